@@ -1,19 +1,71 @@
 import os
+import ast
+import atexit
 import json
 import random
 import glob
 import re
-import time
+import signal
+import threading
 import unicodedata
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import pandas as pd
-import boto3
-from botocore.exceptions import ClientError
-
 import config
+from bedrock_utils import (
+    call_with_retry,
+    create_client,
+    estimate_tokens,
+    get_model_limiter,
+    invoke_model_streaming,
+    summarize_stream_latencies,
+)
+from kb_manifest import build_manifest, diff_manifests, load_manifest, save_manifest
+from llm_cache import cached_invoke, get_llm_cache
+from run_metrics import RunMetrics, record_response_usage
+from run_state import (
+    STATUS_FAILED,
+    STATUS_GENERATED,
+    STATUS_PENDING,
+    STATUS_SKIPPED_NO_GENERATION,
+    RunStateStore,
+    content_hash,
+)
 
 NO_GENERATION_SENTINEL = "No se puede generar con este estilo"
 
+# Worker threads share the parse-failure log, so appends are serialized.
+_parse_fail_lock = threading.Lock()
+
+# Per-call latency records of streamed invocations (list.append is thread-safe).
+stream_latencies = []
+
+run_metrics = RunMetrics("generation")
+
+# Role, task and rules shared by the single-style and multi-style prompts.
+GENERATOR_RULES = """### ROL DEL SISTEMA
+Eres un Generador de Datos Sinteticos especializado en Banca y Bienes Raices de Chile.
+Tu trabajo es crear el Test Set para evaluar un asistente de IA (RAG) del Banco Estado (Casaverso).
+
+### TAREA PRINCIPAL
+Se te entregara un fragmento de texto (La Respuesta).
+Tu objetivo es redactar la Consulta del Usuario (El Input) que provocaria que el sistema recupere este texto como respuesta.
+
+### REGLAS DE ORO (CRITICO: LEER CON ATENCION)
+1. ASIMETRIA DE INFORMACION: El usuario NO ha leido el texto. No sabe los terminos tecnicos exactos, ni los porcentajes, ni los articulos de la ley que aparecen en el texto.
+2. INTENCION vs CONTENIDO:
+- MAL (Contaminado): Cuales son los requisitos del articulo 5 del subsidio DS19?
+- BIEN (Realista): Oye, que papeles me piden para postular al subsidio?
+3. ABSTRACCION: Si el texto habla de Tasa fija del 4.5%, el usuario NO pregunta Es la tasa del 4.5%?. El usuario pregunta Como estan las tasas hoy?.
+4. SI EL TEXTO ES CORTO/PARCIAL: Si el fragmento es muy especifico o tecnico, el usuario debe hacer una pregunta mas amplia o vaga que este fragmento responderia parcialmente.
+5. CONTEXTO CHILENO: Usa vocabulario local, modismos y el tono correspondiente al estilo solicitado.
+
+### DOCUMENTO DE REFERENCIA:
+Se te entregara un fragmento de texto que el asistente deberia recuperar como respuesta a la consulta del usuario."""
+
+MULTI_STYLE_MAX_TOKENS = 4000
+
 QUERY_STYLES = [
     {
         "style_name": "Buscador de Palabras Clave",
@@ -60,9 +112,8 @@ def extract_bd_code(filename):
     return filename[:9]
 
 
-def get_bedrock_client():
-    session = boto3.Session(profile_name=config.AWS_PROFILE_LLM)
-    return session.client(service_name="bedrock-runtime", region_name=config.AWS_REGION)
+def get_bedrock_client(max_pool_connections=None):
+    return create_client("bedrock-runtime", config.AWS_PROFILE_LLM, max_pool_connections)
 
 
 def ensure_parent_dir(path):
@@ -71,78 +122,166 @@ def ensure_parent_dir(path):
         os.makedirs(parent, exist_ok=True)
 
 
-def append_row_to_csv(path, row):
-    ensure_parent_dir(path)
-    file_exists = os.path.exists(path)
-    has_content = file_exists and os.path.getsize(path) > 0
-    pd.DataFrame([row]).to_csv(
-        path,
-        mode="a" if has_content else "w",
-        header=not has_content,
-        index=False,
+class GenerationOutputWriter:
+    """
+    Long-lived, buffered writer for PIPELINE_CSV and the run-state store.
+
+    Rows and status updates are kept in memory and flushed every
+    flush_rows events or flush_seconds, on close/exit and on SIGINT. A
+    flush writes and fsyncs the CSV rows before committing the matching
+    status updates, so a pair is only ever marked done once its row is on disk.
+
+    SIGINT only sets a flag; the main loop calls check_interrupt between
+    results to flush and stop. Raising from the handler could land between
+    the CSV write and the state commit, leaving rows with no recorded state.
+    """
+
+    def __init__(self, csv_path, state_store, flush_rows, flush_seconds):
+        ensure_parent_dir(csv_path)
+        self.csv_path = csv_path
+        self.state_store = state_store
+        self.flush_rows = max(1, flush_rows)
+        self.flush_seconds = flush_seconds
+        self._rows = []
+        self._progress = []
+        self._lock = threading.RLock()
+        self._closed = False
+        self._csv_has_content = os.path.exists(csv_path) and os.path.getsize(csv_path) > 0
+        # Appended rows follow the existing header, which may carry later-stage columns.
+        self._columns = list(pd.read_csv(csv_path, nrows=0).columns) if self._csv_has_content else None
+        self._csv_file = open(csv_path, "a", encoding="utf-8", newline="")
+        self._stop_timer = threading.Event()
+        self._timer = None
+        self._previous_sigint = None
+        self._interrupted = False
+
+    def __enter__(self):
+        if self.flush_seconds > 0:
+            self._timer = threading.Thread(target=self._flush_periodically, daemon=True)
+            self._timer.start()
+        if threading.current_thread() is threading.main_thread():
+            self._previous_sigint = signal.signal(signal.SIGINT, self._handle_sigint)
+        atexit.register(self.close)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def add_row(self, row, file_path, style_name, kb_hash):
+        with self._lock:
+            self._rows.append(row)
+            self._progress.append((file_path, style_name, kb_hash, STATUS_GENERATED))
+            self._maybe_flush()
+
+    def add_progress(self, file_path, style_name, kb_hash, status):
+        with self._lock:
+            self._progress.append((file_path, style_name, kb_hash, status))
+            self._maybe_flush()
+
+    def flush(self):
+        with self._lock:
+            if self._closed:
+                return
+            rows, self._rows = self._rows, []
+            progress, self._progress = self._progress, []
+            if rows:
+                frame = pd.DataFrame(rows)
+                if self._columns is None:
+                    self._columns = list(frame.columns)
+                frame.reindex(columns=self._columns).to_csv(
+                    self._csv_file,
+                    header=not self._csv_has_content,
+                    index=False,
+                )
+                self._csv_has_content = True
+                self._sync(self._csv_file)
+            if progress:
+                self.state_store.mark_many(progress)
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._stop_timer.set()
+            self.flush()
+            self._closed = True
+            self._csv_file.close()
+            if self._previous_sigint is not None:
+                signal.signal(signal.SIGINT, self._previous_sigint)
+                self._previous_sigint = None
+        atexit.unregister(self.close)
+
+    def _maybe_flush(self):
+        if len(self._progress) >= self.flush_rows:
+            self.flush()
+
+    def _flush_periodically(self):
+        while not self._stop_timer.wait(self.flush_seconds):
+            self.flush()
+
+    def _handle_sigint(self, signum, frame):
+        if self._interrupted:
+            print("Interrupt already requested; waiting for the current result to be written...")
+            return
+        self._interrupted = True
+        print("Interrupt requested: stopping once the current result is written...")
+
+    def check_interrupt(self):
+        """Flushes and raises KeyboardInterrupt if SIGINT arrived; call between results."""
+        if not self._interrupted:
+            return
+        self.flush()
+        previous = self._previous_sigint
+        if callable(previous):
+            previous(signal.SIGINT, None)
+        raise KeyboardInterrupt
+
+    @staticmethod
+    def _sync(handle):
+        handle.flush()
+        os.fsync(handle.fileno())
+
+
+def hash_kb_file(file_path):
+    try:
+        with open(file_path, "r", encoding="utf-8") as f:
+            return content_hash(f.read())
+    except OSError:
+        return None
+
+
+def invoke_llm(client, body, expected_blocks=1):
+    """
+    invoke_model, or with STREAMING_GENERATION a streamed call that stops
+    reading once expected_blocks <user_input> tags have been closed.
+    """
+    if config.STREAMING_GENERATION:
+        return invoke_model_streaming(
+            client,
+            config.MODEL_ID,
+            body,
+            stop_tag="</user_input>",
+            stop_count=expected_blocks,
+            latency_log=stream_latencies,
+        )
+    return client.invoke_model(
+        modelId=config.MODEL_ID,
+        body=body
     )
 
 
-def append_progress(progress_log_path, file_path, style_name, status):
-    ensure_parent_dir(progress_log_path)
-    with open(progress_log_path, "a", encoding="utf-8") as f:
-        f.write(json.dumps({
-            "timestamp": datetime.utcnow().isoformat() + "Z",
-            "file_path": file_path,
-            "style_name": style_name,
-            "status": status
-        }, ensure_ascii=False) + "\n")
+def invocation_mode(expected_blocks=1):
+    """LLM cache mode for invoke_llm: streamed bodies end at the last expected </user_input>."""
+    return f"stream:{expected_blocks}" if config.STREAMING_GENERATION else "invoke"
 
 
-def load_processed_pairs(progress_log_path):
-    processed = set()
-    if not os.path.exists(progress_log_path):
-        return processed
-
-    with open(progress_log_path, "r", encoding="utf-8") as f:
-        for line in f:
-            line = line.strip()
-            if not line:
-                continue
-            try:
-                obj = json.loads(line)
-                file_path = obj.get("file_path")
-                style_name = obj.get("style_name")
-                status = obj.get("status")
-                if file_path and style_name and status in {"generated", "skipped_no_generation"}:
-                    processed.add((file_path, style_name))
-            except json.JSONDecodeError:
-                continue
-    return processed
-
-
-def backoff_sleep(attempt):
-    base = config.BACKOFF_BASE_SECONDS * (2 ** attempt)
-    sleep_for = min(base, config.BACKOFF_MAX_SECONDS)
-    sleep_for += random.uniform(0, config.BACKOFF_JITTER_SECONDS)
-    time.sleep(sleep_for)
-
-
-def call_with_retry(fn, operation_name, error_log):
-    last_error = None
-    for attempt in range(config.MAX_RETRIES + 1):
-        try:
-            return fn()
-        except ClientError as e:
-            last_error = e
-        except Exception as e:
-            last_error = e
-
-        if attempt < config.MAX_RETRIES:
-            backoff_sleep(attempt)
-        else:
-            if last_error is not None:
-                error_log.append({
-                    "timestamp": datetime.utcnow().isoformat() + "Z",
-                    "operation": operation_name,
-                    "error": str(last_error),
-                })
-            return None
+def extract_response_content(response_body):
+    if "choices" in response_body:
+        return response_body["choices"][0]["message"]["content"]
+    if "output" in response_body:
+        return response_body["output"]["message"]["content"]
+    return str(response_body)
 
 
 def clean_llm_output(text):
@@ -189,6 +328,43 @@ def parse_llm_xml(content, allowed_styles):
     return question_text, style_found, content_no_reasoning
 
 
+def parse_multi_style_xml(content, allowed_styles):
+    """
+    Parses a repeated <style_name>/<user_input> response into
+    {style_name: question_text}. Blocks that fail validation are left out,
+    and the first valid block per style wins.
+    """
+    content_no_reasoning = clean_llm_output(content)
+    questions = {}
+    for block in re.finditer(
+        r"<style_name>.*?</style_name>\s*<user_input>.*?</user_input>",
+        content_no_reasoning,
+        re.DOTALL | re.IGNORECASE,
+    ):
+        question_text, style_found, _ = parse_llm_xml(block.group(0), allowed_styles)
+        if question_text and style_found and style_found not in questions:
+            questions[style_found] = question_text
+    return questions, content_no_reasoning
+
+
+def response_parses(allowed_styles, multi_style=False):
+    """
+    cached_invoke accept check: only bodies that yield a valid question
+    (at least one, for multi-style answers) are worth caching.
+    """
+    def _accept(raw_body):
+        try:
+            content = extract_response_content(json.loads(raw_body.decode("utf-8")))
+        except (ValueError, KeyError, IndexError, TypeError):
+            return False
+        if multi_style:
+            return bool(parse_multi_style_xml(content, allowed_styles)[0])
+        question_text, style_found, _ = parse_llm_xml(content, allowed_styles)
+        return bool(question_text and style_found)
+
+    return _accept
+
+
 def repair_xml_response(raw_content, allowed_styles, client, error_log):
     allowed_str = ", ".join(allowed_styles) if allowed_styles else ""
     repair_prompt = f"""
@@ -211,22 +387,30 @@ Formato requerido (sin markdown, sin texto adicional):
     })
 
     def _call():
-        return client.invoke_model(
-            modelId=config.MODEL_ID,
-            body=body
-        )
-
-    response = call_with_retry(_call, "invoke_model_repair", error_log)
+        return invoke_llm(client, body)
+
+    response = cached_invoke(
+        get_llm_cache(),
+        config.MODEL_ID,
+        body,
+        0.0,
+        lambda: call_with_retry(
+            _call,
+            "invoke_model_repair",
+            error_log,
+            limiter=get_model_limiter(config.MODEL_ID),
+            tokens=estimate_tokens(repair_prompt) + 500,
+            metrics=run_metrics,
+        ),
+        accept=response_parses(allowed_styles),
+        mode=invocation_mode(),
+    )
     if response is None:
         return None, None, None
 
     response_body = json.loads(response.get("body").read().decode("utf-8"))
-    if "choices" in response_body:
-        content = response_body["choices"][0]["message"]["content"]
-    elif "output" in response_body:
-        content = response_body["output"]["message"]["content"]
-    else:
-        content = str(response_body)
+    record_response_usage(run_metrics, "invoke_model_repair", response, response_body)
+    content = extract_response_content(response_body)
 
     return parse_llm_xml(content, allowed_styles)
 
@@ -237,25 +421,7 @@ def generate_question_for_style(chunk_text, query_style, client, error_log, pars
     allowed_styles = [style_name]
 
     system_prompt = f"""
-### ROL DEL SISTEMA
-Eres un Generador de Datos Sinteticos especializado en Banca y Bienes Raices de Chile.
-Tu trabajo es crear el Test Set para evaluar un asistente de IA (RAG) del Banco Estado (Casaverso).
-
-### TAREA PRINCIPAL
-Se te entregara un fragmento de texto (La Respuesta).
-Tu objetivo es redactar la Consulta del Usuario (El Input) que provocaria que el sistema recupere este texto como respuesta.
-
-### REGLAS DE ORO (CRITICO: LEER CON ATENCION)
-1. ASIMETRIA DE INFORMACION: El usuario NO ha leido el texto. No sabe los terminos tecnicos exactos, ni los porcentajes, ni los articulos de la ley que aparecen en el texto.
-2. INTENCION vs CONTENIDO:
-- MAL (Contaminado): Cuales son los requisitos del articulo 5 del subsidio DS19?
-- BIEN (Realista): Oye, que papeles me piden para postular al subsidio?
-3. ABSTRACCION: Si el texto habla de Tasa fija del 4.5%, el usuario NO pregunta Es la tasa del 4.5%?. El usuario pregunta Como estan las tasas hoy?.
-4. SI EL TEXTO ES CORTO/PARCIAL: Si el fragmento es muy especifico o tecnico, el usuario debe hacer una pregunta mas amplia o vaga que este fragmento responderia parcialmente.
-5. CONTEXTO CHILENO: Usa vocabulario local, modismos y el tono correspondiente al estilo solicitado.
-
-### DOCUMENTO DE REFERENCIA:
-Se te entregara un fragmento de texto que el asistente deberia recuperar como respuesta a la consulta del usuario.
+{GENERATOR_RULES}
 
 ### ESTILO DE CONSULTA OBLIGATORIO:
 Debes redactar la consulta usando EXCLUSIVAMENTE el siguiente estilo:
@@ -293,23 +459,31 @@ Descripcion: {style_description}
     })
 
     def _call():
-        return client.invoke_model(
-            modelId=config.MODEL_ID,
-            body=body
-        )
-
-    response = call_with_retry(_call, "invoke_model", error_log)
+        return invoke_llm(client, body)
+
+    response = cached_invoke(
+        get_llm_cache(),
+        config.MODEL_ID,
+        body,
+        config.TEMPERATURE,
+        lambda: call_with_retry(
+            _call,
+            "invoke_model",
+            error_log,
+            limiter=get_model_limiter(config.MODEL_ID),
+            tokens=estimate_tokens(system_prompt + prompt) + 2000,
+            metrics=run_metrics,
+        ),
+        accept=response_parses(allowed_styles),
+        mode=invocation_mode(),
+    )
     if response is None:
         return None, None
 
     response_body = json.loads(response.get("body").read().decode("utf-8"))
+    record_response_usage(run_metrics, "invoke_model", response, response_body)
 
-    if "choices" in response_body:
-        content = response_body["choices"][0]["message"]["content"]
-    elif "output" in response_body:
-        content = response_body["output"]["message"]["content"]
-    else:
-        content = str(response_body)
+    content = extract_response_content(response_body)
 
     question_text, style_found, cleaned = parse_llm_xml(content, allowed_styles)
     if question_text and style_found:
@@ -320,7 +494,7 @@ Descripcion: {style_description}
         return repair_q, repair_style
 
     ensure_parent_dir(parse_fail_log_path)
-    with open(parse_fail_log_path, "a", encoding="utf-8") as log_file:
+    with _parse_fail_lock, open(parse_fail_log_path, "a", encoding="utf-8") as log_file:
         log_file.write(json.dumps({
             "timestamp": datetime.utcnow().isoformat() + "Z",
             "reason": "parse_failed",
@@ -332,6 +506,275 @@ Descripcion: {style_description}
     return None, None
 
 
+def generate_questions_for_styles(chunk_text, query_styles, client, error_log, parse_fail_log_path):
+    """
+    Asks for every style in a single invoke_model call. Returns a list of
+    (question_text, style_found) aligned with query_styles; styles missing or
+    invalid in the combined answer are retried one by one.
+    """
+    allowed_styles = [style["style_name"] for style in query_styles]
+    styles_block = "\n".join(
+        f"{idx}. Nombre: {style['style_name']}\n   Descripcion: {style['description']}"
+        for idx, style in enumerate(query_styles, start=1)
+    )
+    output_example = "\n".join(
+        f"<style_name>NOMBRE_DEL_ESTILO_{idx}</style_name>\n<user_input>CONSULTA_PARA_EL_ESTILO_{idx}</user_input>"
+        for idx in range(1, min(len(query_styles), 2) + 1)
+    )
+
+    system_prompt = f"""
+{GENERATOR_RULES}
+
+### ESTILOS DE CONSULTA OBLIGATORIOS:
+Debes redactar UNA consulta por cada uno de los siguientes estilos, usando en cada una EXCLUSIVAMENTE ese estilo:
+{styles_block}
+
+Si un estilo no aplica al documento o no es posible crear una consulta realista para ese documento con ese estilo, debes responder dentro del tag <user_input> de ese estilo exactamente:
+{NO_GENERATION_SENTINEL}
+
+No puedes usar ninguna otra frase alternativa para ese caso.
+
+### FORMATO DE SALIDA
+Tu respuesta sera un bloque por estilo, en el mismo orden de la lista, cada uno con dos tags xml: <style_name> y <user_input>.
+El texto dentro de cada style_name debe ser EXACTAMENTE el nombre del estilo correspondiente.
+El texto dentro de cada <user_input> debe ser la consulta generada, sin comillas, sin saltos de linea, sin explicaciones adicionales.
+Responde UNICAMENTE con este formato XML, repetido para los {len(query_styles)} estilos (sin markdown, sin explicaciones):
+
+{output_example}
+"""
+
+    prompt = f"""
+### DOCUMENTO DE REFERENCIA:
+{chunk_text}
+
+### ESTILOS DE CONSULTA OBLIGATORIOS:
+{styles_block}
+"""
+
+    body = json.dumps({
+        "messages": [{"role": "system", "content": system_prompt}, {"role": "user", "content": prompt}],
+        "temperature": config.TEMPERATURE,
+        "max_tokens": MULTI_STYLE_MAX_TOKENS
+    })
+
+    def _call():
+        return invoke_llm(client, body, expected_blocks=len(query_styles))
+
+    response = cached_invoke(
+        get_llm_cache(),
+        config.MODEL_ID,
+        body,
+        config.TEMPERATURE,
+        lambda: call_with_retry(
+            _call,
+            "invoke_model_multi_style",
+            error_log,
+            limiter=get_model_limiter(config.MODEL_ID),
+            tokens=estimate_tokens(system_prompt + prompt) + MULTI_STYLE_MAX_TOKENS,
+            metrics=run_metrics,
+        ),
+        accept=response_parses(allowed_styles, multi_style=True),
+        mode=invocation_mode(len(query_styles)),
+    )
+    if response is None:
+        return [(None, None) for _ in query_styles]
+
+    response_body = json.loads(response.get("body").read().decode("utf-8"))
+    record_response_usage(run_metrics, "invoke_model_multi_style", response, response_body)
+    questions, _ = parse_multi_style_xml(extract_response_content(response_body), allowed_styles)
+
+    results = []
+    for style in query_styles:
+        style_name = style["style_name"]
+        if style_name in questions:
+            results.append((questions[style_name], style_name))
+            continue
+        print(f"  - Multi-style answer missing '{style_name}', retrying on its own")
+        results.append(generate_question_for_style(
+            chunk_text,
+            style,
+            client,
+            error_log,
+            parse_fail_log_path
+        ))
+    return results
+
+
+def iter_work_items(files, manifest, state_store, multi_style=False):
+    """
+    Yields (file_path, chunk_text, kb_hash, styles) in sequential-run order,
+    where styles is a list of (style_idx, style). Each pending style is its
+    own work item, unless multi_style groups all of a file's pending styles.
+    Files with nothing pending are skipped without being read.
+    """
+    for i, file_path in enumerate(files):
+        if file_path not in manifest:
+            continue
+
+        kb_hash = manifest[file_path]["sha256"]
+        pending_styles = [
+            (style_idx, style)
+            for style_idx, style in enumerate(QUERY_STYLES, start=1)
+            if not state_store.is_done(file_path, style["style_name"], kb_hash)
+        ]
+        if not pending_styles:
+            continue
+
+        try:
+            with open(file_path, "r", encoding="utf-8") as f:
+                chunk_text = f.read()
+        except Exception as e:
+            print(f"Error reading file {file_path}: {e}")
+            continue
+
+        if len(chunk_text) < 30:
+            continue
+
+        state_store.mark_many([
+            (file_path, style["style_name"], kb_hash, STATUS_PENDING)
+            for _, style in pending_styles
+        ])
+        print(f"[{i + 1}/{len(files)}] Queueing {os.path.basename(file_path)}")
+        if multi_style:
+            yield file_path, chunk_text, kb_hash, pending_styles
+        else:
+            for pending_style in pending_styles:
+                yield file_path, chunk_text, kb_hash, [pending_style]
+
+
+def apply_kb_changes(kb_changes, manifest, state_store):
+    """Carries renamed documents over and marks rows of outdated content stale."""
+    stale_count = 0
+    for old_path, new_path in kb_changes["renamed"]:
+        # A rename keeps its rows only if the BD code used as source_file is unchanged.
+        if extract_bd_code(os.path.basename(old_path)) == extract_bd_code(os.path.basename(new_path)):
+            state_store.carry_over(old_path, new_path, manifest[new_path]["sha256"])
+        stale_count += state_store.mark_stale(old_path)
+    for file_path in kb_changes["deleted"]:
+        stale_count += state_store.mark_stale(file_path)
+    for file_path in kb_changes["added"] + kb_changes["changed"]:
+        stale_count += state_store.mark_stale(file_path, keep_hash=manifest[file_path]["sha256"])
+    return stale_count
+
+
+def reference_hash(reference_contexts):
+    """content_hash of the document text a row was generated from (its reference_contexts cell)."""
+    try:
+        contexts = ast.literal_eval(reference_contexts) if isinstance(reference_contexts, str) else reference_contexts
+    except (ValueError, SyntaxError):
+        return None
+    if not isinstance(contexts, list) or not contexts:
+        return None
+    return content_hash(str(contexts[0]))
+
+
+def flag_outdated_rows(csv_path, previous_manifest, manifest, renamed=()):
+    """
+    Sets the stale column of PIPELINE_CSV rows generated from document
+    content that is no longer in the KB (edited, deleted or re-coded
+    documents), matching rows on (source_path, kb_hash). Rows are kept,
+    so columns added by later stages survive. Rows written before
+    kb_hash / source_path existed are stamped from their own
+    reference_contexts text and the manifest path with that BD code and
+    hash. Returns (stale rows, kb_hash values in the CSV).
+    """
+    if not os.path.exists(csv_path) or os.path.getsize(csv_path) == 0:
+        return 0, set()
+    df = pd.read_csv(csv_path)
+    if "source_file" not in df.columns:
+        return 0, set()
+    before = df.copy()
+
+    if "kb_hash" not in df.columns:
+        df["kb_hash"] = None
+    if "source_path" not in df.columns:
+        df["source_path"] = None
+    missing_hash = df["kb_hash"].isna()
+    if missing_hash.any():
+        df.loc[missing_hash, "kb_hash"] = df.loc[missing_hash, "reference_contexts"].map(reference_hash)
+
+    missing_path = df["source_path"].isna()
+    if missing_path.any():
+        paths_by_code = {}
+        for path, entry in list((previous_manifest or {}).items()) + list(manifest.items()):
+            paths_by_code.setdefault(extract_bd_code(os.path.basename(path)), {}).setdefault(entry["sha256"], path)
+
+        def _resolve(source_file, kb_hash):
+            candidates = paths_by_code.get(str(source_file), {})
+            if kb_hash in candidates:
+                return candidates[kb_hash]
+            # Content no longer known: the path is only certain when one file carries the BD code.
+            paths = set(candidates.values())
+            return paths.pop() if len(paths) == 1 else None
+
+        df.loc[missing_path, "source_path"] = [
+            _resolve(source_file, kb_hash)
+            for source_file, kb_hash in zip(df.loc[missing_path, "source_file"], df.loc[missing_path, "kb_hash"])
+        ]
+
+    for old_path, new_path in renamed:
+        # Same rule as apply_kb_changes: rows follow a rename only if the BD code is unchanged.
+        if extract_bd_code(os.path.basename(old_path)) == extract_bd_code(os.path.basename(new_path)):
+            df.loc[df["source_path"] == old_path, "source_path"] = new_path
+
+    live = {(path, entry["sha256"]) for path, entry in manifest.items()}
+    df["stale"] = [
+        (source_path, kb_hash) not in live
+        for source_path, kb_hash in zip(df["source_path"], df["kb_hash"])
+    ]
+    if not df.equals(before):
+        tmp_path = f"{csv_path}.tmp"
+        df.to_csv(tmp_path, index=False)
+        os.replace(tmp_path, csv_path)
+    return int(df["stale"].sum()), set(df["kb_hash"].dropna())
+
+
+def run_work_items(work_items, client, error_log, parse_fail_log_path, max_workers, multi_style=False):
+    """
+    Runs generation calls on a bounded thread pool and yields
+    (work_item, results) in submission order, so the caller can write
+    rows exactly as a sequential run would.
+    """
+    def _generate(item):
+        _, chunk_text, _, styles = item
+        if multi_style:
+            return generate_questions_for_styles(
+                chunk_text,
+                [style for _, style in styles],
+                client,
+                error_log,
+                parse_fail_log_path
+            )
+        return [
+            generate_question_for_style(
+                chunk_text,
+                style,
+                client,
+                error_log,
+                parse_fail_log_path
+            )
+            for _, style in styles
+        ]
+
+    max_in_flight = max(1, max_workers) * 2
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        in_flight = deque()
+        for item in work_items:
+            in_flight.append((item, executor.submit(_generate, item)))
+            if len(in_flight) >= max_in_flight:
+                yield _resolve(*in_flight.popleft())
+        while in_flight:
+            yield _resolve(*in_flight.popleft())
+
+
+def _resolve(item, future):
+    try:
+        return item, future.result()
+    except Exception as e:
+        print(f"Error generating for {item[0]}: {e}")
+        return item, [(None, None) for _ in item[3]]
+
+
 def main():
     random.seed(config.SEED)
     print(f"Using seed: {config.SEED}")
@@ -350,7 +793,8 @@ def main():
 
     print(f"Found {len(files)} Markdown files.")
 
-    client = get_bedrock_client()
+    max_workers = max(1, config.GENERATION_WORKERS)
+    client = get_bedrock_client(max_pool_connections=max_workers)
     error_log = []
     parse_failures = 0
     generated_count = 0
@@ -363,57 +807,112 @@ def main():
         os.path.dirname(config.PIPELINE_CSV),
         "generation_progress.jsonl"
     )
+    state_path = os.path.join(
+        os.path.dirname(config.PIPELINE_CSV),
+        "generation_state.sqlite"
+    )
 
-    processed_pairs = load_processed_pairs(progress_log_path)
-    print(f"Resuming with {len(processed_pairs)} completed file/style pairs.")
-    print("Generating synthetic questions...")
-
-    for i, file_path in enumerate(files):
-        try:
-            with open(file_path, "r", encoding="utf-8") as f:
-                chunk_text = f.read()
+    manifest_path = os.path.join(
+        os.path.dirname(config.PIPELINE_CSV),
+        "kb_manifest.json"
+    )
 
-            if len(chunk_text) < 30:
-                continue
+    state_store = RunStateStore(state_path)
+    imported = state_store.import_progress_log(progress_log_path, hash_kb_file)
+    if imported:
+        print(f"Imported {imported} completed pairs from {progress_log_path}.")
+
+    previous_manifest = load_manifest(manifest_path)
+    manifest = build_manifest(files, previous_manifest)
+    kb_changes = diff_manifests(previous_manifest, manifest)
+    stale_count = apply_kb_changes(kb_changes, manifest, state_store)
+    outdated_rows, csv_hashes = flag_outdated_rows(
+        config.PIPELINE_CSV, previous_manifest, manifest, kb_changes["renamed"]
+    )
+    print(
+        "KB changes: "
+        f"{len(kb_changes['added'])} added | {len(kb_changes['changed'])} changed | "
+        f"{len(kb_changes['renamed'])} renamed | {len(kb_changes['deleted'])} deleted | "
+        f"{len(kb_changes['unchanged'])} unchanged ({stale_count} entries marked stale, "
+        f"{outdated_rows} outdated rows flagged stale in {config.PIPELINE_CSV})"
+    )
+    print(f"Resuming with {state_store.count_done()} completed file/style pairs.")
+    print(f"Generating synthetic questions with {max_workers} workers...")
+
+    multi_style = config.MULTI_STYLE_GENERATION
+    if multi_style:
+        print("Multi-style mode: one call per file for all pending styles.")
+    work_items = iter_work_items(files, manifest, state_store, multi_style)
+    results = run_work_items(
+        work_items,
+        client,
+        error_log,
+        parse_fail_log_path,
+        max_workers,
+        multi_style
+    )
 
-            print(f"[{i + 1}/{len(files)}] Processing {os.path.basename(file_path)}")
-            for style_idx, style in enumerate(QUERY_STYLES, start=1):
+    # Only this loop touches PIPELINE_CSV and the run state, so writes stay
+    # serialized and ordered even though generation runs concurrently.
+    with GenerationOutputWriter(
+        config.PIPELINE_CSV,
+        state_store,
+        flush_rows=config.OUTPUT_FLUSH_ROWS,
+        flush_seconds=config.OUTPUT_FLUSH_SECONDS,
+    ) as writer:
+        for (file_path, chunk_text, kb_hash, styles), style_results in results:
+            for (style_idx, style), (generated_question, style_used) in zip(styles, style_results):
                 style_name = style["style_name"]
-                pair_key = (file_path, style_name)
-                if pair_key in processed_pairs:
-                    continue
-
-                print(f"  - Style [{style_idx}/{len(QUERY_STYLES)}]: {style_name}")
-                generated_question, style_used = generate_question_for_style(
-                    chunk_text,
-                    style,
-                    client,
-                    error_log,
-                    parse_fail_log_path
-                )
+                print(f"  - {os.path.basename(file_path)} | Style [{style_idx}/{len(QUERY_STYLES)}]: {style_name}")
 
                 if not (generated_question and style_used):
                     parse_failures += 1
+                    writer.add_progress(file_path, style_name, kb_hash, STATUS_FAILED)
                     continue
 
                 if generated_question == NO_GENERATION_SENTINEL:
                     skipped_by_style_count += 1
-                    append_progress(progress_log_path, file_path, style_name, "skipped_no_generation")
-                    processed_pairs.add(pair_key)
+                    writer.add_progress(file_path, style_name, kb_hash, STATUS_SKIPPED_NO_GENERATION)
                     continue
 
                 row = {
                     "user_input": generated_question,
                     "reference_contexts": [chunk_text],
                     "query_style": style_used,
-                    "source_file": extract_bd_code(os.path.basename(file_path))
+                    "source_file": extract_bd_code(os.path.basename(file_path)),
+                    "source_path": file_path,
+                    "kb_hash": kb_hash,
+                    "stale": False,
                 }
-                append_row_to_csv(config.PIPELINE_CSV, row)
+                writer.add_row(row, file_path, style_name, kb_hash)
                 generated_count += 1
-                append_progress(progress_log_path, file_path, style_name, "generated")
-                processed_pairs.add(pair_key)
-        except Exception as e:
-            print(f"Error reading file {file_path}: {e}")
+            writer.check_interrupt()
+
+    save_manifest(manifest_path, manifest)
+    removed = state_store.compact(keep_hashes=csv_hashes)
+    if removed:
+        print(f"Compacted run state: removed {removed} superseded entries.")
+    state_store.close()
+
+    llm_cache = get_llm_cache()
+    cache_stats = llm_cache.stats() if llm_cache is not None else None
+    if cache_stats:
+        print(f"LLM cache: {cache_stats['hits']} hits | {cache_stats['misses']} misses")
+
+    stream_stats = summarize_stream_latencies(stream_latencies)
+    if stream_stats:
+        print(
+            f"Streaming: {stream_stats['calls']} calls | "
+            f"{stream_stats['stopped_early']} stopped early | "
+            f"avg TTFT {stream_stats['avg_ttft_seconds'] or 0:.2f}s | "
+            f"avg latency {stream_stats['avg_latency_seconds']:.2f}s"
+        )
+
+    metrics_path = os.path.join(
+        os.path.dirname(config.PIPELINE_CSV),
+        "generation_metrics.json"
+    )
+    run_metrics.print_summary(run_metrics.write(metrics_path))
 
     if generated_count > 0:
         print(f"Successfully generated {generated_count} test cases. Saved incrementally to {config.PIPELINE_CSV}")
@@ -426,6 +925,8 @@ def main():
             f"{len(error_log)} | Parse failures: {parse_failures} | "
             f"Skipped by style mismatch: {skipped_by_style_count}"
         )
+
+    if error_log or parse_failures or skipped_by_style_count or cache_stats or stream_stats:
         summary_path = os.path.join(
             os.path.dirname(config.PIPELINE_CSV),
             "run_summary.json"
@@ -436,6 +937,13 @@ def main():
                 "generated": generated_count,
                 "parse_failures": parse_failures,
                 "skipped_by_style_mismatch": skipped_by_style_count,
+                "llm_cache": cache_stats,
+                "streaming": stream_stats,
+                "kb_changes": {
+                    key: len(paths) for key, paths in kb_changes.items()
+                },
+                "stale_entries": stale_count,
+                "stale_rows": outdated_rows,
                 "errors": error_log,
             }, summary_file, ensure_ascii=False, indent=2)
 
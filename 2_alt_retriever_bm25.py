@@ -0,0 +1,113 @@
+import glob
+import os
+import time
+
+import pandas as pd
+
+import config
+from bm25_index import BM25Index
+from kb_manifest import build_manifest
+from kb_variants import variant_column
+from row_checkpoint import atomic_write_csv
+
+
+def list_kb_files():
+    search_pattern = os.path.join(config.KB_FOLDER, "**", "*.md")
+    return sorted(glob.glob(search_pattern, recursive=True))
+
+
+def index_params():
+    return {
+        "k1": config.BM25_K1,
+        "b": config.BM25_B,
+        "chunk_words": config.BM25_CHUNK_WORDS,
+        "overlap_words": config.BM25_CHUNK_OVERLAP_WORDS,
+    }
+
+
+def content_hashes(manifest):
+    return {path: entry.get("sha256") for path, entry in manifest.items()}
+
+
+def load_or_build_index(files):
+    """
+    Loads the persisted index when it was built from the same KB contents
+    and parameters; otherwise rebuilds it from KB_FOLDER and saves it.
+    """
+    index = BM25Index.load(config.BM25_INDEX_DIR)
+    previous = index.sources if index is not None else {}
+    manifest = build_manifest(files, previous)
+    if index is not None and index.params == index_params() and content_hashes(previous) == content_hashes(manifest):
+        print(f"Loaded BM25 index from {config.BM25_INDEX_DIR} ({index.num_passages} passages).")
+        return index
+
+    print(f"Building BM25 index over {len(manifest)} files...")
+    started = time.monotonic()
+    documents = []
+    for file_path in manifest:
+        with open(file_path, "r", encoding="utf-8") as f:
+            documents.append((file_path, f.read()))
+    params = index_params()
+    index = BM25Index.build(
+        documents,
+        k1=params["k1"],
+        b=params["b"],
+        chunk_words=params["chunk_words"],
+        overlap_words=params["overlap_words"],
+        sources=manifest,
+    )
+    index.save(config.BM25_INDEX_DIR)
+    print(
+        f"Indexed {index.num_passages} passages, {len(index.vocabulary)} terms "
+        f"in {time.monotonic() - started:.2f}s. Saved to {config.BM25_INDEX_DIR}"
+    )
+    return index
+
+
+def retrieve_batch(index, queries, top_k):
+    """Same (retrieved_contexts, retrieved_file) lists 2_retriever.py writes, for every query."""
+    retrieved_data = []
+    retrieved_files_data = []
+    for passage_ids, _ in index.search(queries, top_k):
+        retrieved_data.append([index.passages[i] for i in passage_ids])
+        retrieved_files_data.append([index.uris[i] for i in passage_ids])
+    return retrieved_data, retrieved_files_data
+
+
+def main():
+    print(f"Loading {config.PIPELINE_CSV}...")
+    try:
+        df = pd.read_csv(config.PIPELINE_CSV)
+    except FileNotFoundError:
+        print("Input file not found. Run File 1 first.")
+        return
+
+    if 'user_input' not in df.columns:
+        print("Missing required column 'user_input'. Run File 1 first.")
+        return
+
+    files = list_kb_files()
+    if not files:
+        print(f"No .md files found in {config.KB_FOLDER} or its subdirectories.")
+        return
+
+    index = load_or_build_index(files)
+    top_k = max(config.TOP_K, config.SWEEP_K_MAX)
+    queries = ["" if pd.isna(query) else str(query) for query in df['user_input'].tolist()]
+
+    started = time.monotonic()
+    retrieved_data, retrieved_files_data = retrieve_batch(index, queries, top_k)
+    elapsed = time.monotonic() - started
+    rate = len(queries) / elapsed if elapsed > 0 else float("inf")
+    print(f"Retrieved top-{top_k} for {len(queries)} queries in {elapsed:.2f}s ({rate:.0f} queries/s).")
+
+    variant = config.BM25_OUTPUT_VARIANT or None
+    df[variant_column('retrieved_contexts', variant)] = retrieved_data
+    df[variant_column('retrieved_file', variant)] = retrieved_files_data
+
+    atomic_write_csv(df, config.PIPELINE_CSV)
+    print(f"BM25 retrieval complete. Updated {config.PIPELINE_CSV}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+import glob
+import json
+import os
+import re
+import time
+
+import pandas as pd
+
+import config
+from bedrock_utils import create_client
+from kb_manifest import build_manifest
+from kb_variants import variant_column
+from row_checkpoint import atomic_write_csv
+from run_metrics import RunMetrics
+from vector_index import (
+    EmbeddingError,
+    HashingEmbeddingProvider,
+    TitanEmbeddingProvider,
+    VectorStore,
+    split_passages_by_tokens,
+)
+
+run_metrics = RunMetrics("dense_retrieval")
+
+
+def get_bedrock_client(max_pool_connections=None):
+    return create_client("bedrock-runtime", config.AWS_PROFILE_LLM, max_pool_connections)
+
+
+def get_embedding_provider(error_log):
+    if config.VECTOR_PROVIDER == "hash":
+        return HashingEmbeddingProvider(dim=config.VECTOR_DIM)
+    if config.VECTOR_PROVIDER == "titan":
+        workers = max(1, config.EMBEDDING_WORKERS)
+        return TitanEmbeddingProvider(
+            get_bedrock_client(max_pool_connections=workers),
+            config.VECTOR_EMBEDDING_MODEL_ID,
+            dim=config.VECTOR_DIM,
+            workers=workers,
+            error_log=error_log,
+            metrics=run_metrics,
+        )
+    raise ValueError(f"Unknown VECTOR_PROVIDER '{config.VECTOR_PROVIDER}'; use 'hash' or 'titan'.")
+
+
+def get_index_dir(provider):
+    """One store per provider / chunk size / dtype, so 200- and 512-token runs coexist."""
+    slug = re.sub(r"[^A-Za-z0-9]+", "_", provider.name).strip("_")
+    return os.path.join(
+        config.VECTOR_INDEX_ROOT,
+        f"{slug}_{config.VECTOR_CHUNK_TOKENS}tok_{config.VECTOR_DTYPE}",
+    )
+
+
+def load_or_build_store(files, provider):
+    """
+    Loads the store when it was built from the same KB contents and
+    chunking; otherwise re-chunks KB_FOLDER, embeds and saves it.
+    """
+    index_dir = get_index_dir(provider)
+    store = VectorStore.load(index_dir)
+    previous = store.meta.get("sources", {}) if store is not None else {}
+    manifest = build_manifest(files, previous)
+    chunking = {
+        "chunk_tokens": config.VECTOR_CHUNK_TOKENS,
+        "overlap_tokens": config.VECTOR_CHUNK_OVERLAP_TOKENS,
+    }
+    if (
+        store is not None
+        and store.meta.get("chunking") == chunking
+        and {path: entry.get("sha256") for path, entry in previous.items()}
+        == {path: entry.get("sha256") for path, entry in manifest.items()}
+    ):
+        print(f"Loaded vector store from {index_dir} ({len(store)} passages, {store.meta['dtype']}).")
+    else:
+        passages = []
+        uris = []
+        for file_path in manifest:
+            with open(file_path, "r", encoding="utf-8") as f:
+                text = f.read()
+            for passage in split_passages_by_tokens(text, config.VECTOR_CHUNK_TOKENS, config.VECTOR_CHUNK_OVERLAP_TOKENS):
+                passages.append(passage)
+                uris.append(file_path)
+        print(f"Embedding {len(passages)} passages from {len(manifest)} files with {provider.name}...")
+        store = VectorStore.build(
+            index_dir,
+            passages,
+            uris,
+            provider,
+            dtype=config.VECTOR_DTYPE,
+            meta={"chunking": chunking, "sources": manifest},
+        )
+        print(f"Saved vector store to {index_dir}")
+
+    if config.VECTOR_IVF_LISTS > 0:
+        ivf_lists = len(store.ivf["centroids"]) if store.ivf is not None else 0
+        if ivf_lists != min(config.VECTOR_IVF_LISTS, len(store)):
+            print(f"Building IVF index with {config.VECTOR_IVF_LISTS} lists...")
+            store.build_ivf(config.VECTOR_IVF_LISTS)
+    return store
+
+
+def main():
+    print(f"Loading {config.PIPELINE_CSV}...")
+    try:
+        df = pd.read_csv(config.PIPELINE_CSV)
+    except FileNotFoundError:
+        print("Input file not found. Run File 1 first.")
+        return
+
+    if 'user_input' not in df.columns:
+        print("Missing required column 'user_input'. Run File 1 first.")
+        return
+
+    files = sorted(glob.glob(os.path.join(config.KB_FOLDER, "**", "*.md"), recursive=True))
+    if not files:
+        print(f"No .md files found in {config.KB_FOLDER} or its subdirectories.")
+        return
+
+    error_log = []
+    try:
+        provider = get_embedding_provider(error_log)
+    except ValueError as exc:
+        print(exc)
+        return
+    top_k = max(config.TOP_K, config.SWEEP_K_MAX)
+    queries = ["" if pd.isna(query) else str(query) for query in df['user_input'].tolist()]
+
+    stage = "passages"
+    try:
+        store = load_or_build_store(files, provider)
+        stage = "queries"
+        started = time.monotonic()
+        query_vectors = provider.embed(queries)
+    except EmbeddingError as exc:
+        print(f"Dense retrieval aborted, {config.PIPELINE_CSV} left unchanged: {exc} while embedding {stage}.")
+        write_run_summary(provider, error_log, {"stage": stage, "rows": exc.failed_rows, "total": exc.total})
+        run_metrics.print_summary(run_metrics.write(os.path.join(os.path.dirname(config.PIPELINE_CSV), "dense_retrieval_metrics.json")))
+        return
+    embedded_at = time.monotonic()
+    if config.VECTOR_IVF_LISTS > 0:
+        results = store.search_ivf(query_vectors, top_k, nprobe=config.VECTOR_IVF_NPROBE)
+    else:
+        results = store.search(query_vectors, top_k)
+    finished = time.monotonic()
+    print(
+        f"Embedded {len(queries)} queries in {embedded_at - started:.2f}s; "
+        f"top-{top_k} search in {finished - embedded_at:.2f}s."
+    )
+
+    variant = config.VECTOR_OUTPUT_VARIANT or None
+    df[variant_column('retrieved_contexts', variant)] = [[store.passages[i] for i in rows] for rows, _ in results]
+    df[variant_column('retrieved_file', variant)] = [[store.uris[i] for i in rows] for rows, _ in results]
+
+    atomic_write_csv(df, config.PIPELINE_CSV)
+    print(f"Dense retrieval complete. Updated {config.PIPELINE_CSV}")
+
+    if config.VECTOR_PROVIDER == "titan":
+        metrics_path = os.path.join(os.path.dirname(config.PIPELINE_CSV), "dense_retrieval_metrics.json")
+        run_metrics.print_summary(run_metrics.write(metrics_path))
+    if error_log:
+        write_run_summary(provider, error_log)
+
+
+def write_run_summary(provider, error_log, failed=None):
+    summary_path = os.path.join(os.path.dirname(config.PIPELINE_CSV), "dense_retriever_run_summary.json")
+    with open(summary_path, "w", encoding="utf-8") as summary_file:
+        json.dump({
+            "embedding_failures": getattr(provider, "failures", 0),
+            "failed_rows": failed,
+            "errors": error_log,
+        }, summary_file, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
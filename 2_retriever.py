@@ -1,49 +1,26 @@
 import os
 import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import pandas as pd
-import boto3
-import random
-import time
-from datetime import datetime
-from botocore.exceptions import ClientError
 import config
+from bedrock_utils import call_with_retry, create_client, get_kb_limiter
+from kb_variants import variant_column
+from retrieval_cache import get_retrieval_cache
+from row_checkpoint import RowCheckpoint, atomic_write_csv, build_row_keys
+from run_metrics import RunMetrics
 
-def get_runtime_client():
-    session = boto3.Session(profile_name=config.AWS_PROFILE_SANDBOX)
-    return session.client(service_name=config.KB_SERVICE, region_name=config.AWS_REGION)
+run_metrics = RunMetrics("retrieval")
+
+ROW_IDENTITY_COLUMNS = ["user_input", "query_style", "source_file"]
+
+def get_runtime_client(max_pool_connections=None):
+    return create_client(config.KB_SERVICE, config.AWS_PROFILE_SANDBOX, max_pool_connections)
 
 def ensure_parent_dir(path):
     parent = os.path.dirname(path)
     if parent:
         os.makedirs(parent, exist_ok=True)
 
-def backoff_sleep(attempt):
-    base = config.BACKOFF_BASE_SECONDS * (2 ** attempt)
-    sleep_for = min(base, config.BACKOFF_MAX_SECONDS)
-    sleep_for += random.uniform(0, config.BACKOFF_JITTER_SECONDS)
-    time.sleep(sleep_for)
-
-def call_with_retry(fn, operation_name, error_log):
-    last_error = None
-    for attempt in range(config.MAX_RETRIES + 1):
-        try:
-            return fn()
-        except ClientError as e:
-            last_error = e
-        except Exception as e:
-            last_error = e
-
-        if attempt < config.MAX_RETRIES:
-            backoff_sleep(attempt)
-        else:
-            if last_error is not None:
-                error_log.append({
-                    "timestamp": datetime.utcnow().isoformat() + "Z",
-                    "operation": operation_name,
-                    "error": str(last_error),
-                })
-            return None
-
 def clean_text(text):
     """Helper to clean retrieved text for better comparison."""
     if not text:
@@ -53,26 +30,44 @@ def clean_text(text):
 def extract_s3_uri(uri):
     return uri or ""
 
-def retrieve_contexts(query, client, error_log):
-    def _call():
-        return client.retrieve(
-            knowledgeBaseId=config.KB_ID_512,
-            retrievalQuery={
-                'text': query
-            },
-            retrievalConfiguration={
-                'vectorSearchConfiguration': {
-                    'numberOfResults': config.TOP_K
+def get_retrieval_k():
+    """TOP_K, or SWEEP_K_MAX when a K-sweep needs more contexts per query."""
+    return max(config.TOP_K, config.SWEEP_K_MAX)
+
+def retrieve_contexts(query, client, error_log, kb_id):
+    top_k = get_retrieval_k()
+    cache = get_retrieval_cache()
+    results = cache.get(kb_id, query, top_k) if cache else None
+
+    if results is None:
+        def _call():
+            return client.retrieve(
+                knowledgeBaseId=kb_id,
+                retrievalQuery={
+                    'text': query
+                },
+                retrievalConfiguration={
+                    'vectorSearchConfiguration': {
+                        'numberOfResults': top_k
+                    }
                 }
-            }
+            )
+
+        response = call_with_retry(
+            _call,
+            "retrieve",
+            error_log,
+            limiter=get_kb_limiter(kb_id),
+            metrics=run_metrics,
         )
+        if response is None:
+            print(f"Retrieval Error for query '{query}' on KB {kb_id}: exhausted retries")
+            return None
 
-    response = call_with_retry(_call, "retrieve", error_log)
-    if response is None:
-        print(f"Retrieval Error for query '{query}': exhausted retries")
-        return [], []
+        results = response.get('retrievalResults', [])
+        if cache:
+            cache.put(kb_id, query, top_k, results)
 
-    results = response.get('retrievalResults', [])
     retrieved_texts = []
     retrieved_files = []
     for res in results:
@@ -86,6 +81,9 @@ def retrieve_contexts(query, client, error_log):
         retrieved_files.append(extract_s3_uri(uri))
     return retrieved_texts, retrieved_files
 
+def get_checkpoint_path():
+    return os.path.join(os.path.dirname(config.PIPELINE_CSV), "retrieval_checkpoint.jsonl")
+
 def main():
     print(f"Loading {config.PIPELINE_CSV}...")
     try:
@@ -98,29 +96,107 @@ def main():
         print("Missing required column 'user_input'. Run File 1 first.")
         return
 
-    client = get_runtime_client()
+    unknown = [variant for variant in config.RETRIEVAL_KB_VARIANTS if variant not in config.KB_IDS]
+    if unknown or not config.RETRIEVAL_KB_VARIANTS:
+        print(f"Unknown RETRIEVAL_KB_VARIANTS {unknown}; expected a comma-separated subset of {list(config.KB_IDS)}.")
+        return
+    kb_ids = {variant: config.KB_IDS[variant] for variant in config.RETRIEVAL_KB_VARIANTS}
+    # A single KB keeps the plain column names used by the rest of the pipeline.
+    namespaced = len(kb_ids) > 1
+
+    cache = get_retrieval_cache()
+    if cache:
+        for kb_id in kb_ids.values():
+            purged = cache.purge_other_versions(kb_id)
+            if purged:
+                print(f"Dropped {purged} cached retrievals of KB {kb_id} from other KB versions.")
+
+    # Each KB has its own rate limiter, so extra KBs add concurrency instead of wall-clock time.
+    max_workers = max(1, config.RETRIEVAL_WORKERS) * len(kb_ids)
+    client = get_runtime_client(max_pool_connections=max_workers)
     error_log = []
-    
-    print("Starting retrieval process...")
-    retrieved_data = []
-    retrieved_files_data = []
-    
-    for index, row in df.iterrows():
-        query = row['user_input']
-        print(f"[{index+1}/{len(df)}] Retrieving: {query[:30]}...")
-        
-        contexts, retrieved_files = retrieve_contexts(query, client, error_log)
-        retrieved_data.append(contexts)
-        retrieved_files_data.append(retrieved_files)
-
-    df['retrieved_contexts'] = retrieved_data
-    df['retrieved_file'] = retrieved_files_data
-    
-    ensure_parent_dir(config.PIPELINE_CSV)
-    df.to_csv(config.PIPELINE_CSV, index=False)
-    print(f"Retrieval complete. Updated {config.PIPELINE_CSV}")
-
-    if error_log:
+
+    identity_columns = [column for column in ROW_IDENTITY_COLUMNS if column in df.columns]
+    row_keys = build_row_keys(zip(*(df[column].tolist() for column in identity_columns)))
+    checkpoint = RowCheckpoint(
+        get_checkpoint_path(),
+        scope={"kb_version": config.KB_VERSION_TAG, "top_k": get_retrieval_k()},
+        fsync_every=config.OUTPUT_FLUSH_ROWS,
+    )
+    done = checkpoint.load()
+    queries = df['user_input'].tolist()
+    pending = [
+        (index, kb_id)
+        for index, row_key in enumerate(row_keys)
+        for kb_id in kb_ids.values()
+        if f"{row_key}|{kb_id}" not in done
+    ]
+    total_tasks = len(df) * len(kb_ids)
+    if len(pending) < total_tasks:
+        print(f"Resuming: {total_tasks - len(pending)} retrievals already done, {len(pending)} remaining.")
+
+    print(
+        f"Starting retrieval process on KBs {list(kb_ids.values())} with {max_workers} workers "
+        f"(top_k={get_retrieval_k()})..."
+    )
+    failed = 0
+    interrupted = False
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        futures = {
+            executor.submit(retrieve_contexts, queries[index], client, error_log, kb_id): (index, kb_id)
+            for index, kb_id in pending
+        }
+        # Checkpoint rows as they complete; the final frame is assembled by row key.
+        for completed, future in enumerate(as_completed(futures), start=1):
+            index, kb_id = futures[future]
+            result = future.result()
+            if result is None:
+                failed += 1
+                continue
+            contexts, retrieved_files = result
+            record = {"retrieved_contexts": contexts, "retrieved_file": retrieved_files}
+            task_key = f"{row_keys[index]}|{kb_id}"
+            checkpoint.append(task_key, record)
+            done[task_key] = record
+            print(f"[{completed}/{len(pending)}] Retrieved ({kb_id}): {str(queries[index])[:30]}...")
+    except KeyboardInterrupt:
+        interrupted = True
+        print("Interrupted. Finished rows are checkpointed; rerun to resume.")
+    finally:
+        executor.shutdown(wait=not interrupted, cancel_futures=True)
+        checkpoint.close()
+    if interrupted:
+        return
+
+    for variant, kb_id in kb_ids.items():
+        records = [done.get(f"{row_key}|{kb_id}", {}) for row_key in row_keys]
+        for column in ("retrieved_contexts", "retrieved_file"):
+            df[variant_column(column, variant if namespaced else None)] = [
+                record.get(column, []) for record in records
+            ]
+
+    atomic_write_csv(df, config.PIPELINE_CSV)
+    if failed:
+        print(
+            f"Retrieval finished with {failed} failed retrievals (left empty). "
+            f"Rerun to retry them. Updated {config.PIPELINE_CSV}"
+        )
+    else:
+        checkpoint.discard()
+        print(f"Retrieval complete. Updated {config.PIPELINE_CSV}")
+
+    metrics_path = os.path.join(
+        os.path.dirname(config.PIPELINE_CSV),
+        "retrieval_metrics.json"
+    )
+    run_metrics.print_summary(run_metrics.write(metrics_path))
+
+    cache_stats = cache.stats() if cache else None
+    if cache_stats:
+        print(f"Retrieval cache: {cache_stats['hits']} hits | {cache_stats['misses']} misses")
+
+    if error_log or cache_stats:
         summary_path = os.path.join(
             os.path.dirname(config.PIPELINE_CSV),
             "retriever_run_summary.json"
@@ -128,7 +204,10 @@ def main():
         ensure_parent_dir(summary_path)
         with open(summary_path, "w", encoding="utf-8") as summary_file:
             json.dump({
-                "retrieved": len(df),
+                "retrieved": len(df) * len(kb_ids) - failed,
+                "kb_ids": kb_ids,
+                "failed": failed,
+                "retrieval_cache": cache_stats,
                 "errors": error_log,
             }, summary_file, ensure_ascii=False, indent=2)
 
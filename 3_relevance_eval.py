@@ -1,11 +1,24 @@
 import ast
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
 import pandas as pd
 import config
+from kb_variants import detect_variants, variant_column
+from onnx_reranker import load_onnx_reranker, variant_name
+from score_cache import get_score_cache
 
 MODEL_NAME = "BAAI/bge-reranker-v2-m3"
-REQUIRED_COLUMNS = ["user_input", "retrieved_contexts"]
-SCORE_BATCH_SIZE = 64
+# Upper bound on pairs per forward pass; the padded-token budget usually binds first.
+SCORE_BATCH_SIZE = 128
 TARGET_PROGRESS_UPDATES = 20
+# Sharded scoring splits the pairs into this many shards per worker process,
+# so a crashed worker only loses a small slice of the run.
+SHARDS_PER_WORKER = 4
 
 
 def progress_iter(iterable, total, desc, unit):
@@ -18,6 +31,37 @@ def progress_iter(iterable, total, desc, unit):
         return iterable
 
 
+class PrintProgress:
+    """Fallback for progress_bar without tqdm: prints about TARGET_PROGRESS_UPDATES lines."""
+
+    def __init__(self, total, desc, unit):
+        self.total = total
+        self.desc = desc
+        self.unit = unit
+        self.done = 0
+        self.step = max(1, total // TARGET_PROGRESS_UPDATES)
+        self.next_report = self.step
+
+    def update(self, amount):
+        self.done += amount
+        if self.done >= self.next_report or self.done == self.total:
+            print(f"{self.desc}: {self.done}/{self.total} {self.unit}s")
+            self.next_report = (self.done // self.step + 1) * self.step
+
+    def close(self):
+        pass
+
+
+def progress_bar(total, desc, unit):
+    """Progress counted in units of work (e.g. pairs), independent of how the work is batched."""
+    try:
+        from tqdm import tqdm
+
+        return tqdm(total=total, desc=desc, unit=unit)
+    except Exception:
+        return PrintProgress(total, desc, unit)
+
+
 def parse_list_cell(value):
     if isinstance(value, list):
         return value
@@ -45,7 +89,23 @@ def clamp_score(score):
     return numeric
 
 
-def get_reranker():
+def scorer_model_key():
+    """Model name in the score cache; ONNX scores are kept apart from FlagEmbedding's."""
+    if config.RERANKER_BACKEND == "onnx":
+        return f"{MODEL_NAME}@{variant_name(config.RERANKER_ONNX_QUANTIZE)}"
+    return MODEL_NAME
+
+
+def get_reranker(threads=0):
+    if config.RERANKER_BACKEND == "onnx":
+        return load_onnx_reranker(
+            MODEL_NAME,
+            config.RERANKER_ONNX_DIR,
+            quantized=config.RERANKER_ONNX_QUANTIZE,
+            threads=threads,
+            max_length=config.RERANKER_MAX_LENGTH,
+        )
+
     try:
         import torch 
         use_fp16 = torch.cuda.is_available()
@@ -73,9 +133,213 @@ def get_reranker():
     return FlagReranker(MODEL_NAME, use_fp16=use_fp16)
 
 
-def compute_relevance_scores(df, reranker):
+def estimate_pair_tokens(query, passage, max_length):
+    # ~4 chars per token plus special tokens, with FlagReranker's 3/4 query cap.
+    # Only used to plan batches; compute_score tokenizes each pair once itself.
+    query_tokens = min(len(query) // 4, max_length * 3 // 4)
+    return min(max_length, query_tokens + len(passage) // 4 + 4)
+
+
+def plan_batches(lengths, max_tokens, max_pairs):
+    """
+    Pair positions grouped into batches, longest pairs first. A batch is
+    closed once adding a pair would take its padded size (pairs x longest
+    pair) over max_tokens or its pair count over max_pairs.
+    """
+    order = sorted(range(len(lengths)), key=lambda position: -lengths[position])
+    batches = []
+    current = []
+    longest = 0
+    for position in order:
+        longest = max(longest, lengths[position])
+        if current and ((len(current) + 1) * longest > max_tokens or len(current) >= max_pairs):
+            batches.append(current)
+            current = []
+            longest = lengths[position]
+        current.append(position)
+    if current:
+        batches.append(current)
+    return batches
+
+
+def score_batch(reranker, pairs, encoded, batch, max_length):
+    if encoded is not None:
+        batch_scores = reranker.score_encoded([encoded[position] for position in batch])
+    else:
+        # FlagReranker goes through its public compute_score; the batch is
+        # already length-bucketed, so it runs as a single forward pass.
+        batch_scores = reranker.compute_score(
+            [pairs[position] for position in batch],
+            normalize=True,
+            max_length=max_length,
+            batch_size=len(batch),
+        )
+    if isinstance(batch_scores, (float, int)):
+        batch_scores = [batch_scores]
+    return [clamp_score(score) for score in batch_scores]
+
+
+def score_pairs(reranker, pairs, verbose=True):
+    """
+    Scores pairs in length-bucketed batches packed to RERANKER_BATCH_TOKENS
+    padded tokens. Yields (positions in pairs, clamped scores) per batch;
+    batches come longest first, so callers map scores back by position.
+    """
+    max_length = config.RERANKER_MAX_LENGTH
+    encoded = None
+    if hasattr(reranker, "encode_pairs"):
+        # Native backends (onnx_reranker.OnnxReranker) encode their own pairs.
+        encoded = reranker.encode_pairs(pairs, max_length)
+    if encoded is not None:
+        lengths = [len(item["input_ids"]) for item in encoded]
+    else:
+        lengths = [estimate_pair_tokens(query, passage, max_length) for query, passage in pairs]
+
+    batches = plan_batches(lengths, config.RERANKER_BATCH_TOKENS, SCORE_BATCH_SIZE)
+    if not verbose:
+        for batch in batches:
+            yield batch, score_batch(reranker, pairs, encoded, batch, max_length)
+        return
+
+    padded_tokens = sum(len(batch) * lengths[batch[0]] for batch in batches)
+    print(
+        f"Scoring {len(pairs)} query-context pairs in {len(batches)} length-bucketed batches "
+        f"(<= {config.RERANKER_BATCH_TOKENS} padded tokens each, "
+        f"{sum(lengths) / max(1, padded_tokens):.0%} of padded tokens are real"
+        f"{'' if encoded is not None else ', by a ~4 chars/token estimate'})..."
+    )
+    print("Note: the first batch may be slower due to model warm-up.")
+
+    progress = progress_bar(total=len(pairs), desc="Scoring pairs", unit="pair")
+    try:
+        for batch in batches:
+            batch_scores = score_batch(reranker, pairs, encoded, batch, max_length)
+            progress.update(len(batch))
+            yield batch, batch_scores
+    finally:
+        progress.close()
+
+
+_worker_reranker = None
+_worker_load_error = None
+
+
+def init_shard_worker(threads):
+    """Pool initializer: pins the thread count before torch loads, then loads the model once."""
+    global _worker_reranker, _worker_load_error
+    for name in ("OMP_NUM_THREADS", "MKL_NUM_THREADS"):
+        os.environ[name] = str(threads)
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    try:
+        import torch
+
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+    try:
+        _worker_reranker = get_reranker(threads)
+    except Exception as exc:
+        # Raising in the initializer breaks the pool like a crash would; score_shard reports it instead.
+        _worker_load_error = exc
+
+
+def score_shard(shard_index, pairs):
+    if _worker_reranker is None:
+        detail = f": {type(_worker_load_error).__name__}: {_worker_load_error}" if _worker_load_error else ""
+        raise RuntimeError(f"The reranker could not be loaded in a scoring worker{detail}")
+    scores = [None] * len(pairs)
+    for positions, batch_scores in score_pairs(_worker_reranker, pairs, verbose=False):
+        for position, score in zip(positions, batch_scores):
+            scores[position] = score
+    return shard_index, scores
+
+
+def plan_shards(pairs, shard_count):
+    """Round-robin over pairs sorted by length, so every shard gets a similar mix of long and short pairs."""
+    order = sorted(range(len(pairs)), key=lambda position: -(len(pairs[position][0]) + len(pairs[position][1])))
+    return [order[start::shard_count] for start in range(min(shard_count, len(order)))]
+
+
+def score_pairs_sharded(pairs, workers):
+    """
+    score_pairs spread over worker processes. Yields (positions in pairs,
+    scores) per finished shard, in completion order; scores are placed by
+    position, so the merged result does not depend on that order. When a
+    worker dies the pool is restarted and every shard without a result is
+    queued again, up to RERANKER_SHARD_RETRIES times. A shard that raises
+    (model load or scoring error) is not retried: the other shards are
+    still collected, then RuntimeError is raised.
+    """
+    threads = config.RERANKER_THREADS_PER_WORKER or max(1, (os.cpu_count() or 1) // workers)
+    shards = plan_shards(pairs, workers * SHARDS_PER_WORKER)
+    print(
+        f"Scoring {len(pairs)} query-context pairs in {len(shards)} shards "
+        f"on {workers} worker processes ({threads} threads each)..."
+    )
+    print("Note: each worker loads the model once before its first shard.")
+
+    remaining = set(range(len(shards)))
+    restarts = 0
+    context = multiprocessing.get_context("spawn")
+    progress = progress_bar(total=len(pairs), desc="Scoring pairs", unit="pair")
+    try:
+        while remaining:
+            with ProcessPoolExecutor(
+                max_workers=min(workers, len(remaining)),
+                mp_context=context,
+                initializer=init_shard_worker,
+                initargs=(threads,),
+            ) as executor:
+                futures = {
+                    executor.submit(score_shard, index, [pairs[position] for position in shards[index]]): index
+                    for index in sorted(remaining)
+                }
+                failed = None
+                for future in as_completed(futures):
+                    try:
+                        shard_index, scores = future.result()
+                    except BrokenProcessPool:
+                        continue
+                    except Exception as exc:
+                        # The worker survived its own error: keep collecting the other
+                        # shards, so every finished one still reaches the caller.
+                        failed = failed or (futures[future], exc)
+                        continue
+                    remaining.discard(shard_index)
+                    progress.update(len(scores))
+                    yield shards[shard_index], scores
+            if failed:
+                shard_index, exc = failed
+                raise RuntimeError(
+                    f"Scoring shard {shard_index} failed in a worker process ({type(exc).__name__}: {exc}); "
+                    f"{len(remaining)} of {len(shards)} shards left unscored."
+                ) from exc
+            if remaining:
+                restarts += 1
+                if restarts > config.RERANKER_SHARD_RETRIES:
+                    raise RuntimeError(
+                        f"Scoring workers kept crashing; {len(remaining)} shards left unscored "
+                        f"after {config.RERANKER_SHARD_RETRIES} restarts."
+                    )
+                print(
+                    f"A scoring worker crashed; re-queuing {len(remaining)} unfinished shards "
+                    f"(restart {restarts}/{config.RERANKER_SHARD_RETRIES})."
+                )
+    finally:
+        progress.close()
+
+
+def compute_relevance_scores(df, reranker, contexts_columns=("retrieved_contexts",), cache=None, stats=None, workers=1):
+    """
+    Scores every (query, chunk) pair of the given contexts columns in one
+    batched pass. Returns {contexts_column: per-row score lists}. Duplicate
+    pairs are scored once; with a ScoreCache, cached pairs are reused and
+    only missing ones are scored. Pair and cache counts go into stats.
+    With workers > 1 the pairs are scored by worker processes instead of
+    reranker (which may then be None).
+    """
     all_pairs = []
-    row_chunk_counts = []
+    row_chunk_counts = {column: [] for column in contexts_columns}
 
     row_iter = progress_iter(
         df.iterrows(),
@@ -85,47 +349,71 @@ def compute_relevance_scores(df, reranker):
     )
     for _, row in row_iter:
         query = "" if is_empty_text(row["user_input"]) else str(row["user_input"])
-        chunks = [str(chunk) for chunk in parse_list_cell(row["retrieved_contexts"])]
-        row_chunk_counts.append(len(chunks))
+        for column in contexts_columns:
+            chunks = [str(chunk) for chunk in parse_list_cell(row[column])]
+            row_chunk_counts[column].append(len(chunks))
 
-        for chunk in chunks:
-            all_pairs.append([query, chunk])
+            for chunk in chunks:
+                all_pairs.append([query, chunk])
 
     if not all_pairs:
-        return [[] for _ in range(len(df))]
-
-    dynamic_batch_size = min(
-        SCORE_BATCH_SIZE,
-        max(1, len(all_pairs) // TARGET_PROGRESS_UPDATES),
-    )
-    total_batches = (len(all_pairs) + dynamic_batch_size - 1) // dynamic_batch_size
-    print(
-        f"Scoring {len(all_pairs)} query-context pairs in {total_batches} batches "
-        f"(batch_size={dynamic_batch_size})..."
-    )
-    print("Note: the first batch may be slower due to model warm-up.")
+        return {column: [[] for _ in range(len(df))] for column in contexts_columns}
+
+    # Identical (query, chunk) pairs recur across styles, reruns and shared chunks:
+    # score each unique pair once and fan the scores back out through pair_index.
+    unique_positions = {}
+    pair_index = []
+    for query, chunk in all_pairs:
+        pair_index.append(unique_positions.setdefault((query, chunk), len(unique_positions)))
+    unique_pairs = [list(pair) for pair in unique_positions]
+    dedup_ratio = 1.0 - len(unique_pairs) / len(all_pairs)
+    print(f"Deduplicated {len(all_pairs)} pairs to {len(unique_pairs)} unique ({dedup_ratio:.1%} removed).")
+    if stats is not None:
+        stats["pairs"] = {"total": len(all_pairs), "unique": len(unique_pairs), "dedup_ratio": dedup_ratio}
+
+    unique_scores = [None] * len(unique_pairs)
+    if cache is not None:
+        unique_scores = cache.get_many(scorer_model_key(), config.RERANKER_MAX_LENGTH, unique_pairs)
+    missing = [index for index, score in enumerate(unique_scores) if score is None]
+    hits = len(unique_pairs) - len(missing)
+    if cache is not None:
+        print(
+            f"Score cache: {hits}/{len(unique_pairs)} unique pairs cached "
+            f"({hits / len(unique_pairs):.1%} hit rate), {len(missing)} to score."
+        )
 
-    all_scores = []
-    batch_iter = progress_iter(
-        range(0, len(all_pairs), dynamic_batch_size),
-        total=total_batches,
-        desc="Scoring pairs",
-        unit="batch",
-    )
-    for start in batch_iter:
-        end = start + dynamic_batch_size
-        batch_pairs = all_pairs[start:end]
-        batch_scores = reranker.compute_score(batch_pairs, normalize=True)
-        if isinstance(batch_scores, (float, int)):
-            batch_scores = [batch_scores]
-        all_scores.extend(clamp_score(score) for score in batch_scores)
-
-    row_scores = []
+    started = time.monotonic()
+    if missing:
+        missing_pairs = [unique_pairs[index] for index in missing]
+        if workers > 1:
+            scored_batches = score_pairs_sharded(missing_pairs, workers)
+        else:
+            scored_batches = score_pairs(reranker, missing_pairs)
+        for positions, batch_scores in scored_batches:
+            for position, score in zip(positions, batch_scores):
+                unique_scores[missing[position]] = score
+            if cache is not None:
+                cache.put_many(
+                    scorer_model_key(),
+                    config.RERANKER_MAX_LENGTH,
+                    [missing_pairs[position] for position in positions],
+                    batch_scores,
+                )
+    if cache is not None:
+        cache.record_timing(scorer_model_key(), config.RERANKER_MAX_LENGTH, len(missing), time.monotonic() - started, hits)
+        print(f"Score cache saved an estimated {cache.stats()['time_saved_seconds']:.1f}s of scoring.")
+        if stats is not None:
+            stats["score_cache"] = cache.stats()
+    all_scores = [unique_scores[index] for index in pair_index]
+
+    # Pairs were appended row by row, column by column; walk them back in that order.
+    row_scores = {column: [] for column in contexts_columns}
     cursor = 0
-    for chunk_count in row_chunk_counts:
-        row_values = all_scores[cursor:cursor + chunk_count]
-        row_scores.append(row_values)
-        cursor += chunk_count
+    for row_index in range(len(df)):
+        for column in contexts_columns:
+            chunk_count = row_chunk_counts[column][row_index]
+            row_scores[column].append(all_scores[cursor:cursor + chunk_count])
+            cursor += chunk_count
 
     return row_scores
 
@@ -138,27 +426,54 @@ def main():
         print("Input file not found. Run File 2 first.")
         return
 
-    missing_cols = [column for column in REQUIRED_COLUMNS if column not in df.columns]
+    # Multi-KB runs store one namespaced contexts column per KB variant.
+    variants = detect_variants(df.columns) or [None]
+    required = ["user_input"] + [variant_column("retrieved_contexts", variant) for variant in variants]
+    missing_cols = [column for column in required if column not in df.columns]
     if missing_cols:
         print(f"Missing required columns: {missing_cols}. Run File 2 first.")
         return
 
+    # Loaded here first even for sharded runs, so a missing dependency or export
+    # is reported once instead of from every worker process.
+    workers = max(1, config.RERANKER_WORKERS)
     reranker = get_reranker()
     if reranker is None:
         return
+    if workers > 1:
+        # Each worker loads its own copy; the parent's would sit idle.
+        reranker = None
 
     print("Computing normalized relevance scores...")
-    relevance_scores = compute_relevance_scores(df, reranker)
+    contexts_columns = [variant_column("retrieved_contexts", variant) for variant in variants]
+    cache = get_score_cache()
+    run_stats = {}
+    try:
+        relevance_scores = compute_relevance_scores(
+            df, reranker, contexts_columns, cache=cache, stats=run_stats, workers=workers
+        )
+    except RuntimeError as exc:
+        print(f"Relevance scoring stopped: {exc}")
+        if cache is not None:
+            print("Scores finished before the error are saved in the score cache; rerun to score the rest.")
+        print(f"{config.PIPELINE_CSV} was not updated.")
+        raise SystemExit(1) from exc
 
-    if "relevance_scores" in df.columns:
-        df = df.drop(columns=["relevance_scores"])
+    for variant, contexts_column in zip(variants, contexts_columns):
+        scores_column = variant_column("relevance_scores", variant)
+        if scores_column in df.columns:
+            df = df.drop(columns=[scores_column])
 
-    insert_at = df.columns.get_loc("retrieved_contexts") + 1
-    df.insert(insert_at, "relevance_scores", relevance_scores)
+        insert_at = df.columns.get_loc(contexts_column) + 1
+        df.insert(insert_at, scores_column, relevance_scores[contexts_column])
 
     df.to_csv(config.PIPELINE_CSV, index=False)
     print(f"Relevance scoring complete. Updated {config.PIPELINE_CSV}")
 
+    summary_path = os.path.join(os.path.dirname(config.PIPELINE_CSV), "relevance_run_summary.json")
+    with open(summary_path, "w", encoding="utf-8") as summary_file:
+        json.dump(run_stats, summary_file, ensure_ascii=False, indent=2)
+
 
 if __name__ == "__main__":
     main()
@@ -2,17 +2,22 @@
 import pandas as pd
 import ast
 import json
-import random
 import re
-import time
-import boto3
-from botocore.exceptions import ClientError
+import numpy as np
 
 import config
+from bedrock_utils import call_with_retry, create_client, estimate_tokens, get_model_limiter
+from kb_variants import VARIANT_SEPARATOR, detect_variants, select_variant
+from llm_cache import cached_invoke, get_llm_cache
+from run_metrics import RunMetrics, record_response_usage
 
 
 output_file = "full_run_200"
 
+run_metrics = RunMetrics("evaluation_summary")
+
+RELEVANCE_THRESHOLD = 0.4
+
 REQUIRED_COLUMNS = [
     "reference_contexts",
     "retrieved_contexts",
@@ -27,6 +32,19 @@ def ensure_parent_dir(path):
         os.makedirs(parent, exist_ok=True)
 
 
+def build_sweep_paths(output_dir: str, output_name: str = "") -> tuple[str, str]:
+    folder_name = os.path.basename(os.path.normpath(output_dir))
+    base_name = output_name.strip() if isinstance(output_name, str) else ""
+    if not base_name:
+        base_name = folder_name
+
+    csv_path = os.path.join(output_dir, f"{base_name}_k_sweep.csv")
+    streamlit_parquet_path = os.path.join(
+        "streamlit", "complete_datasets", base_name, f"{base_name}_k_sweep.parquet"
+    )
+    return csv_path, streamlit_parquet_path
+
+
 def build_results_paths(output_dir: str, output_name: str = "") -> tuple[str, str, str, str]:
     folder_name = os.path.basename(os.path.normpath(output_dir))
     base_name = output_name.strip() if isinstance(output_name, str) else ""
@@ -48,37 +66,7 @@ def build_results_paths(output_dir: str, output_name: str = "") -> tuple[str, st
 
 
 def get_bedrock_client():
-    session = boto3.Session(profile_name=config.AWS_PROFILE_LLM)
-    return session.client(service_name="bedrock-runtime", region_name=config.AWS_REGION)
-
-
-def backoff_sleep(attempt):
-    base = config.BACKOFF_BASE_SECONDS * (2 ** attempt)
-    sleep_for = min(base, config.BACKOFF_MAX_SECONDS)
-    sleep_for += random.uniform(0, config.BACKOFF_JITTER_SECONDS)
-    time.sleep(sleep_for)
-
-
-def call_with_retry(fn, operation_name, error_log, max_retries=None):
-    retries = config.MAX_RETRIES if max_retries is None else max_retries
-    last_error = None
-    for attempt in range(retries + 1):
-        try:
-            return fn()
-        except ClientError as e:
-            last_error = e
-        except Exception as e:
-            last_error = e
-
-        if attempt < retries:
-            backoff_sleep(attempt)
-        else:
-            if last_error is not None:
-                error_log.append({
-                    "operation": operation_name,
-                    "error": str(last_error),
-                })
-            return None
+    return create_client("bedrock-runtime", config.AWS_PROFILE_LLM)
 
 
 def clean_reasoning(text: str) -> str:
@@ -139,7 +127,20 @@ Usa un tono profesional y breve.
             body=body
         )
 
-    response = call_with_retry(_call, "invoke_model_run_summary", error_log)
+    response = cached_invoke(
+        get_llm_cache(),
+        config.MODEL_ID,
+        body,
+        0.2,
+        lambda: call_with_retry(
+            _call,
+            "invoke_model_run_summary",
+            error_log,
+            limiter=get_model_limiter(config.MODEL_ID),
+            tokens=estimate_tokens(system_prompt + user_prompt) + 1200,
+            metrics=run_metrics,
+        ),
+    )
     if response is None:
         return (
             "## Interpretación de los resultados\n"
@@ -152,6 +153,7 @@ Usa un tono profesional y breve.
         )
 
     response_body = json.loads(response.get("body").read().decode("utf-8"))
+    record_response_usage(run_metrics, "invoke_model_run_summary", response, response_body)
     if "choices" in response_body:
         return clean_reasoning(response_body["choices"][0]["message"]["content"])
     if "output" in response_body:
@@ -226,7 +228,7 @@ def calculate_metrics(row):
         k = len(relevance_scores)
         if k > 0 and k == len(retrieved_list):
             try:
-                hits = sum(1 for score in relevance_scores if float(score) >= 0.4)
+                hits = sum(1 for score in relevance_scores if float(score) >= RELEVANCE_THRESHOLD)
                 precision_at_k_relevance = hits / k
             except (TypeError, ValueError):
                 precision_at_k_relevance = float('nan')
@@ -237,29 +239,122 @@ def calculate_metrics(row):
     return pd.Series([hit_rate, mrr, precision, recall, precision_at_k_relevance])
 
 
-def main():
-    error_log = []
-    print(f"Loading {config.PIPELINE_CSV}...")
-    try:
-        df = pd.read_csv(config.PIPELINE_CSV)
-    except FileNotFoundError:
-        print("Input file not found. Run File 2 first.")
-        return
+def truncate_to_k(df, k):
+    """Copy of df with the per-context list columns cut to their top k entries."""
+    truncated = df.copy()
+    for column in ('retrieved_contexts', 'retrieved_file', 'relevance_scores'):
+        if column in truncated.columns:
+            truncated[column] = truncated[column].apply(
+                lambda values: values[:k] if isinstance(values, list) else values
+            )
+    return truncated
+
+
+def first_match_ranks(df, k_max):
+    """
+    1-based rank of the first source_file match and of the first text match
+    within the top k_max contexts of each row, 0 when there is none.
+    """
+    source_ranks = np.zeros(len(df), dtype=np.int64)
+    text_ranks = np.zeros(len(df), dtype=np.int64)
+    rows = zip(df['reference_contexts'], df['retrieved_contexts'], df['retrieved_file'], df['source_file'])
+    for i, (gt_list, retrieved_list, retrieved_files, source_file) in enumerate(rows):
+        if source_file and retrieved_files:
+            _, source_ranks[i] = contains_source_file(source_file, retrieved_files[:k_max])
+
+        clean_gt = " ".join((gt_list[0] if gt_list else "").lower().split())
+        for rank, ret_text in enumerate(retrieved_list[:k_max], start=1):
+            clean_ret = " ".join(ret_text.lower().split())
+            if clean_gt in clean_ret or clean_ret in clean_gt:
+                text_ranks[i] = rank
+                break
+    return source_ranks, text_ranks
+
+
+def relevance_matrix(df, k_max):
+    """(rows, k_max) float array of relevance scores, NaN where a row has no usable score."""
+    scores = np.full((len(df), k_max), np.nan)
+    if 'relevance_scores' not in df.columns:
+        return scores
+    for i, (row_scores, retrieved_list) in enumerate(zip(df['relevance_scores'], df['retrieved_contexts'])):
+        if not isinstance(row_scores, list) or not row_scores or len(row_scores) != len(retrieved_list):
+            continue
+        try:
+            values = [float(score) for score in row_scores[:k_max]]
+        except (TypeError, ValueError):
+            continue
+        scores[i, :len(values)] = values
+    return scores
+
+
+def compute_k_sweep(df, k_max):
+    """
+    Hit rate, MRR and relevance precision@k for every k in 1..k_max from a
+    single set of top-k_max contexts, as a long table (k, metric, value).
+    Per row and k this matches calculate_metrics on the top-k contexts.
+    """
+    ks = np.arange(1, k_max + 1)
+    source_ranks, text_ranks = first_match_ranks(df, k_max)
+    source_ranks = source_ranks[:, None]
+    text_ranks = text_ranks[:, None]
+
+    # Source-file matches win over text matches, as in calculate_metrics.
+    source_hit = (source_ranks > 0) & (source_ranks <= ks)
+    text_hit = (text_ranks > 0) & (text_ranks <= ks)
+    ranks = np.where(source_hit, source_ranks, np.where(text_hit, text_ranks, 0))
+    hits = ranks > 0
+    mrr = np.where(hits, 1.0 / np.maximum(ranks, 1), 0.0)
+
+    scores = relevance_matrix(df, k_max)
+    scored = np.cumsum(~np.isnan(scores), axis=1)
+    relevant = np.cumsum(scores >= RELEVANCE_THRESHOLD, axis=1)
+    precision = np.where(scored > 0, relevant / np.maximum(scored, 1), np.nan)
+    precision = np.where(hits & (precision == 0), 1 / 3, precision)
+
+    wide = pd.DataFrame({
+        "k": ks,
+        "hit_rate": hits.mean(axis=0),
+        "mrr": mrr.mean(axis=0),
+        "precision_at_k": pd.DataFrame(precision).mean(axis=0).to_numpy(),
+    })
+    return wide.melt(id_vars="k", var_name="metric", value_name="value")
+
+
+def evaluate_variant(df, variant, output_name, client, error_log):
+    """
+    Computes metrics, the LLM run summary and (in sweep mode) the K-sweep for
+    one KB variant of the pipeline CSV, and writes its result files. variant
+    is None for single-KB runs, whose columns are not namespaced.
+    """
+    df = select_variant(df, variant)
+    label = f" for KB variant {variant}" if variant else ""
+    if "stale" in df.columns:
+        # File 1 flags rows whose source document has since changed or been deleted.
+        stale = df["stale"].astype(str).str.lower().eq("true")
+        if stale.any():
+            print(f"Skipping {int(stale.sum())} stale rows{label} (source document changed or deleted).")
+            df = df[~stale].reset_index(drop=True)
 
     missing_cols = [col for col in REQUIRED_COLUMNS if col not in df.columns]
     if missing_cols:
-        print(f"Missing required columns: {missing_cols}. Run Files 1 and 2 first.")
-        return
+        print(f"Missing required columns{label}: {missing_cols}. Run Files 1 and 2 first.")
+        return None
 
     df['reference_contexts'] = df['reference_contexts'].apply(parse_list_cell)
     df['retrieved_contexts'] = df['retrieved_contexts'].apply(parse_list_cell)
     df['retrieved_file'] = df['retrieved_file'].apply(parse_list_cell)
     if 'relevance_scores' in df.columns:
         df['relevance_scores'] = df['relevance_scores'].apply(parse_list_cell)
+    if variant:
+        df['kb_variant'] = variant
 
-    print("Calculating metrics...")
+    print(f"Calculating metrics{label}...")
 
-    metrics_df = df.apply(calculate_metrics, axis=1)
+    sweep_mode = config.SWEEP_K_MAX > config.TOP_K
+    # In sweep mode the lists hold SWEEP_K_MAX contexts; headline metrics and the
+    # results files stay at TOP_K, and only the K-sweep reads the full lists.
+    metrics_source = truncate_to_k(df, config.TOP_K) if sweep_mode else df
+    metrics_df = metrics_source.apply(calculate_metrics, axis=1)
     metrics_df.columns = [
         'custom_hit_rate',
         'custom_mrr',
@@ -268,7 +363,7 @@ def main():
         'precision_at_k_relevance',
     ]
 
-    final_df = pd.concat([df, metrics_df], axis=1)
+    final_df = pd.concat([metrics_source, metrics_df], axis=1)
 
     avg_hit_rate = float(final_df['custom_hit_rate'].mean())
     avg_mrr = float(final_df['custom_mrr'].mean())
@@ -283,12 +378,11 @@ def main():
         "avg_recall_at_k": avg_recall_at_k,
     }
 
-    client = get_bedrock_client()
-    summary_md = extract_run_summary(client, summary_metrics, output_file, error_log)
+    summary_md = extract_run_summary(client, summary_metrics, output_name, error_log)
 
     results_csv, results_parquet, streamlit_parquet, streamlit_summary = build_results_paths(
         config.PIPELINE_OUTPUT_DIR,
-        output_file,
+        output_name,
     )
 
     ensure_parent_dir(results_csv)
@@ -302,10 +396,76 @@ def main():
 
     save_markdown_summary(streamlit_summary, summary_md)
 
+    if sweep_mode:
+        k_max = min(config.SWEEP_K_MAX, int(df['retrieved_contexts'].map(len).max() or 0))
+        if k_max < config.SWEEP_K_MAX:
+            print(
+                f"Retrieved lists hold at most {k_max} contexts; run File 2 with "
+                f"SWEEP_K_MAX={config.SWEEP_K_MAX} to sweep the full range."
+            )
+        if k_max > 0:
+            sweep_df = compute_k_sweep(df, k_max)
+            if variant:
+                sweep_df.insert(0, "kb_variant", variant)
+            sweep_csv, sweep_parquet = build_sweep_paths(config.PIPELINE_OUTPUT_DIR, output_name)
+            ensure_parent_dir(sweep_csv)
+            sweep_df.to_csv(sweep_csv, index=False)
+            ensure_parent_dir(sweep_parquet)
+            sweep_df.to_parquet(sweep_parquet, index=False)
+            print(sweep_df.pivot(index="k", columns="metric", values="value").round(4).to_string())
+            print(f"K-sweep (k=1..{k_max}) saved to {sweep_csv} and {sweep_parquet}")
+
     print(
-        "Evaluation complete. Results saved to "
+        f"Results{label} saved to "
         f"{results_csv}, {results_parquet}, {streamlit_parquet}, and {streamlit_summary}"
     )
+    return summary_metrics
+
+
+def main():
+    error_log = []
+    print(f"Loading {config.PIPELINE_CSV}...")
+    try:
+        df = pd.read_csv(config.PIPELINE_CSV)
+    except FileNotFoundError:
+        print("Input file not found. Run File 2 first.")
+        return
+
+    # Multi-KB runs are evaluated once per KB, each as its own dataset ("<output>__<variant>").
+    variants = detect_variants(df.columns) or [None]
+    client = get_bedrock_client()
+    skipped = []
+    for variant in variants:
+        output_name = f"{output_file}{VARIANT_SEPARATOR}{variant}" if variant else output_file
+        summary_metrics = evaluate_variant(df, variant, output_name, client, error_log)
+        if summary_metrics is None:
+            skipped.append(variant)
+            continue
+        if variant:
+            print(
+                f"[{variant}] hit rate {summary_metrics['avg_hit_rate']:.4f} | "
+                f"mrr {summary_metrics['avg_mrr']:.4f} | "
+                f"precision@k {summary_metrics['avg_precision_at_k']:.4f}"
+            )
+
+    if len(skipped) == len(variants):
+        return
+
+    llm_cache = get_llm_cache()
+    if llm_cache is not None:
+        cache_stats = llm_cache.stats()
+        print(f"LLM cache: {cache_stats['hits']} hits | {cache_stats['misses']} misses")
+
+    metrics_path = os.path.join(config.PIPELINE_OUTPUT_DIR, "evaluation_metrics.json")
+    run_metrics.print_summary(run_metrics.write(metrics_path))
+
+    if skipped:
+        print(
+            f"Evaluation incomplete: skipped {len(skipped)} of {len(variants)} KB variants "
+            f"({', '.join(skipped)}); see the messages above."
+        )
+    else:
+        print("Evaluation complete.")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,193 @@
+import json
+from datetime import datetime
+
+import pandas as pd
+
+# Timing keys that mark a trace "metadata" block (reference metadata has none of them).
+TRACE_TIMING_KEYS = {"startTime", "endTime", "totalTimeMs", "operationTotalTimeMs", "usage"}
+
+# modelInvocationInput types that plan or route rather than write the answer.
+REASONING_MODEL_TYPES = {"ORCHESTRATION", "PRE_PROCESSING", "ROUTING_CLASSIFIER"}
+GENERATION_MODEL_TYPES = {"KNOWLEDGE_BASE_RESPONSE_GENERATION", "POST_PROCESSING"}
+
+CATEGORY_ORDER = ["guardrail", "retrieval", "action_group", "reasoning", "generation", "model", "other", "unattributed"]
+
+
+def to_epoch_seconds(value):
+    """Trace times arrive as datetimes from boto3, or as strings once saved to JSON."""
+    if isinstance(value, datetime):
+        return value.timestamp()
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value).timestamp()
+        except ValueError:
+            return None
+    return None
+
+
+def trace_steps(trace, path=""):
+    """
+    Timed steps of one trace event, e.g. orchestrationTrace.observation.
+    knowledgeBaseLookupOutput, as flat dicts with start/end epoch seconds,
+    duration and token usage. Retrieved references are not descended into.
+    """
+    for key, value in trace.items():
+        if not isinstance(value, dict) or key == "retrievedReferences":
+            continue
+        step_path = f"{path}.{key}" if path else key
+        metadata = value.get("metadata")
+        if isinstance(metadata, dict) and TRACE_TIMING_KEYS & set(metadata):
+            usage = metadata.get("usage") or {}
+            yield {
+                "step": step_path,
+                "trace_id": value.get("traceId") or trace.get("traceId"),
+                "start": to_epoch_seconds(metadata.get("startTime")),
+                "end": to_epoch_seconds(metadata.get("endTime")),
+                "total_ms": metadata.get("totalTimeMs", metadata.get("operationTotalTimeMs")),
+                "input_tokens": usage.get("inputTokens"),
+                "output_tokens": usage.get("outputTokens"),
+            }
+        yield from trace_steps(value, step_path)
+
+
+def step_category(step, model_type=None):
+    """retrieval / reasoning / generation / guardrail / ... for one step path."""
+    leaf = step.rsplit(".", 1)[-1]
+    if step.startswith("guardrailTrace"):
+        return "guardrail"
+    if leaf == "finalResponse":
+        return "total"
+    if leaf == "knowledgeBaseLookupOutput":
+        return "retrieval"
+    if leaf == "actionGroupInvocationOutput":
+        return "action_group"
+    if leaf == "modelInvocationOutput":
+        if model_type in GENERATION_MODEL_TYPES or step.startswith("postProcessingTrace"):
+            return "generation"
+        if model_type in REASONING_MODEL_TYPES or step.startswith("preProcessingTrace"):
+            return "reasoning"
+        return "model"
+    return "other"
+
+
+class TraceTimeline:
+    """
+    Folds trace events into categorized steps as they arrive. Model
+    invocation outputs carry no type of their own, so the type announced by
+    the matching modelInvocationInput (same traceId) is remembered to tell
+    reasoning calls from answer generation.
+    """
+
+    def __init__(self):
+        self.steps = []
+        self._model_types = {}
+
+    def add(self, trace):
+        for part in trace.values():
+            if not isinstance(part, dict):
+                continue
+            model_input = part.get("modelInvocationInput")
+            if isinstance(model_input, dict) and model_input.get("traceId"):
+                self._model_types[model_input["traceId"]] = model_input.get("type")
+        for step in trace_steps(trace):
+            step["category"] = step_category(step["step"], self._model_types.get(step["trace_id"]))
+            self.steps.append(step)
+
+
+def steps_from_completion(events):
+    """Categorized steps of an already materialized completion (e.g. a saved raw reply)."""
+    timeline = TraceTimeline()
+    for event in events:
+        if "trace" in event:
+            timeline.add(event["trace"].get("trace") or {})
+    return timeline.steps
+
+
+def load_batch_records(path):
+    """Successful lines of agent_batch_results.jsonl; a torn last line is skipped."""
+    records = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get("status") == "ok":
+                records.append(record)
+    return records
+
+
+def steps_frame(records):
+    """
+    One row per (query, category) with summed milliseconds and tokens. The
+    end-to-end time is the agent's finalResponse time, or the client-side
+    total when the trace has none; whatever the steps do not cover is
+    reported as "unattributed".
+    """
+    rows = []
+    for position, record in enumerate(records):
+        row_index = record.get("row_index", position)
+        per_category = {}
+        end_to_end = None
+        for step in record.get("steps", []):
+            category = step.get("category") or step_category(step.get("step", ""))
+            total_ms = step.get("total_ms")
+            if total_ms is None and step.get("start") is not None and step.get("end") is not None:
+                total_ms = (step["end"] - step["start"]) * 1000.0
+            if category == "total":
+                end_to_end = total_ms
+                continue
+            entry = per_category.setdefault(category, {"calls": 0, "ms": 0.0, "input_tokens": 0, "output_tokens": 0})
+            entry["calls"] += 1
+            entry["ms"] += float(total_ms or 0)
+            entry["input_tokens"] += int(step.get("input_tokens") or 0)
+            entry["output_tokens"] += int(step.get("output_tokens") or 0)
+        if end_to_end is None:
+            end_to_end = (record.get("client_ms") or {}).get("total")
+        if end_to_end is not None:
+            covered = sum(entry["ms"] for entry in per_category.values())
+            per_category["unattributed"] = {
+                "calls": 0,
+                "ms": max(0.0, float(end_to_end) - covered),
+                "input_tokens": 0,
+                "output_tokens": 0,
+            }
+        for category, entry in per_category.items():
+            rows.append({"row_index": row_index, "category": category, "end_to_end_ms": end_to_end, **entry})
+    return pd.DataFrame(rows, columns=[
+        "row_index", "category", "end_to_end_ms", "calls", "ms", "input_tokens", "output_tokens",
+    ])
+
+
+def latency_breakdown(steps_df):
+    """
+    Per-category table across a batch: queries touching the category, calls
+    per query, mean / p50 / p95 milliseconds per query, share of the summed
+    end-to-end time, and mean tokens per query.
+    """
+    columns = [
+        "category", "queries", "calls_per_query", "mean_ms", "p50_ms", "p95_ms",
+        "share_of_total", "mean_input_tokens", "mean_output_tokens",
+    ]
+    if steps_df.empty:
+        return pd.DataFrame(columns=columns)
+    end_to_end_total = steps_df.drop_duplicates("row_index")["end_to_end_ms"].fillna(0).sum()
+    rows = []
+    for category, group in steps_df.groupby("category", sort=False):
+        rows.append({
+            "category": category,
+            "queries": group["row_index"].nunique(),
+            "calls_per_query": group["calls"].mean(),
+            "mean_ms": group["ms"].mean(),
+            "p50_ms": group["ms"].quantile(0.5),
+            "p95_ms": group["ms"].quantile(0.95),
+            "share_of_total": group["ms"].sum() / end_to_end_total if end_to_end_total else float("nan"),
+            "mean_input_tokens": group["input_tokens"].mean(),
+            "mean_output_tokens": group["output_tokens"].mean(),
+        })
+    table = pd.DataFrame(rows, columns=columns)
+    order = {category: i for i, category in enumerate(CATEGORY_ORDER)}
+    table["_order"] = table["category"].map(lambda category: order.get(category, len(order)))
+    return table.sort_values("_order").drop(columns="_order").reset_index(drop=True)
@@ -1,11 +1,16 @@
 ﻿import argparse
 import csv
 import json
+import sys
+import time
 from pathlib import Path
 from typing import Tuple
 
 import boto3
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from run_metrics import RunMetrics, extract_usage  # noqa: E402
+
 
 def read_text(path: Path) -> Tuple[str, str]:
     """
@@ -42,6 +47,12 @@ def main() -> int:
         default="amazon.titan-embed-text-v2:0",
         help="Bedrock model ID",
     )
+    parser.add_argument(
+        "--price-per-1k",
+        type=float,
+        default=0.00002,
+        help="Input price per 1K tokens used for the projected cost",
+    )
     args = parser.parse_args()
 
     root = Path(args.root)
@@ -49,6 +60,7 @@ def main() -> int:
     out_path.parent.mkdir(parents=True, exist_ok=True)
 
     client = boto3.client("bedrock-runtime", region_name=args.region)
+    metrics = RunMetrics("token_count", input_price=args.price_per_1k, output_price=0.0)
 
     write_header = not out_path.exists()
     with out_path.open("a", newline="", encoding="utf-8") as f:
@@ -64,8 +76,11 @@ def main() -> int:
 
             native_request = {"inputText": text}
             request = json.dumps(native_request)
+            started = time.monotonic()
             response = client.invoke_model(modelId=args.model_id, body=request)
             model_response = json.loads(response["body"].read())
+            metrics.record_call("invoke_model_embedding", time.monotonic() - started)
+            metrics.record_usage("invoke_model_embedding", *extract_usage(model_response, response))
             input_token_count = model_response.get("inputTextTokenCount")
 
             if input_token_count is None:
@@ -76,6 +91,7 @@ def main() -> int:
             print(f"OK {md_path} -> {input_token_count} tokens ({encoding_used})")
 
     print(f"Done. Appended results to {out_path}")
+    metrics.print_summary(metrics.write(str(out_path.parent / "token_count_metrics.json")))
     return 0
 
 
@@ -0,0 +1,359 @@
+import io
+import json
+import random
+import threading
+import time
+from datetime import datetime
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+import config
+
+THROTTLING_ERROR_CODES = {
+    "ThrottlingException",
+    "TooManyRequestsException",
+    "Throttling",
+    # Raised mid-stream by invoke_agent event streams.
+    "throttlingException",
+}
+
+
+def create_client(service_name, profile_name, max_pool_connections=None):
+    """
+    boto3 client for a Bedrock service. With BEDROCK_ENDPOINT_URL set, the
+    client targets that endpoint with placeholder credentials, so the
+    pipeline runs against fake_bedrock/server.py without an AWS profile.
+    """
+    client_config = Config(max_pool_connections=max_pool_connections) if max_pool_connections else None
+    if config.BEDROCK_ENDPOINT_URL:
+        session = boto3.Session(aws_access_key_id="fake", aws_secret_access_key="fake")
+        return session.client(
+            service_name=service_name,
+            region_name=config.AWS_REGION,
+            endpoint_url=config.BEDROCK_ENDPOINT_URL,
+            config=client_config,
+        )
+    session = boto3.Session(profile_name=profile_name)
+    return session.client(service_name=service_name, region_name=config.AWS_REGION, config=client_config)
+
+
+def backoff_sleep(attempt):
+    base = config.BACKOFF_BASE_SECONDS * (2 ** attempt)
+    sleep_for = min(base, config.BACKOFF_MAX_SECONDS)
+    sleep_for += random.uniform(0, config.BACKOFF_JITTER_SECONDS)
+    time.sleep(sleep_for)
+
+
+def is_throttling_error(error):
+    if isinstance(error, ClientError):
+        code = error.response.get("Error", {}).get("Code", "")
+        return code in THROTTLING_ERROR_CODES
+    return False
+
+
+def estimate_tokens(text):
+    """Rough token estimate (~4 chars per token) used only for rate budgeting."""
+    if not text:
+        return 0
+    return max(1, len(text) // 4)
+
+
+class AdaptiveTokenBucket:
+    """
+    Token bucket whose refill rate follows AIMD: it grows by a fixed step on
+    every success and is multiplied down on every throttle, bounded by
+    [min_rate, max_rate]. Rates are expressed in units per second.
+    """
+
+    def __init__(self, rate, max_rate, min_rate, burst_seconds=1.0):
+        self.max_rate = float(max_rate)
+        self.min_rate = min(float(min_rate), self.max_rate)
+        self.rate = min(max(float(rate), self.min_rate), self.max_rate)
+        self.burst_seconds = burst_seconds
+        self.increase_step = self.max_rate * config.RATE_LIMIT_INCREASE_FRACTION
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    @property
+    def capacity(self):
+        return max(1.0, self.rate * self.burst_seconds)
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def acquire(self, amount=1.0):
+        while True:
+            with self._lock:
+                self._refill()
+                # Oversized requests would never fit; cap them to a full bucket.
+                needed = min(float(amount), self.capacity)
+                if self.tokens >= needed:
+                    self.tokens -= needed
+                    return
+                wait = (needed - self.tokens) / self.rate
+            time.sleep(min(wait, 1.0))
+
+    def on_success(self):
+        with self._lock:
+            self._refill()
+            self.rate = min(self.max_rate, self.rate + self.increase_step)
+
+    def on_throttle(self):
+        with self._lock:
+            self._refill()
+            self.rate = max(self.min_rate, self.rate * config.RATE_LIMIT_DECREASE_FACTOR)
+            self.tokens = min(self.tokens, self.capacity)
+
+
+class AdaptiveRateLimiter:
+    """Requests/s bucket plus an optional tokens/min bucket for one Bedrock resource."""
+
+    def __init__(self, requests_per_second, max_requests_per_second, tokens_per_minute=None):
+        self.requests = AdaptiveTokenBucket(
+            rate=requests_per_second,
+            max_rate=max_requests_per_second,
+            min_rate=config.RATE_LIMIT_MIN_REQUESTS_PER_SECOND,
+        )
+        self.tokens = None
+        if tokens_per_minute:
+            tokens_per_second = tokens_per_minute / 60.0
+            self.tokens = AdaptiveTokenBucket(
+                rate=tokens_per_second,
+                max_rate=tokens_per_second,
+                min_rate=tokens_per_second * config.RATE_LIMIT_MIN_TOKEN_FRACTION,
+                burst_seconds=10.0,
+            )
+
+    def acquire(self, tokens=0):
+        self.requests.acquire(1)
+        if self.tokens is not None and tokens:
+            self.tokens.acquire(tokens)
+
+    def on_success(self):
+        self.requests.on_success()
+        if self.tokens is not None:
+            self.tokens.on_success()
+
+    def on_throttle(self):
+        self.requests.on_throttle()
+        if self.tokens is not None:
+            self.tokens.on_throttle()
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_model_limiter(model_id):
+    with _limiters_lock:
+        key = ("model", model_id)
+        if key not in _limiters:
+            _limiters[key] = AdaptiveRateLimiter(
+                requests_per_second=config.MODEL_REQUESTS_PER_SECOND,
+                max_requests_per_second=config.MODEL_MAX_REQUESTS_PER_SECOND,
+                tokens_per_minute=config.MODEL_TOKENS_PER_MINUTE,
+            )
+        return _limiters[key]
+
+
+def get_kb_limiter(kb_id):
+    with _limiters_lock:
+        key = ("kb", kb_id)
+        if key not in _limiters:
+            _limiters[key] = AdaptiveRateLimiter(
+                requests_per_second=config.KB_REQUESTS_PER_SECOND,
+                max_requests_per_second=config.KB_MAX_REQUESTS_PER_SECOND,
+            )
+        return _limiters[key]
+
+
+def get_agent_limiter(agent_id):
+    with _limiters_lock:
+        key = ("agent", agent_id)
+        if key not in _limiters:
+            _limiters[key] = AdaptiveRateLimiter(
+                requests_per_second=config.AGENT_REQUESTS_PER_SECOND,
+                max_requests_per_second=config.AGENT_MAX_REQUESTS_PER_SECOND,
+            )
+        return _limiters[key]
+
+
+def call_with_retry(fn, operation_name, error_log, limiter=None, tokens=0, max_retries=None, metrics=None):
+    retries = config.MAX_RETRIES if max_retries is None else max_retries
+    last_error = None
+    throttles = 0
+    for attempt in range(retries + 1):
+        if limiter is not None:
+            limiter.acquire(tokens)
+        started = time.monotonic()
+        try:
+            result = fn()
+        except Exception as e:
+            last_error = e
+            if is_throttling_error(e):
+                throttles += 1
+                if limiter is not None:
+                    limiter.on_throttle()
+        else:
+            if limiter is not None:
+                limiter.on_success()
+            if metrics is not None:
+                metrics.record_call(operation_name, time.monotonic() - started, attempt, throttles)
+            return result
+
+        if attempt < retries:
+            backoff_sleep(attempt)
+        else:
+            if metrics is not None:
+                metrics.record_call(operation_name, time.monotonic() - started, attempt, throttles, success=False)
+            if last_error is not None:
+                error_log.append({
+                    "timestamp": datetime.utcnow().isoformat() + "Z",
+                    "operation": operation_name,
+                    "error": str(last_error),
+                })
+            return None
+
+
+def extract_stream_text(chunk_payload):
+    """Text delta of one streamed chunk (OpenAI-style or Bedrock-native payloads)."""
+    if "choices" in chunk_payload:
+        choices = chunk_payload.get("choices") or [{}]
+        delta = choices[0].get("delta") or choices[0].get("message") or {}
+        return delta.get("content") or ""
+    if "contentBlockDelta" in chunk_payload:
+        return chunk_payload["contentBlockDelta"].get("delta", {}).get("text", "")
+    return chunk_payload.get("outputText") or chunk_payload.get("completion") or ""
+
+
+class StreamStopParser:
+    """
+    Incremental scanner over streamed text that reports when stop_tag has
+    been closed stop_count times outside of <reasoning> blocks. Each delta
+    is scanned once; tags split across deltas are still matched.
+    """
+
+    REASONING_OPEN = "<reasoning>"
+    REASONING_CLOSE = "</reasoning>"
+
+    def __init__(self, stop_tag, stop_count=1):
+        self.stop_tag = stop_tag.lower()
+        self.stop_count = stop_count
+        self.parts = []
+        self.matches = 0
+        # Lowercased text not yet ruled out as the start of a tag; never longer than the longest tag.
+        self._tail = ""
+        self._in_reasoning = False
+        self._longest_tag = max(len(self.stop_tag), len(self.REASONING_OPEN), len(self.REASONING_CLOSE))
+
+    def feed(self, text):
+        self.parts.append(text)
+        window = self._tail + text.lower()
+        scan_from = 0
+        while True:
+            if self._in_reasoning:
+                end = window.find(self.REASONING_CLOSE, scan_from)
+                if end == -1:
+                    break
+                self._in_reasoning = False
+                scan_from = end + len(self.REASONING_CLOSE)
+                continue
+
+            stop_at = window.find(self.stop_tag, scan_from)
+            reasoning_at = window.find(self.REASONING_OPEN, scan_from)
+            if reasoning_at != -1 and (stop_at == -1 or reasoning_at < stop_at):
+                self._in_reasoning = True
+                scan_from = reasoning_at + len(self.REASONING_OPEN)
+                continue
+            if stop_at == -1:
+                break
+            self.matches += 1
+            scan_from = stop_at + len(self.stop_tag)
+
+        # Keep only a tail that could still be the start of a tag split across deltas.
+        self._tail = window[max(scan_from, len(window) - self._longest_tag + 1):]
+        return self.is_complete()
+
+    def is_complete(self):
+        return self.matches >= self.stop_count
+
+    @property
+    def text(self):
+        return "".join(self.parts)
+
+
+def invoke_model_streaming(client, model_id, body, stop_tag, stop_count=1, latency_log=None):
+    """
+    Calls invoke_model_with_response_stream and stops reading as soon as the
+    parser has seen stop_count closing stop_tags. Returns a response shaped
+    like invoke_model's, with the collected text as an OpenAI-style body, so
+    callers and the response cache handle both paths the same way.
+    """
+    started = time.monotonic()
+    first_token_at = None
+    stopped_early = False
+    invocation_metrics = None
+    parser = StreamStopParser(stop_tag, stop_count)
+
+    response = client.invoke_model_with_response_stream(modelId=model_id, body=body)
+    stream = response.get("body")
+    try:
+        for event in stream:
+            chunk = event.get("chunk")
+            if not chunk:
+                continue
+            chunk_payload = json.loads(chunk["bytes"].decode("utf-8"))
+            invocation_metrics = chunk_payload.get("amazon-bedrock-invocationMetrics") or invocation_metrics
+            text = extract_stream_text(chunk_payload)
+            if not text:
+                continue
+            if first_token_at is None:
+                first_token_at = time.monotonic()
+            if parser.feed(text):
+                stopped_early = True
+                break
+    finally:
+        close = getattr(stream, "close", None)
+        if stopped_early and callable(close):
+            close()
+
+    finished = time.monotonic()
+    if latency_log is not None:
+        latency_log.append({
+            "ttft_seconds": (first_token_at - started) if first_token_at else None,
+            "latency_seconds": finished - started,
+            "stopped_early": stopped_early,
+        })
+
+    # An early stop never sees the final invocation metrics, so usage is estimated.
+    if invocation_metrics:
+        usage = {
+            "prompt_tokens": invocation_metrics.get("inputTokenCount", 0),
+            "completion_tokens": invocation_metrics.get("outputTokenCount", 0),
+        }
+    else:
+        usage = {
+            "prompt_tokens": estimate_tokens(body),
+            "completion_tokens": estimate_tokens(parser.text),
+            "estimated": True,
+        }
+    payload = {"choices": [{"message": {"content": parser.text}}], "usage": usage}
+    return {"body": io.BytesIO(json.dumps(payload, ensure_ascii=False).encode("utf-8"))}
+
+
+def summarize_stream_latencies(latency_log):
+    if not latency_log:
+        return None
+    ttfts = [entry["ttft_seconds"] for entry in latency_log if entry["ttft_seconds"] is not None]
+    latencies = [entry["latency_seconds"] for entry in latency_log]
+    return {
+        "calls": len(latency_log),
+        "stopped_early": sum(1 for entry in latency_log if entry["stopped_early"]),
+        "avg_ttft_seconds": (sum(ttfts) / len(ttfts)) if ttfts else None,
+        "avg_latency_seconds": sum(latencies) / len(latencies),
+    }
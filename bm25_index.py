@@ -0,0 +1,220 @@
+import json
+import os
+import re
+import unicodedata
+
+import numpy as np
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+# Accent-folded, so they match tokens produced by fold_accents.
+SPANISH_STOPWORDS = frozenset("""
+a al algo algun alguna algunas alguno algunos ante antes aqui asi aun cada como con contra cual cuales
+cuando de del desde donde dos el ella ellas ello ellos en entre era eran es esa esas ese eso esos esta
+estan estas este esto estos fue fueron ha han hasta hay la las le les lo los mas me mi mis mucho muy
+nada ni no nos nosotros o otra otras otro otros para pero poco por porque que quien se sea ser si sido
+sin sobre son su sus tambien tan te tiene tienen todo todos tu tus un una unas uno unos usted ustedes
+y ya yo
+""".split())
+
+INDEX_FILE = "index.npz"
+META_FILE = "meta.json"
+
+
+def fold_accents(text):
+    """Lowercase and strip diacritics, the same folding as normalize_style_name."""
+    normalized = unicodedata.normalize("NFKD", str(text))
+    return "".join(ch for ch in normalized if not unicodedata.combining(ch)).lower()
+
+
+def tokenize(text):
+    """Spanish-aware tokens: accent-folded, stopwords dropped, trailing plural -s stripped."""
+    tokens = []
+    for token in TOKEN_PATTERN.findall(fold_accents(text)):
+        if len(token) < 2 or token in SPANISH_STOPWORDS:
+            continue
+        if len(token) > 3 and token.endswith("s") and not token.isdigit():
+            token = token[:-1]
+        tokens.append(token)
+    return tokens
+
+
+def split_passages(text, chunk_words, overlap_words):
+    """Whitespace-normalized word windows; chunk_words <= 0 keeps the whole document."""
+    words = str(text).split()
+    if not words:
+        return []
+    if chunk_words <= 0 or len(words) <= chunk_words:
+        return [" ".join(words)]
+    step = max(1, chunk_words - max(0, overlap_words))
+    passages = []
+    for start in range(0, len(words), step):
+        passages.append(" ".join(words[start:start + chunk_words]))
+        if start + chunk_words >= len(words):
+            break
+    return passages
+
+
+class BM25Index:
+    """
+    Okapi BM25 over KB passages, stored as a term-major inverted index in
+    CSR form: postings of term t are doc_ids/weights[indptr[t]:indptr[t+1]].
+    Weights already include idf and length normalization, so scoring a
+    query is a sum of posting weights per passage.
+    """
+
+    def __init__(self, vocabulary, indptr, doc_ids, weights, passages, uris, params=None, sources=None):
+        self.vocabulary = vocabulary
+        self.term_ids = {term: i for i, term in enumerate(vocabulary)}
+        self.indptr = indptr
+        self.doc_ids = doc_ids
+        self.weights = weights
+        self.passages = passages
+        self.uris = uris
+        self.params = params or {}
+        self.sources = sources or {}
+
+    @property
+    def num_passages(self):
+        return len(self.passages)
+
+    @classmethod
+    def build(cls, documents, k1=1.2, b=0.75, chunk_words=300, overlap_words=50, sources=None):
+        """documents: iterable of (uri, text). sources is stored as-is to detect stale indexes."""
+        passages = []
+        uris = []
+        for uri, text in documents:
+            for passage in split_passages(text, chunk_words, overlap_words):
+                passages.append(passage)
+                uris.append(uri)
+
+        term_ids = {}
+        term_column = []
+        doc_column = []
+        lengths = np.zeros(len(passages), dtype=np.float64)
+        for doc_index, passage in enumerate(passages):
+            tokens = tokenize(passage)
+            lengths[doc_index] = len(tokens)
+            for token in tokens:
+                term_column.append(term_ids.setdefault(token, len(term_ids)))
+            doc_column.extend([doc_index] * len(tokens))
+
+        vocabulary = [None] * len(term_ids)
+        for term, term_id in term_ids.items():
+            vocabulary[term_id] = term
+
+        num_docs = max(1, len(passages))
+        # One (term, doc) key per token; unique counts give term frequencies sorted term-major.
+        keys = np.asarray(term_column, dtype=np.int64) * num_docs + np.asarray(doc_column, dtype=np.int64)
+        keys, tf = np.unique(keys, return_counts=True)
+        terms = keys // num_docs
+        docs = keys % num_docs
+
+        doc_freq = np.bincount(terms, minlength=len(vocabulary))
+        idf = np.log(1.0 + (len(passages) - doc_freq + 0.5) / (doc_freq + 0.5))
+        avg_length = lengths.mean() if len(passages) else 0.0
+        norm = k1 * (1.0 - b + b * lengths[docs] / avg_length) if avg_length else k1
+        weights = idf[terms] * tf * (k1 + 1.0) / (tf + norm)
+
+        indptr = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        np.cumsum(doc_freq, out=indptr[1:])
+        params = {"k1": k1, "b": b, "chunk_words": chunk_words, "overlap_words": overlap_words}
+        return cls(
+            vocabulary,
+            indptr,
+            docs.astype(np.int32),
+            weights.astype(np.float32),
+            passages,
+            uris,
+            params=params,
+            sources=sources,
+        )
+
+    def save(self, index_dir):
+        os.makedirs(index_dir, exist_ok=True)
+        index_path = os.path.join(index_dir, INDEX_FILE)
+        meta_path = os.path.join(index_dir, META_FILE)
+        tmp_index = os.path.join(index_dir, f"tmp_{INDEX_FILE}")
+        with open(tmp_index, "wb") as f:
+            np.savez(f, indptr=self.indptr, doc_ids=self.doc_ids, weights=self.weights)
+        with open(f"{meta_path}.tmp", "w", encoding="utf-8") as f:
+            json.dump({
+                "params": self.params,
+                "sources": self.sources,
+                "vocabulary": self.vocabulary,
+                "passages": self.passages,
+                "uris": self.uris,
+            }, f, ensure_ascii=False)
+        os.replace(tmp_index, index_path)
+        os.replace(f"{meta_path}.tmp", meta_path)
+
+    @classmethod
+    def load(cls, index_dir):
+        index_path = os.path.join(index_dir, INDEX_FILE)
+        meta_path = os.path.join(index_dir, META_FILE)
+        if not (os.path.exists(index_path) and os.path.exists(meta_path)):
+            return None
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            arrays = np.load(index_path)
+        except (OSError, ValueError, json.JSONDecodeError):
+            return None
+        return cls(
+            meta["vocabulary"],
+            arrays["indptr"],
+            arrays["doc_ids"],
+            arrays["weights"],
+            meta["passages"],
+            meta["uris"],
+            params=meta.get("params"),
+            sources=meta.get("sources"),
+        )
+
+    def _query_term_ids(self, query):
+        return [self.term_ids[token] for token in tokenize(query) if token in self.term_ids]
+
+    def score_batch(self, queries):
+        """Dense (len(queries), num_passages) BM25 scores from one bincount over all postings."""
+        num_docs = self.num_passages
+        rows = []
+        postings = []
+        for row, query in enumerate(queries):
+            for term_id in self._query_term_ids(query):
+                start, end = self.indptr[term_id], self.indptr[term_id + 1]
+                postings.append(np.arange(start, end))
+                rows.append(np.full(end - start, row, dtype=np.int64))
+        if not postings:
+            return np.zeros((len(queries), num_docs), dtype=np.float64)
+        positions = np.concatenate(postings)
+        flat = np.concatenate(rows) * num_docs + self.doc_ids[positions]
+        scores = np.bincount(flat, weights=self.weights[positions], minlength=len(queries) * num_docs)
+        return scores.reshape(len(queries), num_docs)
+
+    def search(self, queries, top_k, batch_size=None):
+        """
+        Top-k (passage indices, scores) per query, best first. Passages with
+        no matching term are never returned, so a list may be shorter than k.
+        """
+        num_docs = self.num_passages
+        if num_docs == 0 or top_k <= 0:
+            return [([], []) for _ in queries]
+        top_k = min(top_k, num_docs)
+        # Keep each dense score block around 16M cells.
+        batch_size = batch_size or max(1, min(4096, (1 << 24) // num_docs))
+
+        results = []
+        for start in range(0, len(queries), batch_size):
+            scores = self.score_batch(queries[start:start + batch_size])
+            if top_k < num_docs:
+                candidates = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+            else:
+                candidates = np.tile(np.arange(num_docs), (len(scores), 1))
+            candidate_scores = np.take_along_axis(scores, candidates, axis=1)
+            order = np.argsort(-candidate_scores, axis=1, kind="stable")
+            ranked = np.take_along_axis(candidates, order, axis=1)
+            ranked_scores = np.take_along_axis(candidate_scores, order, axis=1)
+            for doc_row, score_row in zip(ranked, ranked_scores):
+                keep = score_row > 0
+                results.append((doc_row[keep].tolist(), score_row[keep].tolist()))
+        return results
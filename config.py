@@ -19,8 +19,17 @@ OUTPUT_RESULTS_PARQUET = os.getenv(
 KB_SERVICE = os.getenv("KB_SERVICE", "bedrock-agent-runtime")
 KB_ID_200 = os.getenv("KB_ID_200", "J7JNHSZPJ3")
 KB_ID_512 = os.getenv("KB_ID_512", "V8C4GPJB9I")
+KB_IDS = {"200": KB_ID_200, "512": KB_ID_512}
+# Comma-separated KB_IDS keys queried by 2_retriever. With more than one, results go to
+# namespaced columns (retrieved_contexts__512, ...) and each KB is evaluated as a variant.
+RETRIEVAL_KB_VARIANTS = [
+    variant.strip() for variant in os.getenv("RETRIEVAL_KB_VARIANTS", "512").split(",") if variant.strip()
+]
 
 AWS_REGION = os.getenv("AWS_REGION", "us-east-1")
+# Point every Bedrock client at another endpoint (e.g. fake_bedrock/server.py) instead of AWS.
+# Clients then use placeholder credentials rather than the AWS profiles below.
+BEDROCK_ENDPOINT_URL = os.getenv("BEDROCK_ENDPOINT_URL", "")
 AWS_PROFILE_LLM = os.getenv("AWS_PROFILE_DEFAULT", "default")
 AWS_PROFILE_SANDBOX = os.getenv("AWS_PROFILE_SANDBOX", "sandbox")
 
@@ -41,9 +50,88 @@ TEMPERATURE = float(os.getenv("TEMPERATURE", "0.7"))
 INPUT_PRICE = float(os.getenv("INPUT_PRICE", "0.00015"))
 OUTPUT_PRICE = float(os.getenv("OUTPUT_PRICE", "0.0006"))
 
+# --- LLM RESPONSE CACHE ---
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "true").lower() in {"1", "true", "yes"}
+# Skip cache lookups (still refreshing stored responses).
+LLM_CACHE_BYPASS = os.getenv("LLM_CACHE_BYPASS", "false").lower() in {"1", "true", "yes"}
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", os.path.join("outputs", "llm_cache.sqlite"))
+LLM_CACHE_MAX_MB = float(os.getenv("LLM_CACHE_MAX_MB", "512"))
+
+# --- RETRIEVAL CACHE ---
+RETRIEVAL_CACHE_ENABLED = os.getenv("RETRIEVAL_CACHE_ENABLED", "true").lower() in {"1", "true", "yes"}
+RETRIEVAL_CACHE_PATH = os.getenv("RETRIEVAL_CACHE_PATH", os.path.join("outputs", "retrieval_cache.sqlite"))
+# Bump after re-ingesting a KB so cached retrievals from the old index are ignored.
+KB_VERSION_TAG = os.getenv("KB_VERSION_TAG", "")
+
+# --- RELEVANCE SCORE CACHE ---
+RELEVANCE_CACHE_ENABLED = os.getenv("RELEVANCE_CACHE_ENABLED", "true").lower() in {"1", "true", "yes"}
+RELEVANCE_CACHE_PATH = os.getenv("RELEVANCE_CACHE_PATH", os.path.join("outputs", "relevance_score_cache.sqlite"))
+# Reranker truncation length; part of the score cache key.
+RERANKER_MAX_LENGTH = int(os.getenv("RERANKER_MAX_LENGTH", "512"))
+# Padded tokens per reranker forward pass (batch size x longest pair in the batch).
+RERANKER_BATCH_TOKENS = int(os.getenv("RERANKER_BATCH_TOKENS", "8192"))
+# CPU sharding: > 1 splits the pairs to score across this many worker processes,
+# each loading the model once. Threads per worker default to cpu_count // workers.
+RERANKER_WORKERS = int(os.getenv("RERANKER_WORKERS", "1"))
+RERANKER_THREADS_PER_WORKER = int(os.getenv("RERANKER_THREADS_PER_WORKER", "0"))
+# Times the worker pool is restarted to re-queue shards lost to a crashed worker.
+RERANKER_SHARD_RETRIES = int(os.getenv("RERANKER_SHARD_RETRIES", "2"))
+# Scorer backend: "flag" (FlagEmbedding) or "onnx" (ONNX Runtime export made by onnx_reranker.py).
+RERANKER_BACKEND = os.getenv("RERANKER_BACKEND", "flag").lower()
+RERANKER_ONNX_DIR = os.getenv("RERANKER_ONNX_DIR", os.path.join("outputs", "onnx_reranker"))
+# Score with the int8 dynamically quantized export instead of fp32.
+RERANKER_ONNX_QUANTIZE = os.getenv("RERANKER_ONNX_QUANTIZE", "false").lower() in {"1", "true", "yes"}
+# Max |score difference| against FlagEmbedding for an ONNX export to pass the parity check.
+RERANKER_PARITY_TOLERANCE = float(os.getenv("RERANKER_PARITY_TOLERANCE", "0.02"))
+
 # --- RETRIEVAL / EVAL ---
 TOP_K = int(os.getenv("TOP_K", "3"))
 EVAL_K = int(os.getenv("EVAL_K", "3"))
+# K-sweep mode: when > TOP_K, retrieve and score this many contexts once and let
+# 4_evaluator report hit rate / MRR / precision@k for every k in 1..SWEEP_K_MAX.
+SWEEP_K_MAX = int(os.getenv("SWEEP_K_MAX", "0"))
+
+# --- OFFLINE BM25 RETRIEVER ---
+BM25_INDEX_DIR = os.getenv("BM25_INDEX_DIR", os.path.join("outputs", "bm25_index"))
+# Passage size in words (0 = whole document) and overlap between consecutive passages.
+BM25_CHUNK_WORDS = int(os.getenv("BM25_CHUNK_WORDS", "300"))
+BM25_CHUNK_OVERLAP_WORDS = int(os.getenv("BM25_CHUNK_OVERLAP_WORDS", "50"))
+BM25_K1 = float(os.getenv("BM25_K1", "1.2"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+# When set, results are written as KB variant columns (retrieved_contexts__<variant>).
+BM25_OUTPUT_VARIANT = os.getenv("BM25_OUTPUT_VARIANT", "")
+
+# --- OFFLINE DENSE RETRIEVER ---
+# "hash" (deterministic local stand-in, no network) or "titan" (cached Titan V2 embeddings).
+VECTOR_PROVIDER = os.getenv("VECTOR_PROVIDER", "hash")
+VECTOR_EMBEDDING_MODEL_ID = os.getenv("VECTOR_EMBEDDING_MODEL_ID", "amazon.titan-embed-text-v2:0")
+# Titan Text Embeddings V2 only accepts 256, 512 or 1024.
+VECTOR_DIM = int(os.getenv("VECTOR_DIM", "1024" if VECTOR_PROVIDER == "titan" else "384"))
+VECTOR_DTYPE = os.getenv("VECTOR_DTYPE", "float16")
+# Simulated KB chunk size in tokens (e.g. 200 or 512); 0 embeds whole documents.
+VECTOR_CHUNK_TOKENS = int(os.getenv("VECTOR_CHUNK_TOKENS", "512"))
+VECTOR_CHUNK_OVERLAP_TOKENS = int(os.getenv("VECTOR_CHUNK_OVERLAP_TOKENS", "0"))
+VECTOR_INDEX_ROOT = os.getenv("VECTOR_INDEX_ROOT", os.path.join("outputs", "vector_index"))
+# IVF lists (0 = exact brute-force search) and lists probed per query.
+VECTOR_IVF_LISTS = int(os.getenv("VECTOR_IVF_LISTS", "0"))
+VECTOR_IVF_NPROBE = int(os.getenv("VECTOR_IVF_NPROBE", "8"))
+EMBEDDING_WORKERS = int(os.getenv("EMBEDDING_WORKERS", "4"))
+# When set, results are written as KB variant columns (retrieved_contexts__<variant>).
+VECTOR_OUTPUT_VARIANT = os.getenv("VECTOR_OUTPUT_VARIANT", "")
+
+# --- CONCURRENCY ---
+GENERATION_WORKERS = int(os.getenv("GENERATION_WORKERS", "4"))
+RETRIEVAL_WORKERS = int(os.getenv("RETRIEVAL_WORKERS", "8"))
+
+# --- OUTPUT BUFFERING ---
+OUTPUT_FLUSH_ROWS = int(os.getenv("OUTPUT_FLUSH_ROWS", "50"))
+OUTPUT_FLUSH_SECONDS = float(os.getenv("OUTPUT_FLUSH_SECONDS", "5.0"))
+
+# --- GENERATION MODE ---
+# Ask for every QUERY_STYLE in a single invoke_model call per document.
+MULTI_STYLE_GENERATION = os.getenv("MULTI_STYLE_GENERATION", "false").lower() in {"1", "true", "yes"}
+# Stream responses and stop reading once the closing </user_input> arrives.
+STREAMING_GENERATION = os.getenv("STREAMING_GENERATION", "false").lower() in {"1", "true", "yes"}
 
 # --- REPRODUCIBILITY ---
 SEED = int(os.getenv("SEED", "42"))
@@ -53,3 +141,16 @@ MAX_RETRIES = int(os.getenv("MAX_RETRIES", "3"))
 BACKOFF_BASE_SECONDS = float(os.getenv("BACKOFF_BASE_SECONDS", "1.0"))
 BACKOFF_MAX_SECONDS = float(os.getenv("BACKOFF_MAX_SECONDS", "8.0"))
 BACKOFF_JITTER_SECONDS = float(os.getenv("BACKOFF_JITTER_SECONDS", "0.3"))
+
+# --- RATE LIMITING (adaptive, per model ID / KB ID) ---
+MODEL_REQUESTS_PER_SECOND = float(os.getenv("MODEL_REQUESTS_PER_SECOND", "2.0"))
+MODEL_MAX_REQUESTS_PER_SECOND = float(os.getenv("MODEL_MAX_REQUESTS_PER_SECOND", "10.0"))
+MODEL_TOKENS_PER_MINUTE = float(os.getenv("MODEL_TOKENS_PER_MINUTE", "200000"))
+KB_REQUESTS_PER_SECOND = float(os.getenv("KB_REQUESTS_PER_SECOND", "5.0"))
+KB_MAX_REQUESTS_PER_SECOND = float(os.getenv("KB_MAX_REQUESTS_PER_SECOND", "20.0"))
+AGENT_REQUESTS_PER_SECOND = float(os.getenv("AGENT_REQUESTS_PER_SECOND", "2.0"))
+AGENT_MAX_REQUESTS_PER_SECOND = float(os.getenv("AGENT_MAX_REQUESTS_PER_SECOND", "10.0"))
+RATE_LIMIT_MIN_REQUESTS_PER_SECOND = float(os.getenv("RATE_LIMIT_MIN_REQUESTS_PER_SECOND", "0.2"))
+RATE_LIMIT_MIN_TOKEN_FRACTION = float(os.getenv("RATE_LIMIT_MIN_TOKEN_FRACTION", "0.05"))
+RATE_LIMIT_INCREASE_FRACTION = float(os.getenv("RATE_LIMIT_INCREASE_FRACTION", "0.02"))
+RATE_LIMIT_DECREASE_FACTOR = float(os.getenv("RATE_LIMIT_DECREASE_FACTOR", "0.5"))
@@ -0,0 +1,511 @@
+# Local stand-in for the Bedrock endpoints used by the pipeline, for offline
+# load and regression testing. Serves, through boto3's endpoint_url:
+#   bedrock-runtime        invoke_model, invoke_model_with_response_stream
+#   bedrock-agent-runtime  retrieve, invoke_agent
+# with injected latency, throttling and errors, and canned or templated replies.
+#
+#   python fake_bedrock/server.py --port 8765 --latency-ms 40 --throttle-rate 0.02
+#   BEDROCK_ENDPOINT_URL=http://127.0.0.1:8765 python 1_generate_user_inputs.py
+#
+# botocore retries throttles on its own before call_with_retry sees them; set
+# AWS_MAX_ATTEMPTS=1 to exercise only the pipeline's retry and rate limiting.
+
+import argparse
+import base64
+import glob
+import hashlib
+import json
+import os
+import random
+import re
+import struct
+import sys
+import threading
+import time
+import uuid
+import zlib
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from string import Template
+from urllib.parse import unquote
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import config  # noqa: E402
+from bm25_index import BM25Index  # noqa: E402
+from vector_index import HashingEmbeddingProvider  # noqa: E402
+
+DEFAULT_BLOCK_TEMPLATE = "<style_name>$style_name</style_name>\n<user_input>$query</user_input>"
+DEFAULT_QUERY_TEMPLATE = "Que necesito saber sobre $topic segun el estilo $style_name (consulta $request_number)"
+DEFAULT_ANSWER_TEMPLATE = "Respuesta sintetica para: $input_text"
+
+STYLE_LINE_PATTERN = re.compile(r"^\s*(?:\d+\.\s*)?Nombre:\s*(.+?)\s*$", re.MULTILINE)
+ALLOWED_STYLES_PATTERN = re.compile(r"Estilos permitidos:\s*(.+)")
+ROUTES = [
+    ("invoke_model", re.compile(r"^/model/(?P<model_id>[^/]+)/invoke$")),
+    ("invoke_model_stream", re.compile(r"^/model/(?P<model_id>[^/]+)/invoke-with-response-stream$")),
+    ("retrieve", re.compile(r"^/knowledgebases/(?P<kb_id>[^/]+)/retrieve$")),
+    (
+        "invoke_agent",
+        re.compile(r"^/agents/(?P<agent_id>[^/]+)/agentAliases/(?P<alias_id>[^/]+)/sessions/(?P<session_id>[^/]+)/text$"),
+    ),
+]
+
+
+def estimate_tokens(text):
+    return max(1, len(text) // 4) if text else 0
+
+
+def encode_event(event_type, payload, message_type="event"):
+    """One AWS event-stream message (prelude, string headers, payload, CRCs)."""
+    headers = b""
+    for name, value in (
+        (":event-type", event_type),
+        (":content-type", "application/json"),
+        (":message-type", message_type),
+    ):
+        name_bytes = name.encode("utf-8")
+        value_bytes = value.encode("utf-8")
+        headers += struct.pack(">B", len(name_bytes)) + name_bytes
+        headers += b"\x07" + struct.pack(">H", len(value_bytes)) + value_bytes
+    total_length = 12 + len(headers) + len(payload) + 4
+    prelude = struct.pack(">II", total_length, len(headers))
+    message = prelude + struct.pack(">I", zlib.crc32(prelude)) + headers + payload
+    return message + struct.pack(">I", zlib.crc32(message))
+
+
+def json_event(event_type, obj):
+    return encode_event(event_type, json.dumps(obj, ensure_ascii=False).encode("utf-8"))
+
+
+class FakeBedrock:
+    """Fault injection, response rendering and request stats shared by all handler threads."""
+
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.rng_lock = threading.Lock()
+        self.stats = Counter()
+        self.stats_lock = threading.Lock()
+        self.request_number = 0
+        self.block_template = Template(DEFAULT_BLOCK_TEMPLATE)
+        self.query_template = Template(args.query_template or DEFAULT_QUERY_TEMPLATE)
+        self.answer_template = Template(args.answer_template or DEFAULT_ANSWER_TEMPLATE)
+        if args.block_template_file:
+            with open(args.block_template_file, "r", encoding="utf-8") as f:
+                self.block_template = Template(f.read().strip())
+        self.canned = {}
+        if args.canned_file:
+            with open(args.canned_file, "r", encoding="utf-8") as f:
+                self.canned = json.load(f)
+
+        self.rate_tokens = float(args.max_rps or 0)
+        self.rate_updated = time.monotonic()
+        self.rate_lock = threading.Lock()
+
+        self.kb_index = None
+        if args.kb_folder:
+            files = sorted(glob.glob(os.path.join(args.kb_folder, "**", "*.md"), recursive=True))
+            documents = []
+            for file_path in files:
+                with open(file_path, "r", encoding="utf-8") as f:
+                    documents.append((f"s3://fake-kb/{os.path.relpath(file_path, args.kb_folder)}", f.read()))
+            self.kb_index = BM25Index.build(
+                documents,
+                chunk_words=config.BM25_CHUNK_WORDS,
+                overlap_words=config.BM25_CHUNK_OVERLAP_WORDS,
+            )
+            print(f"Serving retrieve from {len(files)} files ({self.kb_index.num_passages} passages).")
+
+    def count(self, key, amount=1):
+        with self.stats_lock:
+            self.stats[key] += amount
+
+    def next_request_number(self):
+        with self.stats_lock:
+            self.request_number += 1
+            return self.request_number
+
+    def random(self):
+        with self.rng_lock:
+            return self.rng.random()
+
+    def latency_seconds(self):
+        with self.rng_lock:
+            latency = self.rng.gauss(self.args.latency_ms, self.args.latency_jitter_ms)
+        return max(0.0, latency) / 1000.0
+
+    def _over_rate_limit(self):
+        if not self.args.max_rps:
+            return False
+        with self.rate_lock:
+            now = time.monotonic()
+            self.rate_tokens = min(
+                float(self.args.max_rps),
+                self.rate_tokens + (now - self.rate_updated) * self.args.max_rps,
+            )
+            self.rate_updated = now
+            if self.rate_tokens < 1.0:
+                return True
+            self.rate_tokens -= 1.0
+            return False
+
+    def injected_error(self):
+        """(status, error_code) to fail this request with, or None."""
+        if self._over_rate_limit() or self.random() < self.args.throttle_rate:
+            return 429, "ThrottlingException"
+        if self.random() < self.args.error_rate:
+            return 500, "InternalServerException"
+        return None
+
+    def render_generation(self, messages):
+        if "invoke_model" in self.canned:
+            return self.canned["invoke_model"]
+        user_text = ""
+        for message in messages:
+            if message.get("role") == "user":
+                user_text = str(message.get("content", ""))
+        prompt = "\n".join(str(message.get("content", "")) for message in messages)
+
+        styles = STYLE_LINE_PATTERN.findall(user_text)
+        if not styles:
+            allowed = ALLOWED_STYLES_PATTERN.search(prompt)
+            styles = [style.strip() for style in allowed.group(1).split(",")] if allowed else []
+        styles = list(dict.fromkeys(style for style in styles if style)) or ["Estilo"]
+
+        topic = "el documento"
+        if "DOCUMENTO DE REFERENCIA" in user_text:
+            after = user_text.split("DOCUMENTO DE REFERENCIA", 1)[1].splitlines()[1:]
+            lines = [line.strip("# ").strip() for line in after if line.strip()]
+            if lines:
+                topic = lines[0][:80]
+
+        request_number = self.next_request_number()
+        blocks = []
+        for index, style_name in enumerate(styles, start=1):
+            values = {"style_name": style_name, "index": index, "topic": topic, "request_number": request_number}
+            values["query"] = self.query_template.safe_substitute(values)
+            blocks.append(self.block_template.safe_substitute(values))
+        content = "\n".join(blocks)
+        if self.args.reasoning:
+            content = f"<reasoning>Generando {len(styles)} consultas.</reasoning>\n{content}"
+        return content
+
+    def retrieval_results(self, kb_id, query, top_k):
+        if self.kb_index is not None:
+            (passage_ids, scores), = self.kb_index.search([query], top_k)
+            pairs = [(self.kb_index.passages[i], self.kb_index.uris[i], score) for i, score in zip(passage_ids, scores)]
+        else:
+            seed = int(hashlib.sha256(f"{kb_id}\x1f{query}".encode("utf-8")).hexdigest()[:8], 16)
+            pairs = []
+            for rank in range(top_k):
+                doc = (seed + rank * 7919) % 1000
+                pairs.append((
+                    f"Contenido sintetico {doc} recuperado para: {query}",
+                    f"s3://fake-kb/{kb_id}/BD1-{doc:05d} - Documento sintetico {doc}.md",
+                    1.0 - rank / (top_k + 1),
+                ))
+        return [
+            {
+                "content": {"text": text, "type": "TEXT"},
+                "location": {"s3Location": {"uri": uri}, "type": "S3"},
+                "metadata": {"x-amz-bedrock-kb-source-uri": uri},
+                "score": score,
+            }
+            for text, uri, score in pairs
+        ]
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    fake = None
+
+    def log_message(self, format, *args):
+        if self.fake.args.verbose:
+            super().log_message(format, *args)
+
+    def _send_json(self, status, obj, headers=None):
+        body = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("x-amzn-RequestId", str(uuid.uuid4()))
+        for name, value in (headers or {}).items():
+            self.send_header(name, str(value))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, status, code):
+        body = json.dumps({"message": f"Injected {code}"}).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("x-amzn-ErrorType", code)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _start_stream(self, headers=None):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/vnd.amazon.eventstream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.send_header("x-amzn-RequestId", str(uuid.uuid4()))
+        for name, value in (headers or {}).items():
+            self.send_header(name, str(value))
+        self.end_headers()
+
+    def _write_chunk(self, data):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def _end_stream(self):
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/_stats":
+            with self.fake.stats_lock:
+                stats = dict(self.fake.stats)
+            self._send_json(200, stats)
+            return
+        self._send_json(404, {"message": "Not found"})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        try:
+            body = json.loads(raw.decode("utf-8")) if raw else {}
+        except ValueError:
+            body = {}
+
+        for operation, pattern in ROUTES:
+            match = pattern.match(self.path.split("?", 1)[0])
+            if match:
+                break
+        else:
+            self._send_json(404, {"message": f"Unknown route {self.path}"})
+            return
+
+        params = {key: unquote(value) for key, value in match.groupdict().items()}
+        self.fake.count(f"{operation}.requests")
+        error = self.fake.injected_error()
+        if error:
+            status, code = error
+            self.fake.count(f"{operation}.{'throttled' if status == 429 else 'errors'}")
+            self._send_error(status, code)
+            return
+
+        started = time.monotonic()
+        try:
+            getattr(self, f"_handle_{operation}")(params, body)
+        except (BrokenPipeError, ConnectionResetError):
+            # Clients stop reading streams early on purpose (see invoke_model_streaming).
+            self.fake.count(f"{operation}.client_closed")
+            self.close_connection = True
+            return
+        self.fake.count(f"{operation}.ok")
+        self.fake.count(f"{operation}.latency_ms", int((time.monotonic() - started) * 1000))
+
+    def _handle_invoke_model(self, params, body):
+        time.sleep(self.fake.latency_seconds())
+        if "inputText" in body:
+            dim = int(body.get("dimensions") or 1024)
+            embedding = HashingEmbeddingProvider(dim).embed([body["inputText"]])[0]
+            input_tokens = estimate_tokens(body["inputText"])
+            self._send_json(
+                200,
+                {"embedding": [round(float(value), 6) for value in embedding], "inputTextTokenCount": input_tokens},
+                headers={"x-amzn-bedrock-input-token-count": input_tokens},
+            )
+            return
+
+        content = self.fake.render_generation(body.get("messages", []))
+        input_tokens = estimate_tokens(json.dumps(body, ensure_ascii=False))
+        output_tokens = estimate_tokens(content)
+        self._send_json(
+            200,
+            {
+                "id": f"chatcmpl-{uuid.uuid4().hex}",
+                "object": "chat.completion",
+                "model": params["model_id"],
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": {
+                    "prompt_tokens": input_tokens,
+                    "completion_tokens": output_tokens,
+                    "total_tokens": input_tokens + output_tokens,
+                },
+            },
+            headers={
+                "x-amzn-bedrock-input-token-count": input_tokens,
+                "x-amzn-bedrock-output-token-count": output_tokens,
+            },
+        )
+
+    def _handle_invoke_model_stream(self, params, body):
+        started = time.monotonic()
+        latency = self.fake.latency_seconds()
+        content = self.fake.render_generation(body.get("messages", []))
+        chunk_chars = max(1, self.fake.args.stream_chunk_chars)
+        pieces = [content[i:i + chunk_chars] for i in range(0, len(content), chunk_chars)] or [""]
+        # First byte arrives after a third of the latency; the rest is spread over the pieces.
+        time.sleep(latency / 3)
+        self._start_stream()
+        first_byte_ms = int((time.monotonic() - started) * 1000)
+        for piece in pieces:
+            payload = {"choices": [{"index": 0, "delta": {"content": piece}}]}
+            self._write_chunk(json_event("chunk", {"bytes": base64.b64encode(json.dumps(payload).encode("utf-8")).decode("ascii")}))
+            time.sleep(latency * 2 / 3 / len(pieces))
+        final = {
+            "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+            "amazon-bedrock-invocationMetrics": {
+                "inputTokenCount": estimate_tokens(json.dumps(body, ensure_ascii=False)),
+                "outputTokenCount": estimate_tokens(content),
+                "invocationLatency": int((time.monotonic() - started) * 1000),
+                "firstByteLatency": first_byte_ms,
+            },
+        }
+        self._write_chunk(json_event("chunk", {"bytes": base64.b64encode(json.dumps(final).encode("utf-8")).decode("ascii")}))
+        self._end_stream()
+
+    def _handle_retrieve(self, params, body):
+        time.sleep(self.fake.latency_seconds())
+        query = body.get("retrievalQuery", {}).get("text", "")
+        top_k = int(
+            body.get("retrievalConfiguration", {})
+                .get("vectorSearchConfiguration", {})
+                .get("numberOfResults", 5)
+        )
+        self._send_json(200, {"retrievalResults": self.fake.retrieval_results(params["kb_id"], query, top_k)})
+
+    def _handle_invoke_agent(self, params, body):
+        request_started = time.time()
+        input_text = body.get("inputText", "")
+        session_id = params["session_id"]
+        trace_base = {
+            "agentId": params["agent_id"],
+            "agentAliasId": params["alias_id"],
+            "agentVersion": "1",
+            "sessionId": session_id,
+        }
+        latency = self.fake.latency_seconds()
+        references = self.fake.retrieval_results("agent-kb", input_text, self.fake.args.agent_top_k)
+        answer = self.fake.canned.get("invoke_agent") or self.fake.answer_template.safe_substitute(input_text=input_text)
+        enable_trace = bool(body.get("enableTrace"))
+
+        self._start_stream(headers={
+            "x-amz-bedrock-agent-session-id": session_id,
+            "x-amzn-bedrock-agent-content-type": "application/json",
+        })
+
+        def emit_trace(trace):
+            if enable_trace:
+                event = dict(trace_base, eventTime=time.time(), trace=trace)
+                self._write_chunk(json_event("trace", event))
+
+        def step(seconds):
+            step_started = time.time()
+            time.sleep(seconds)
+            step_finished = time.time()
+            return {
+                "startTime": step_started,
+                "endTime": step_finished,
+                "totalTimeMs": int((step_finished - step_started) * 1000),
+            }
+
+        # Same shape as a KB-backed agent: a planning model call, the KB lookup,
+        # then the model call that writes the answer from the retrieved chunks.
+        trace_id = str(uuid.uuid4())
+        emit_trace({"orchestrationTrace": {"modelInvocationInput": {
+            "text": input_text,
+            "traceId": f"{trace_id}-0",
+            "type": "ORCHESTRATION",
+        }}})
+        planning_metadata = step(latency * 0.2)
+        planning_metadata["usage"] = {"inputTokens": estimate_tokens(input_text) + 200, "outputTokens": 20}
+        emit_trace({"orchestrationTrace": {"modelInvocationOutput": {
+            "metadata": planning_metadata,
+            "rawResponse": {"content": "<search>"},
+            "traceId": f"{trace_id}-0",
+        }}})
+        emit_trace({"orchestrationTrace": {"invocationInput": {
+            "invocationType": "KNOWLEDGE_BASE",
+            "knowledgeBaseLookupInput": {"knowledgeBaseId": "agent-kb", "text": input_text},
+            "traceId": f"{trace_id}-0",
+        }}})
+        kb_metadata = step(latency * 0.3)
+        emit_trace({"orchestrationTrace": {"observation": {
+            "knowledgeBaseLookupOutput": {"metadata": kb_metadata, "retrievedReferences": references},
+            "traceId": f"{trace_id}-0",
+            "type": "KNOWLEDGE_BASE",
+        }}})
+        emit_trace({"orchestrationTrace": {"modelInvocationInput": {
+            "text": input_text,
+            "traceId": f"{trace_id}-KB-0",
+            "type": "KNOWLEDGE_BASE_RESPONSE_GENERATION",
+        }}})
+        model_metadata = step(latency * 0.5)
+        model_metadata["usage"] = {
+            "inputTokens": estimate_tokens(input_text) + sum(estimate_tokens(r["content"]["text"]) for r in references),
+            "outputTokens": estimate_tokens(answer),
+        }
+        emit_trace({"orchestrationTrace": {"modelInvocationOutput": {
+            "metadata": model_metadata,
+            "rawResponse": {"content": answer},
+            "traceId": f"{trace_id}-KB-0",
+        }}})
+        emit_trace({"orchestrationTrace": {"observation": {
+            "finalResponse": {"metadata": {
+                "startTime": request_started,
+                "endTime": time.time(),
+                "operationTotalTimeMs": int((time.time() - request_started) * 1000),
+            }, "text": answer},
+            "traceId": f"{trace_id}-1",
+            "type": "FINISH",
+        }}})
+        self._write_chunk(json_event("chunk", {
+            "bytes": base64.b64encode(answer.encode("utf-8")).decode("ascii"),
+            "attribution": {"citations": [{
+                "generatedResponsePart": {"textResponsePart": {"span": {"start": 0, "end": len(answer)}, "text": answer}},
+                "retrievedReferences": references,
+            }]},
+        }))
+        self._end_stream()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Local fake Bedrock runtime / agent runtime endpoint.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Mean injected latency per call")
+    parser.add_argument("--latency-jitter-ms", type=float, default=0.0, help="Standard deviation of the latency")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Fraction of calls answered with 429")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of calls answered with 500")
+    parser.add_argument("--max-rps", type=float, default=0.0, help="Server-wide request budget; excess calls get 429")
+    parser.add_argument("--seed", type=int, default=config.SEED)
+    parser.add_argument("--kb-folder", default="", help="Serve retrieve results from BM25 over this Markdown folder")
+    parser.add_argument("--agent-top-k", type=int, default=3)
+    parser.add_argument("--stream-chunk-chars", type=int, default=16)
+    parser.add_argument("--reasoning", action="store_true", help="Prefix generations with a <reasoning> block")
+    parser.add_argument("--query-template", default="", help="string.Template for generated queries")
+    parser.add_argument("--answer-template", default="", help="string.Template for agent answers ($input_text)")
+    parser.add_argument("--block-template-file", default="", help="string.Template for one style block")
+    parser.add_argument("--canned-file", default="", help='JSON {"invoke_model": text, "invoke_agent": text}')
+    parser.add_argument("--verbose", action="store_true")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    Handler.fake = FakeBedrock(args)
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    server.daemon_threads = True
+    print(f"Fake Bedrock listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(dict(Handler.fake.stats), indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
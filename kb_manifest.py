@@ -0,0 +1,95 @@
+import json
+import os
+
+from run_state import content_hash
+
+
+def load_manifest(path):
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            payload = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+    return payload.get("files", {}) if isinstance(payload, dict) else {}
+
+
+def save_manifest(path, manifest):
+    parent = os.path.dirname(path)
+    if parent:
+        os.makedirs(parent, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"files": manifest}, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+def build_manifest(files, previous=None):
+    """
+    Returns {path: {"size", "mtime", "sha256"}} for the given KB files.
+    Files whose size and mtime match the previous manifest reuse its hash,
+    so only new or touched files are read. The hash is content_hash of the
+    decoded text, the same value the run-state store uses as kb_hash.
+    """
+    previous = previous or {}
+    manifest = {}
+    for file_path in files:
+        try:
+            stat = os.stat(file_path)
+        except OSError as e:
+            print(f"Error reading file {file_path}: {e}")
+            continue
+
+        entry = {"size": stat.st_size, "mtime": stat.st_mtime}
+        old = previous.get(file_path)
+        if old and old.get("size") == entry["size"] and old.get("mtime") == entry["mtime"]:
+            entry["sha256"] = old["sha256"]
+        else:
+            try:
+                with open(file_path, "r", encoding="utf-8") as f:
+                    entry["sha256"] = content_hash(f.read())
+            except Exception as e:
+                print(f"Error reading file {file_path}: {e}")
+                continue
+        manifest[file_path] = entry
+    return manifest
+
+
+def diff_manifests(previous, current):
+    """
+    Compares two manifests by path and content hash. A deleted path whose
+    hash reappears under a new path is reported as renamed (old, new)
+    instead of as a delete plus an add.
+    """
+    added = [path for path in current if path not in previous]
+    deleted = [path for path in previous if path not in current]
+    changed = [
+        path for path in current
+        if path in previous and previous[path]["sha256"] != current[path]["sha256"]
+    ]
+    unchanged = [
+        path for path in current
+        if path in previous and previous[path]["sha256"] == current[path]["sha256"]
+    ]
+
+    added_by_hash = {}
+    for path in added:
+        added_by_hash.setdefault(current[path]["sha256"], []).append(path)
+
+    renamed = []
+    for old_path in list(deleted):
+        candidates = added_by_hash.get(previous[old_path]["sha256"])
+        if candidates:
+            new_path = candidates.pop(0)
+            renamed.append((old_path, new_path))
+            deleted.remove(old_path)
+            added.remove(new_path)
+
+    return {
+        "added": added,
+        "changed": changed,
+        "renamed": renamed,
+        "deleted": deleted,
+        "unchanged": unchanged,
+    }
@@ -0,0 +1,40 @@
+import re
+
+VARIANT_SEPARATOR = "__"
+VARIANT_COLUMNS = ["retrieved_contexts", "retrieved_file", "relevance_scores"]
+
+
+def variant_column(column, variant=None):
+    """Namespaced column name for one KB variant, e.g. retrieved_contexts__512."""
+    return f"{column}{VARIANT_SEPARATOR}{variant}" if variant else column
+
+
+def detect_variants(columns, base_column="retrieved_contexts"):
+    """KB variants present as namespaced base_column columns, in column order."""
+    pattern = re.compile(rf"^{re.escape(base_column)}{VARIANT_SEPARATOR}(.+)$")
+    variants = []
+    for column in columns:
+        match = pattern.match(str(column))
+        if match:
+            variants.append(match.group(1))
+    return variants
+
+
+def select_variant(df, variant):
+    """
+    Copy of df where the variant's namespaced columns take the plain names
+    used by single-KB runs; the other variants' columns are dropped.
+    """
+    if not variant:
+        return df.copy()
+    drop = [
+        column for column in df.columns
+        if any(str(column).startswith(f"{base}{VARIANT_SEPARATOR}") for base in VARIANT_COLUMNS)
+        or column in VARIANT_COLUMNS
+    ]
+    selected = df.drop(columns=drop)
+    for base in VARIANT_COLUMNS:
+        source = variant_column(base, variant)
+        if source in df.columns:
+            selected[base] = df[source]
+    return selected
@@ -0,0 +1,187 @@
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import config
+
+
+def make_cache_key(model_id, body, temperature, seed, mode=None):
+    # mode tells apart invocations whose bodies differ for the same request (e.g. streamed early stops).
+    parts = [model_id, body, temperature, seed] + ([mode] if mode else [])
+    payload = json.dumps(parts, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LLMResponseCache:
+    """
+    Persistent invoke_model response cache in a local SQLite file.
+
+    Entries map a content hash of the request to the raw response body and
+    are evicted least-recently-used once the stored bodies exceed max_bytes.
+    With bypass=True lookups always miss, but fresh responses are still
+    written, so a bypassed run refreshes the cache.
+    """
+
+    def __init__(self, path, max_bytes, bypass=False):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.bypass = bypass
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+        parent = os.path.dirname(path)
+        if parent:
+            os.makedirs(parent, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, "
+            "body BLOB NOT NULL, "
+            "size INTEGER NOT NULL, "
+            "last_access REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_responses_last_access ON responses(last_access)"
+        )
+        self._conn.commit()
+        self._total_bytes = self._conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+
+    def get(self, key):
+        with self._lock:
+            if self.bypass:
+                self.misses += 1
+                return None
+            row = self._conn.execute(
+                "SELECT body FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute(
+                "UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key)
+            )
+            self._conn.commit()
+            self.hits += 1
+            return bytes(row[0])
+
+    def put(self, key, body):
+        size = len(body)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._conn.execute(
+                "SELECT size FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, body, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, sqlite3.Binary(body), size, time.time()),
+            )
+            self._total_bytes += size - (previous[0] if previous else 0)
+            self._evict()
+            self._conn.commit()
+
+    def reject(self, key):
+        """Drops an entry the caller could not use and counts its lookup as a miss."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT size FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return
+            self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._conn.commit()
+            self._total_bytes -= row[0]
+            self.hits -= 1
+            self.misses += 1
+
+    def _evict(self):
+        # Trim to 90% of the cap so a full cache does not evict on every put.
+        target = int(self.max_bytes * 0.9)
+        while self._total_bytes > self.max_bytes:
+            rows = self._conn.execute(
+                "SELECT key, size FROM responses ORDER BY last_access ASC LIMIT 100"
+            ).fetchall()
+            if not rows:
+                self._total_bytes = 0
+                return
+            for key, size in rows:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._total_bytes -= size
+                self.evictions += 1
+                if self._total_bytes <= target:
+                    return
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "path": self.path,
+            "bypass": self.bypass,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / lookups) if lookups else 0.0,
+            "evictions": self.evictions,
+            "stored_bytes": self._total_bytes,
+        }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_llm_cache():
+    """Returns the process-wide cache, or None when LLM_CACHE_ENABLED is off."""
+    global _cache
+    if not config.LLM_CACHE_ENABLED:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = LLMResponseCache(
+                config.LLM_CACHE_PATH,
+                max_bytes=int(config.LLM_CACHE_MAX_MB * 1024 * 1024),
+                bypass=config.LLM_CACHE_BYPASS,
+            )
+        return _cache
+
+
+def cached_invoke(cache, model_id, body, temperature, invoke_fn, accept=None, mode=None):
+    """
+    Serves an invoke_model response from the cache, or runs invoke_fn (which
+    returns a response dict or None) and stores its body. The returned
+    response always has a fresh, readable "body".
+
+    accept(raw_body) -> bool, when given, decides whether a body is usable
+    (e.g. it parses). Rejected bodies are returned but never stored, and a
+    rejected cached body is dropped and fetched again, so a retry of a
+    failed call does not get the same bad response back.
+
+    mode, when given, is part of the cache key, so a body cut short by an
+    early stop is never served to a caller that wanted the full completion.
+    """
+    if cache is None:
+        return invoke_fn()
+
+    key = make_cache_key(model_id, body, temperature, config.SEED, mode)
+    cached_body = cache.get(key)
+    if cached_body is not None:
+        if accept is None or accept(cached_body):
+            return {"body": io.BytesIO(cached_body), "cached": True}
+        cache.reject(key)
+
+    response = invoke_fn()
+    if response is None:
+        return None
+    raw_body = response.get("body").read()
+    if accept is None or accept(raw_body):
+        cache.put(key, raw_body)
+    response = dict(response)
+    response["body"] = io.BytesIO(raw_body)
+    return response
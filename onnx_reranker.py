@@ -0,0 +1,347 @@
+import argparse
+import ast
+import inspect
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+import config
+from kb_variants import detect_variants, variant_column
+
+DEFAULT_MODEL_NAME = "BAAI/bge-reranker-v2-m3"
+FP32_FILE = "model.onnx"
+INT8_FILE = "model.int8.onnx"
+EXPORT_INFO_FILE = "export_info.json"
+PARITY_REPORT_FILE = "parity_report.json"
+OPSET_VERSION = 17
+PARITY_SAMPLE_PAIRS = 256
+PARITY_BATCH_SIZE = 32
+
+
+def variant_name(quantized):
+    return "onnx-int8" if quantized else "onnx"
+
+
+def model_file(model_dir, quantized):
+    return os.path.join(model_dir, INT8_FILE if quantized else FP32_FILE)
+
+
+def read_json(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def write_json(path, payload):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(payload, f, ensure_ascii=False, indent=2)
+
+
+def export_onnx(model_name, model_dir, quantize=False):
+    """
+    Exports the cross-encoder to model_dir/model.onnx (dynamic batch and
+    sequence axes) next to its tokenizer.json. With quantize, also writes a
+    dynamically int8-quantized model.int8.onnx. torch and transformers are
+    only needed here, not for scoring.
+    """
+    import torch
+    from transformers import AutoModelForSequenceClassification, AutoTokenizer
+
+    os.makedirs(model_dir, exist_ok=True)
+    # A new export has to pass the parity check again.
+    report_path = os.path.join(model_dir, PARITY_REPORT_FILE)
+    if os.path.exists(report_path):
+        os.remove(report_path)
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    tokenizer.save_pretrained(model_dir)
+    model = AutoModelForSequenceClassification.from_pretrained(model_name).eval()
+    # Plain tuple outputs, so the graph has a single "logits" output.
+    model.config.return_dict = False
+
+    sample = tokenizer("query", "passage", return_tensors="pt")
+    fp32_path = model_file(model_dir, False)
+    # torch 2.5 added dynamo= (later defaulting it to True); older releases reject the keyword.
+    export_kwargs = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        export_kwargs["dynamo"] = False
+    print(f"Exporting {model_name} to {fp32_path}...")
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            (sample["input_ids"], sample["attention_mask"]),
+            fp32_path,
+            input_names=["input_ids", "attention_mask"],
+            output_names=["logits"],
+            dynamic_axes={
+                "input_ids": {0: "batch", 1: "sequence"},
+                "attention_mask": {0: "batch", 1: "sequence"},
+                "logits": {0: "batch"},
+            },
+            opset_version=OPSET_VERSION,
+            **export_kwargs,
+        )
+
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        int8_path = model_file(model_dir, True)
+        print(f"Quantizing weights to int8 into {int8_path}...")
+        quantize_dynamic(fp32_path, int8_path, weight_type=QuantType.QInt8)
+
+    write_json(os.path.join(model_dir, EXPORT_INFO_FILE), {
+        "model_name": model_name,
+        "opset": OPSET_VERSION,
+        "quantized": bool(quantize),
+        "exported_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    })
+    print(f"Export complete. Run `python onnx_reranker.py parity{' --quantized' if quantize else ''}` next.")
+
+
+class OnnxReranker:
+    """
+    Cross-encoder scoring on ONNX Runtime with the exported tokenizer.json,
+    without torch or transformers. Pairs are encoded the way FlagReranker
+    encodes them, so scores line up with FlagEmbedding's. Offers the
+    FlagReranker compute_score signature plus encode_pairs / score_encoded
+    for 3_relevance_eval's length-bucketed batching.
+    """
+
+    def __init__(self, model_dir, quantized=False, threads=0):
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        self.model_dir = model_dir
+        self.quantized = quantized
+        self._tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self._tokenizer.no_truncation()
+        self._tokenizer.no_padding()
+        self.cls_id = self._tokenizer.token_to_id("<s>")
+        self.sep_id = self._tokenizer.token_to_id("</s>")
+        self.pad_id = self._tokenizer.token_to_id("<pad>")
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        self._session = onnxruntime.InferenceSession(
+            model_file(model_dir, quantized), options, providers=["CPUExecutionProvider"]
+        )
+
+    def encode_pairs(self, pairs, max_length):
+        """<s> query </s></s> passage </s>, query capped at 3/4 of max_length and passage truncated to fit."""
+        query_max_length = max_length * 3 // 4
+        queries = self._tokenizer.encode_batch([query for query, _ in pairs], add_special_tokens=False)
+        passages = self._tokenizer.encode_batch([passage for _, passage in pairs], add_special_tokens=False)
+        encoded = []
+        for query, passage in zip(queries, passages):
+            query_ids = query.ids[:query_max_length]
+            passage_ids = passage.ids[:max(0, max_length - len(query_ids) - 4)]
+            encoded.append({"input_ids": [self.cls_id] + query_ids + [self.sep_id, self.sep_id] + passage_ids + [self.sep_id]})
+        return encoded
+
+    def _logits(self, inputs):
+        longest = max(len(item["input_ids"]) for item in inputs)
+        input_ids = np.full((len(inputs), longest), self.pad_id, dtype=np.int64)
+        attention_mask = np.zeros((len(inputs), longest), dtype=np.int64)
+        for row, item in enumerate(inputs):
+            length = len(item["input_ids"])
+            input_ids[row, :length] = item["input_ids"]
+            attention_mask[row, :length] = 1
+        logits = self._session.run(["logits"], {"input_ids": input_ids, "attention_mask": attention_mask})[0]
+        return logits.reshape(-1).astype(np.float64)
+
+    def score_encoded(self, inputs):
+        """Normalized scores for encoded pairs, padded only to this batch's longest pair."""
+        return (1.0 / (1.0 + np.exp(-self._logits(inputs)))).tolist()
+
+    def compute_score(self, pairs, normalize=True, max_length=512, batch_size=PARITY_BATCH_SIZE):
+        encoded = self.encode_pairs(pairs, max_length)
+        scores = []
+        for start in range(0, len(encoded), batch_size):
+            batch = encoded[start:start + batch_size]
+            scores.extend(self.score_encoded(batch) if normalize else self._logits(batch).tolist())
+        return scores
+
+
+def load_onnx_reranker(model_name, model_dir, quantized=False, threads=0, max_length=512):
+    """
+    OnnxReranker for an export of model_name that passed the parity check
+    at this max_length, or None with a hint on what to run first.
+    """
+    try:
+        import onnxruntime  # noqa: F401
+        import tokenizers  # noqa: F401
+    except ImportError:
+        print(
+            "Missing dependency for the ONNX scorer. Install it with "
+            "`pip install onnxruntime tokenizers` and run again."
+        )
+        return None
+
+    variant = variant_name(quantized)
+    export_flag = " --quantize" if quantized else ""
+    if not os.path.exists(model_file(model_dir, quantized)):
+        print(f"No {variant} export in {model_dir}. Run `python onnx_reranker.py export{export_flag}` first.")
+        return None
+    exported_name = read_json(os.path.join(model_dir, EXPORT_INFO_FILE)).get("model_name")
+    if exported_name != model_name:
+        print(f"{model_dir} holds an export of {exported_name}, not {model_name}. Export again.")
+        return None
+    parity = read_json(os.path.join(model_dir, PARITY_REPORT_FILE)).get(variant) or {}
+    if not parity.get("passed") or parity.get("max_length") != max_length:
+        print(
+            f"The {variant} export has not passed the parity check against FlagEmbedding "
+            f"at max_length={max_length}. Run `python onnx_reranker.py parity"
+            f"{' --quantized' if quantized else ''}` first."
+        )
+        return None
+    return OnnxReranker(model_dir, quantized, threads)
+
+
+def parity_pairs(csv_path, limit):
+    """
+    Up to limit unique (query, chunk) pairs from queries spread evenly over
+    the pipeline CSV. Each sampled query keeps all its chunks, so the check
+    can also compare which chunk ranks first. Multi-KB runs contribute the
+    chunks of every retrieved_contexts__<variant> column.
+    """
+    header = pd.read_csv(csv_path, nrows=0).columns
+    variants = detect_variants(header) or [None]
+    contexts_columns = [variant_column("retrieved_contexts", variant) for variant in variants]
+    missing = [column for column in ["user_input"] + contexts_columns if column not in header]
+    if missing:
+        return []
+    df = pd.read_csv(csv_path, usecols=["user_input"] + contexts_columns)
+    queries = {}
+    for contexts_column in contexts_columns:
+        for query, contexts in zip(df["user_input"], df[contexts_column]):
+            if pd.isna(query) or pd.isna(contexts):
+                continue
+            try:
+                chunks = ast.literal_eval(contexts)
+            except (ValueError, SyntaxError):
+                continue
+            for chunk in chunks if isinstance(chunks, list) else []:
+                queries.setdefault(str(query), {}).setdefault(str(chunk), None)
+    if not queries:
+        return []
+    chunks_per_query = sum(len(chunks) for chunks in queries.values()) / len(queries)
+    step = max(1, int(len(queries) * chunks_per_query / max(1, limit)))
+    pairs = [[query, chunk] for query in list(queries)[::step] for chunk in queries[query]]
+    return pairs[:limit]
+
+
+def top1_agreement(pairs, reference, candidate):
+    """Share of queries with 2+ sampled chunks whose best chunk is the same under both scorers."""
+    by_query = {}
+    for (query, _), ref_score, cand_score in zip(pairs, reference, candidate):
+        by_query.setdefault(query, []).append((ref_score, cand_score))
+    ranked = [scores for scores in by_query.values() if len(scores) > 1]
+    if not ranked:
+        return None
+    agree = sum(
+        max(range(len(scores)), key=lambda i: scores[i][0]) == max(range(len(scores)), key=lambda i: scores[i][1])
+        for scores in ranked
+    )
+    return agree / len(ranked)
+
+
+def run_parity_check(model_name, model_dir, quantized, pairs, tolerance, max_length):
+    """
+    Scores the same pairs with FlagEmbedding (fp32) and the ONNX export and
+    records the result under the export's variant in parity_report.json.
+    """
+    from FlagEmbedding import FlagReranker
+
+    print(f"Scoring {len(pairs)} pairs with FlagEmbedding...")
+    reference_model = FlagReranker(model_name, use_fp16=False)
+    started = time.monotonic()
+    reference = reference_model.compute_score(
+        pairs, normalize=True, max_length=max_length, batch_size=PARITY_BATCH_SIZE
+    )
+    reference_seconds = time.monotonic() - started
+
+    variant = variant_name(quantized)
+    print(f"Scoring {len(pairs)} pairs with the {variant} export...")
+    candidate_model = OnnxReranker(model_dir, quantized)
+    started = time.monotonic()
+    candidate = candidate_model.compute_score(pairs, normalize=True, max_length=max_length)
+    candidate_seconds = time.monotonic() - started
+
+    diffs = np.abs(np.asarray(reference, dtype=np.float64) - np.asarray(candidate, dtype=np.float64))
+    result = {
+        "model_name": model_name,
+        "pairs": len(pairs),
+        "max_length": max_length,
+        "tolerance": tolerance,
+        "max_abs_diff": float(diffs.max()),
+        "mean_abs_diff": float(diffs.mean()),
+        "top1_agreement": top1_agreement(pairs, reference, candidate),
+        "flag_seconds": round(reference_seconds, 3),
+        "onnx_seconds": round(candidate_seconds, 3),
+        "speedup": round(reference_seconds / candidate_seconds, 2) if candidate_seconds else None,
+        "passed": bool(diffs.max() <= tolerance),
+        "checked_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    report_path = os.path.join(model_dir, PARITY_REPORT_FILE)
+    report = read_json(report_path)
+    report[variant] = result
+    write_json(report_path, report)
+
+    print(
+        f"{variant}: max |diff| {result['max_abs_diff']:.5f}, mean |diff| {result['mean_abs_diff']:.5f} "
+        f"(tolerance {tolerance}), top-1 agreement {result['top1_agreement']}, "
+        f"{result['speedup']}x faster than FlagEmbedding."
+    )
+    print(f"Parity {'PASSED' if result['passed'] else 'FAILED'}. Report saved to {report_path}")
+    return result
+
+
+def build_argparser():
+    parser = argparse.ArgumentParser(description="Export and validate the ONNX relevance scorer")
+    parser.add_argument("--model", default=DEFAULT_MODEL_NAME, help="Hugging Face cross-encoder to export")
+    parser.add_argument(
+        "--dir",
+        default=config.RERANKER_ONNX_DIR,
+        help="Export directory (default: RERANKER_ONNX_DIR)",
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = commands.add_parser("export", help="Export the model to ONNX")
+    export_parser.add_argument("--quantize", action="store_true", help="Also write an int8 dynamically quantized model")
+
+    parity_parser = commands.add_parser("parity", help="Compare ONNX scores against FlagEmbedding")
+    parity_parser.add_argument("--quantized", action="store_true", help="Check the int8 model instead of fp32")
+    parity_parser.add_argument("--csv", default=config.PIPELINE_CSV, help="Pipeline CSV to sample pairs from")
+    parity_parser.add_argument("--pairs", type=int, default=PARITY_SAMPLE_PAIRS, help="Number of pairs to compare")
+    parity_parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=config.RERANKER_PARITY_TOLERANCE,
+        help="Max allowed |score difference| (default: RERANKER_PARITY_TOLERANCE)",
+    )
+    return parser
+
+
+def main():
+    args = build_argparser().parse_args()
+    if args.command == "export":
+        export_onnx(args.model, args.dir, quantize=args.quantize)
+        return
+
+    pairs = parity_pairs(args.csv, args.pairs)
+    if not pairs:
+        print(f"No (user_input, retrieved_contexts) pairs found in {args.csv}. Run File 2 first.")
+        return
+    result = run_parity_check(args.model, args.dir, args.quantized, pairs, args.tolerance, config.RERANKER_MAX_LENGTH)
+    if not result["passed"]:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import config
+
+
+def hash_query(query):
+    return hashlib.sha256(str(query).encode("utf-8")).hexdigest()
+
+
+class RetrievalCache:
+    """
+    Persistent cache of Bedrock KB retrievalResults in a local SQLite file.
+
+    Entries are keyed by (kb_id, kb_version, query) and keep the largest
+    top_k fetched so far: a cached top-10 answers any top_k <= 10 by
+    slicing. Changing kb_version (e.g. after re-ingesting the KB) makes
+    every older entry unreachable.
+    """
+
+    def __init__(self, path, kb_version=""):
+        parent = os.path.dirname(path)
+        if parent:
+            os.makedirs(parent, exist_ok=True)
+        self.path = path
+        self.kb_version = kb_version
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS retrievals ("
+            "kb_id TEXT NOT NULL, "
+            "kb_version TEXT NOT NULL, "
+            "query_hash TEXT NOT NULL, "
+            "query TEXT NOT NULL, "
+            "top_k INTEGER NOT NULL, "
+            "results TEXT NOT NULL, "
+            "updated_at REAL NOT NULL, "
+            "PRIMARY KEY (kb_id, kb_version, query_hash))"
+        )
+        self._conn.commit()
+
+    def get(self, kb_id, query, top_k):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT top_k, results FROM retrievals "
+                "WHERE kb_id = ? AND kb_version = ? AND query_hash = ?",
+                (kb_id, self.kb_version, hash_query(query)),
+            ).fetchone()
+            if row is None or row[0] < top_k:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(row[1])[:top_k]
+
+    def put(self, kb_id, query, top_k, results):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO retrievals (kb_id, kb_version, query_hash, query, top_k, results, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (kb_id, kb_version, query_hash) DO UPDATE SET "
+                "top_k = excluded.top_k, results = excluded.results, updated_at = excluded.updated_at "
+                "WHERE excluded.top_k >= retrievals.top_k",
+                (
+                    kb_id,
+                    self.kb_version,
+                    hash_query(query),
+                    str(query),
+                    top_k,
+                    json.dumps(results, ensure_ascii=False, default=str),
+                    time.time(),
+                ),
+            )
+
+    def purge_other_versions(self, kb_id):
+        """Deletes entries of kb_id cached under any other kb_version."""
+        with self._lock, self._conn:
+            return self._conn.execute(
+                "DELETE FROM retrievals WHERE kb_id = ? AND kb_version != ?",
+                (kb_id, self.kb_version),
+            ).rowcount
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "path": self.path,
+            "kb_version": self.kb_version,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / lookups) if lookups else 0.0,
+        }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_retrieval_cache():
+    """Returns the process-wide cache, or None when RETRIEVAL_CACHE_ENABLED is off."""
+    global _cache
+    if not config.RETRIEVAL_CACHE_ENABLED:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = RetrievalCache(config.RETRIEVAL_CACHE_PATH, kb_version=config.KB_VERSION_TAG)
+        return _cache
@@ -1,17 +1,26 @@
 ﻿import base64
 import json
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime, timezone
 from pathlib import Path
-from typing import Any, Dict
+from typing import Any, Dict, List, Optional
 
-import boto3
+import pandas as pd
 from botocore.exceptions import BotoCoreError, ClientError
 
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+import config  # noqa: E402
+from agent_trace import TraceTimeline, latency_breakdown, load_batch_records, steps_frame, steps_from_completion  # noqa: E402
+from bedrock_utils import call_with_retry, create_client, get_agent_limiter  # noqa: E402
+from run_metrics import RunMetrics  # noqa: E402
+
 # -----------------------------
 # REQUIRED CONFIG (fill these)
 # -----------------------------
+# Region and endpoint come from the root config.py (AWS_REGION, BEDROCK_ENDPOINT_URL).
 AWS_PROFILE = "sandbox"
-AWS_REGION = "us-east-1"
 AGENT_ID = "UKQEMRZQUS"
 AGENT_ALIAS_ID = "JPSUY1DN1P"
 INPUT_TEXT = "dime en código python cómo compro una casa"
@@ -25,6 +34,21 @@ ENABLE_TRACE = True
 # JSON output written in the same folder as this script.
 OUTPUT_JSON_PATH = Path(__file__).resolve().parent / "agent_raw_response.json"
 
+# -----------------------------
+# BATCH MODE
+# -----------------------------
+# When True, every user_input in BATCH_INPUT_CSV is sent to the agent
+# (BATCH_WORKERS at a time, one session per query) and each reply is
+# reduced to one compact JSON line as its events arrive.
+BATCH_MODE = False
+BATCH_INPUT_CSV = config.PIPELINE_CSV
+BATCH_WORKERS = 8
+# 0 = every row.
+BATCH_LIMIT = 0
+BATCH_OUTPUT_JSONL_PATH = Path(config.PIPELINE_OUTPUT_DIR) / "agent_batch_results.jsonl"
+
+# Retry settings (backoff timing and rate limits come from the root config.py)
+MAX_RETRIES = 3
 
 def ensure_session_id(value: str) -> str:
     if value.strip():
@@ -51,9 +75,12 @@ def make_json_safe(value: Any) -> Any:
     return str(value)
 
 
+def get_agent_client(max_pool_connections: Optional[int] = None):
+    return create_client("bedrock-agent-runtime", AWS_PROFILE, max_pool_connections)
+
+
 def invoke_bedrock_agent() -> Dict[str, Any]:
-    session = boto3.Session(profile_name=AWS_PROFILE, region_name=AWS_REGION)
-    client = session.client("bedrock-agent-runtime")
+    client = get_agent_client()
 
     request_payload = {
         "agentId": AGENT_ID,
@@ -72,7 +99,179 @@ def invoke_bedrock_agent() -> Dict[str, Any]:
     return make_json_safe(raw_response)
 
 
+class AgentStreamSummary:
+    """
+    Incremental reduction of one invoke_agent completion stream: answer
+    text, cited references (de-duplicated, in citation order), timed trace
+    steps and client-side arrival times. Events are dropped once folded in.
+    """
+
+    def __init__(self) -> None:
+        self.started = time.monotonic()
+        self.first_event_ms: Optional[int] = None
+        self.first_chunk_ms: Optional[int] = None
+        self.answer_parts: List[str] = []
+        self.citations = 0
+        self.retrieved_contexts: List[str] = []
+        self.retrieved_file: List[str] = []
+        self._seen_references = set()
+        self.timeline = TraceTimeline()
+
+    def _elapsed_ms(self) -> int:
+        return int((time.monotonic() - self.started) * 1000)
+
+    def add(self, event: Dict[str, Any]) -> None:
+        if self.first_event_ms is None:
+            self.first_event_ms = self._elapsed_ms()
+        if "chunk" in event:
+            if self.first_chunk_ms is None:
+                self.first_chunk_ms = self._elapsed_ms()
+            chunk = event["chunk"]
+            data = chunk.get("bytes")
+            if data:
+                self.answer_parts.append(data.decode("utf-8", errors="replace"))
+            for citation in (chunk.get("attribution") or {}).get("citations", []):
+                self.citations += 1
+                for reference in citation.get("retrievedReferences", []):
+                    self._add_reference(reference)
+        elif "trace" in event:
+            self.timeline.add(event["trace"].get("trace") or {})
+
+    def _add_reference(self, reference: Dict[str, Any]) -> None:
+        text = (reference.get("content") or {}).get("text", "")
+        uri = ((reference.get("location") or {}).get("s3Location") or {}).get("uri", "")
+        if (text, uri) in self._seen_references:
+            return
+        self._seen_references.add((text, uri))
+        self.retrieved_contexts.append(text)
+        self.retrieved_file.append(uri)
+
+    def to_record(self) -> Dict[str, Any]:
+        return {
+            "answer": "".join(self.answer_parts),
+            "citations": self.citations,
+            "retrieved_contexts": self.retrieved_contexts,
+            "retrieved_file": self.retrieved_file,
+            "steps": self.timeline.steps,
+            "client_ms": {
+                "first_event": self.first_event_ms,
+                "first_chunk": self.first_chunk_ms,
+                "total": self._elapsed_ms(),
+            },
+        }
+
+
+def invoke_agent_streaming(client, query_text: str, session_id: str, error_log: list, metrics: RunMetrics):
+    attempts = []
+
+    def _call():
+        # A fresh session per attempt, so a retry never sees a half-finished turn.
+        attempts.append(None)
+        response = client.invoke_agent(
+            agentId=AGENT_ID,
+            agentAliasId=AGENT_ALIAS_ID,
+            sessionId=f"{session_id}-a{len(attempts)}" if len(attempts) > 1 else session_id,
+            inputText=query_text,
+            enableTrace=ENABLE_TRACE,
+        )
+        summary = AgentStreamSummary()
+        for event in response.get("completion", []):
+            summary.add(event)
+        return summary.to_record()
+
+    record = call_with_retry(
+        _call,
+        "invoke_agent",
+        error_log,
+        limiter=get_agent_limiter(AGENT_ID),
+        max_retries=MAX_RETRIES,
+        metrics=metrics,
+    )
+    if record is not None:
+        for step in record["steps"]:
+            if step["input_tokens"] or step["output_tokens"]:
+                metrics.record_usage("invoke_agent", step["input_tokens"] or 0, step["output_tokens"] or 0)
+    return record
+
+
+def print_latency_breakdown(breakdown: pd.DataFrame) -> None:
+    print("Agent latency breakdown (per query):")
+    print(breakdown.to_string(index=False, float_format=lambda value: f"{value:.2f}"))
+
+
+def load_batch_queries() -> List[str]:
+    df = pd.read_csv(BATCH_INPUT_CSV, usecols=["user_input"])
+    queries = ["" if pd.isna(query) else str(query) for query in df["user_input"].tolist()]
+    return queries[:BATCH_LIMIT] if BATCH_LIMIT > 0 else queries
+
+
+def run_batch() -> None:
+    try:
+        queries = load_batch_queries()
+    except (FileNotFoundError, ValueError) as exc:
+        print(f"Cannot read user_input from {BATCH_INPUT_CSV}: {exc}")
+        return
+
+    workers = max(1, BATCH_WORKERS)
+    client = get_agent_client(max_pool_connections=workers)
+    metrics = RunMetrics("agent_batch")
+    error_log: list = []
+    run_stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    BATCH_OUTPUT_JSONL_PATH.parent.mkdir(parents=True, exist_ok=True)
+
+    def _run(row_index: int):
+        session_id = f"agent-batch-{run_stamp}-{row_index}"
+        record = invoke_agent_streaming(client, queries[row_index], session_id, error_log, metrics)
+        return row_index, session_id, record
+
+    print(f"Invoking agent {AGENT_ID} for {len(queries)} queries with {workers} workers...")
+    done_count = 0
+    failed = 0
+    pending = set()
+    next_index = 0
+    with open(BATCH_OUTPUT_JSONL_PATH, "w", encoding="utf-8") as output, ThreadPoolExecutor(max_workers=workers) as executor:
+        # Keep at most two waves in flight, so finished replies are written and released right away.
+        while next_index < len(queries) or pending:
+            while next_index < len(queries) and len(pending) < workers * 2:
+                pending.add(executor.submit(_run, next_index))
+                next_index += 1
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                row_index, session_id, record = future.result()
+                line = {"row_index": row_index, "user_input": queries[row_index], "session_id": session_id}
+                if record is None:
+                    failed += 1
+                    line["status"] = "error"
+                else:
+                    line["status"] = "ok"
+                    line.update(record)
+                output.write(json.dumps(line, ensure_ascii=False, separators=(",", ":")) + "\n")
+                done_count += 1
+            output.flush()
+            print(f"[{done_count}/{len(queries)}] agent replies written ({failed} failed)")
+
+    print(f"Saved {done_count} agent replies to {BATCH_OUTPUT_JSONL_PATH}")
+    breakdown = latency_breakdown(steps_frame(load_batch_records(BATCH_OUTPUT_JSONL_PATH)))
+    if not breakdown.empty:
+        breakdown_path = BATCH_OUTPUT_JSONL_PATH.parent / "agent_latency_breakdown.csv"
+        breakdown.to_csv(breakdown_path, index=False)
+        print_latency_breakdown(breakdown)
+        print(f"Saved latency breakdown to {breakdown_path}")
+    metrics_path = BATCH_OUTPUT_JSONL_PATH.parent / "agent_batch_metrics.json"
+    metrics.print_summary(metrics.write(str(metrics_path)))
+    if error_log:
+        summary_path = BATCH_OUTPUT_JSONL_PATH.parent / "agent_batch_run_summary.json"
+        summary_path.write_text(
+            json.dumps({"queries": len(queries), "failed": failed, "errors": error_log}, ensure_ascii=False, indent=2),
+            encoding="utf-8",
+        )
+
+
 def main() -> None:
+    if BATCH_MODE:
+        run_batch()
+        return
+
     try:
         result = invoke_bedrock_agent()
     except (ClientError, BotoCoreError, ValueError) as exc:
@@ -92,6 +291,12 @@ def main() -> None:
     )
     print(f"Saved full Bedrock Agent reply to: {OUTPUT_JSON_PATH}")
 
+    if ENABLE_TRACE:
+        steps = steps_from_completion(result.get("completion", []))
+        breakdown = latency_breakdown(steps_frame([{"steps": steps}]))
+        if not breakdown.empty:
+            print_latency_breakdown(breakdown)
+
 
 if __name__ == "__main__":
     main()
@@ -1,16 +1,20 @@
 ﻿import os
+import sys
 import json
 import time
-import random
-from datetime import datetime
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
-import boto3
-from botocore.exceptions import ClientError
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bedrock_utils import call_with_retry, create_client, get_kb_limiter  # noqa: E402
+from row_checkpoint import RowCheckpoint, build_row_keys  # noqa: E402
+from run_metrics import RunMetrics  # noqa: E402
 
 # -----------------------------
 # CONFIGURATION (edit as needed)
 # -----------------------------
-AWS_REGION = "us-east-1"
+# Region and endpoint come from the root config.py (AWS_REGION, BEDROCK_ENDPOINT_URL).
 KB_SERVICE = "bedrock-agent-runtime"
 AWS_PROFILE = "sandbox"
 KB_ID = "J7JNHSZPJ3"
@@ -24,16 +28,20 @@ KB_ID = "J7JNHSZPJ3"
 QUERY = "cuenta rut faq"
 TOP_K = 3
 
-# Retry settings
+# Batch mode: when QUERY_FILE is set, every query in it is retrieved instead of QUERY.
+# .txt = one query per line; .csv / .jsonl = the QUERY_COLUMN field (JSONL lines may also be plain strings).
+QUERY_FILE = ""
+QUERY_COLUMN = "user_input"
+BATCH_WORKERS = 8
+# One line per query; rerunning with the same KB_ID / TOP_K skips queries already captured.
+BATCH_OUTPUT_JSONL = os.path.join(os.path.dirname(os.path.abspath(__file__)), "kb_raw_responses.jsonl")
+
+# Retry settings (backoff timing and rate limits come from the root config.py)
 MAX_RETRIES = 3
-BACKOFF_BASE_SECONDS = 1.0
-BACKOFF_MAX_SECONDS = 8.0
-BACKOFF_JITTER_SECONDS = 0.3
 
 
-def get_runtime_client():
-    session = boto3.Session(profile_name=AWS_PROFILE)
-    return session.client(service_name=KB_SERVICE, region_name=AWS_REGION)
+def get_runtime_client(max_pool_connections=None):
+    return create_client(KB_SERVICE, AWS_PROFILE, max_pool_connections)
 
 
 def ensure_parent_dir(path):
@@ -42,51 +50,122 @@ def ensure_parent_dir(path):
         os.makedirs(parent, exist_ok=True)
 
 
-def backoff_sleep(attempt):
-    base = BACKOFF_BASE_SECONDS * (2 ** attempt)
-    sleep_for = min(base, BACKOFF_MAX_SECONDS)
-    sleep_for += random.uniform(0, BACKOFF_JITTER_SECONDS)
-    time.sleep(sleep_for)
-
-
-def call_with_retry(fn, operation_name, error_log):
-    last_error = None
-    for attempt in range(MAX_RETRIES + 1):
-        try:
-            return fn()
-        except ClientError as e:
-            last_error = e
-        except Exception as e:
-            last_error = e
-
-        if attempt < MAX_RETRIES:
-            backoff_sleep(attempt)
-        else:
-            if last_error is not None:
-                error_log.append(
-                    {
-                        "timestamp": datetime.utcnow().isoformat() + "Z",
-                        "operation": operation_name,
-                        "error": str(last_error),
-                    }
-                )
-            return None
-
-
-def retrieve_raw_response(query_text, top_k_value, client, error_log):
+def retrieve_raw_response(query_text, top_k_value, client, error_log, metrics=None, timing=None):
     def _call():
-        return client.retrieve(
+        # Counted before the call, so throttled and failed attempts show up too.
+        if timing is not None:
+            timing["attempts"] = timing.get("attempts", 0) + 1
+        started = time.monotonic()
+        response = client.retrieve(
             knowledgeBaseId=KB_ID,
             retrievalQuery={"text": query_text},
             retrievalConfiguration={
                 "vectorSearchConfiguration": {"numberOfResults": top_k_value}
             },
         )
+        if timing is not None:
+            timing["latency_ms"] = round((time.monotonic() - started) * 1000, 1)
+        return response
+
+    return call_with_retry(
+        _call,
+        "retrieve",
+        error_log,
+        limiter=get_kb_limiter(KB_ID),
+        max_retries=MAX_RETRIES,
+        metrics=metrics,
+    )
+
+
+def load_queries(path):
+    """Queries from a .txt (one per line), .csv or .jsonl file, in file order."""
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".csv":
+        column = pd.read_csv(path, usecols=[QUERY_COLUMN])[QUERY_COLUMN]
+        queries = ["" if pd.isna(query) else str(query) for query in column.tolist()]
+    elif extension == ".jsonl":
+        queries = []
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                queries.append(str(item.get(QUERY_COLUMN, item.get("query", ""))) if isinstance(item, dict) else str(item))
+    else:
+        with open(path, "r", encoding="utf-8-sig") as f:
+            queries = [line.strip() for line in f]
+    return [query for query in queries if query.strip()]
+
+
+def run_batch():
+    try:
+        queries = load_queries(QUERY_FILE)
+    except (OSError, ValueError) as exc:
+        print(f"Cannot read queries from {QUERY_FILE}: {exc}")
+        return
+
+    row_keys = build_row_keys((query,) for query in queries)
+    checkpoint = RowCheckpoint(BATCH_OUTPUT_JSONL, scope={"kb_id": KB_ID, "top_k": TOP_K})
+    done = checkpoint.load()
+    pending = [index for index, row_key in enumerate(row_keys) if row_key not in done]
+    if len(pending) < len(queries):
+        print(f"Resuming: {len(queries) - len(pending)} queries already captured, {len(pending)} remaining.")
 
-    return call_with_retry(_call, "retrieve", error_log)
+    workers = max(1, BATCH_WORKERS)
+    client = get_runtime_client(max_pool_connections=workers)
+    metrics = RunMetrics("kb_raw_batch")
+    error_log = []
+
+    def _run(index):
+        timing = {}
+        started = time.monotonic()
+        response = retrieve_raw_response(queries[index], TOP_K, client, error_log, metrics, timing)
+        timing["total_ms"] = round((time.monotonic() - started) * 1000, 1)
+        return index, response, timing
+
+    print(f"Retrieving {len(pending)} queries from KB {KB_ID} with {workers} workers (top_k={TOP_K})...")
+    captured = 0
+    failed = 0
+    in_flight = set()
+    next_pending = 0
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # A bounded window of submissions keeps only a few raw responses in memory at a time.
+            while next_pending < len(pending) or in_flight:
+                while next_pending < len(pending) and len(in_flight) < workers * 2:
+                    in_flight.add(executor.submit(_run, pending[next_pending]))
+                    next_pending += 1
+                finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    index, response, timing = future.result()
+                    if response is None:
+                        failed += 1
+                        continue
+                    checkpoint.append(row_keys[index], {"query": queries[index], **timing, "response": response})
+                    captured += 1
+                print(f"[{captured + failed}/{len(pending)}] captured ({failed} failed)")
+    finally:
+        checkpoint.close()
+
+    print(f"Saved raw responses to {BATCH_OUTPUT_JSONL}")
+    output_dir = os.path.dirname(BATCH_OUTPUT_JSONL)
+    metrics.print_summary(metrics.write(os.path.join(output_dir, "kb_raw_batch_metrics.json")))
+    if error_log:
+        with open(os.path.join(output_dir, "retriever_raw_run_summary.json"), "w", encoding="utf-8") as summary_file:
+            json.dump(
+                {"retrieved": captured, "failed": failed, "errors": error_log},
+                summary_file,
+                ensure_ascii=False,
+                indent=2,
+            )
+        print(f"{failed} queries failed; rerun to retry them.")
 
 
 def main():
+    if QUERY_FILE:
+        run_batch()
+        return
+
     if not QUERY.strip():
         print("Set the 'QUERY' variable at the top of this file before running.")
         return
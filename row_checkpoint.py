@@ -0,0 +1,108 @@
+import json
+import os
+import threading
+from datetime import datetime
+
+from run_state import content_hash
+
+
+def build_row_keys(rows):
+    """
+    Stable identity for each row of an input file, from the given tuples of
+    identifying values. Repeated tuples get an occurrence suffix so
+    duplicated queries still map to distinct rows.
+    """
+    seen = {}
+    keys = []
+    for values in rows:
+        base = content_hash("\x1f".join(str(value) for value in values))
+        occurrence = seen.get(base, 0)
+        seen[base] = occurrence + 1
+        keys.append(f"{base}:{occurrence}")
+    return keys
+
+
+class RowCheckpoint:
+    """
+    Append-only JSONL checkpoint of finished rows, one line per row key.
+
+    Every line also carries the scope (e.g. KB ID and top_k) it was produced
+    under; lines from another scope are ignored on load, so changing the
+    retrieval settings never resumes from incompatible results. A torn last
+    line from a crash is skipped.
+    """
+
+    def __init__(self, path, scope, fsync_every=50):
+        parent = os.path.dirname(path)
+        if parent:
+            os.makedirs(parent, exist_ok=True)
+        self.path = path
+        self.scope = scope
+        self.fsync_every = max(1, fsync_every)
+        self._pending_sync = 0
+        self._lock = threading.Lock()
+        self._file = None
+
+    def load(self):
+        """Returns {row_key: record} for rows already finished in this scope."""
+        done = {}
+        if not os.path.exists(self.path):
+            return done
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    obj = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if obj.get("scope") != self.scope or "row_key" not in obj:
+                    continue
+                done[obj["row_key"]] = obj.get("record", {})
+        return done
+
+    def append(self, row_key, record):
+        line = json.dumps({
+            "row_key": row_key,
+            "scope": self.scope,
+            "record": record,
+            "timestamp": datetime.utcnow().isoformat() + "Z",
+        }, ensure_ascii=False, default=str)
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, "a", encoding="utf-8")
+            self._file.write(line + "\n")
+            self._file.flush()
+            self._pending_sync += 1
+            if self._pending_sync >= self.fsync_every:
+                os.fsync(self._file.fileno())
+                self._pending_sync = 0
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._file.close()
+                self._file = None
+                self._pending_sync = 0
+
+    def discard(self):
+        """Removes the checkpoint once its rows are merged into the final output."""
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def atomic_write_csv(df, path):
+    """Writes df to path via a temp file and os.replace, so readers never see a partial CSV."""
+    parent = os.path.dirname(path)
+    if parent:
+        os.makedirs(parent, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8", newline="") as f:
+        df.to_csv(f, index=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
@@ -0,0 +1,166 @@
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+import config
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = (len(ordered) - 1) * pct / 100.0
+    lower = int(index)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (index - lower)
+
+
+def extract_usage(response_body, response=None):
+    """
+    Returns (input_tokens, output_tokens) from a Bedrock response body,
+    falling back to the token-count HTTP headers. Missing values are 0.
+    """
+    usage = response_body.get("usage") if isinstance(response_body, dict) else None
+    if isinstance(usage, dict):
+        input_tokens = usage.get("prompt_tokens", usage.get("inputTokens", usage.get("input_tokens", 0)))
+        output_tokens = usage.get("completion_tokens", usage.get("outputTokens", usage.get("output_tokens", 0)))
+        return int(input_tokens or 0), int(output_tokens or 0)
+    if isinstance(response_body, dict) and "inputTextTokenCount" in response_body:
+        return int(response_body["inputTextTokenCount"] or 0), 0
+
+    headers = {}
+    if isinstance(response, dict):
+        headers = response.get("ResponseMetadata", {}).get("HTTPHeaders", {})
+    return (
+        int(headers.get("x-amzn-bedrock-input-token-count", 0) or 0),
+        int(headers.get("x-amzn-bedrock-output-token-count", 0) or 0),
+    )
+
+
+class RunMetrics:
+    """
+    Thread-safe per-run accounting of Bedrock calls for one pipeline stage:
+    call count, latency, retries and throttles per operation (recorded by
+    call_with_retry), plus token usage and cache hits recorded by callers.
+    """
+
+    def __init__(self, stage, input_price=None, output_price=None):
+        self.stage = stage
+        self.input_price = config.INPUT_PRICE if input_price is None else input_price
+        self.output_price = config.OUTPUT_PRICE if output_price is None else output_price
+        self.started_at = time.monotonic()
+        self._operations = {}
+        self._lock = threading.Lock()
+
+    def _operation(self, name):
+        if name not in self._operations:
+            self._operations[name] = {
+                "calls": 0,
+                "failed_calls": 0,
+                "retries": 0,
+                "throttles": 0,
+                "cached": 0,
+                "input_tokens": 0,
+                "output_tokens": 0,
+                "latencies": [],
+            }
+        return self._operations[name]
+
+    def record_call(self, operation, latency_seconds, retries=0, throttles=0, success=True):
+        with self._lock:
+            op = self._operation(operation)
+            op["calls"] += 1
+            op["retries"] += retries
+            op["throttles"] += throttles
+            if success:
+                op["latencies"].append(latency_seconds)
+            else:
+                op["failed_calls"] += 1
+
+    def record_usage(self, operation, input_tokens, output_tokens, cached=False):
+        with self._lock:
+            op = self._operation(operation)
+            if cached:
+                op["cached"] += 1
+                return
+            op["input_tokens"] += input_tokens
+            op["output_tokens"] += output_tokens
+
+    def _cost(self, input_tokens, output_tokens):
+        return (input_tokens / 1000.0) * self.input_price + (output_tokens / 1000.0) * self.output_price
+
+    def summary(self):
+        wall_seconds = time.monotonic() - self.started_at
+        with self._lock:
+            operations = {}
+            all_latencies = []
+            totals = {
+                "calls": 0,
+                "failed_calls": 0,
+                "retries": 0,
+                "throttles": 0,
+                "cached": 0,
+                "input_tokens": 0,
+                "output_tokens": 0,
+            }
+            for name, op in self._operations.items():
+                latencies = op["latencies"]
+                all_latencies.extend(latencies)
+                operations[name] = {
+                    key: op[key] for key in totals
+                }
+                operations[name].update({
+                    "p50_latency_seconds": percentile(latencies, 50),
+                    "p95_latency_seconds": percentile(latencies, 95),
+                    "projected_cost": self._cost(op["input_tokens"], op["output_tokens"]),
+                })
+                for key in totals:
+                    totals[key] += op[key]
+
+        totals.update({
+            "p50_latency_seconds": percentile(all_latencies, 50),
+            "p95_latency_seconds": percentile(all_latencies, 95),
+            "projected_cost": self._cost(totals["input_tokens"], totals["output_tokens"]),
+            "wall_seconds": wall_seconds,
+            # Average number of calls in flight; useful to size worker pools.
+            "effective_concurrency": (sum(all_latencies) / wall_seconds) if wall_seconds > 0 else 0.0,
+        })
+        return {
+            "stage": self.stage,
+            "finished_at": datetime.utcnow().isoformat() + "Z",
+            "pricing_per_1k_tokens": {"input": self.input_price, "output": self.output_price},
+            "totals": totals,
+            "operations": operations,
+        }
+
+    def write(self, path):
+        parent = os.path.dirname(path)
+        if parent:
+            os.makedirs(parent, exist_ok=True)
+        summary = self.summary()
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        return summary
+
+    def print_summary(self, summary=None):
+        summary = summary or self.summary()
+        totals = summary["totals"]
+
+        def _fmt(value):
+            return f"{value:.2f}s" if value is not None else "n/a"
+
+        print(
+            f"[{self.stage}] Bedrock calls: {totals['calls']} "
+            f"(failed {totals['failed_calls']}, retries {totals['retries']}, "
+            f"throttles {totals['throttles']}, cached {totals['cached']}) | "
+            f"tokens in/out: {totals['input_tokens']}/{totals['output_tokens']} | "
+            f"latency p50/p95: {_fmt(totals['p50_latency_seconds'])}/{_fmt(totals['p95_latency_seconds'])} | "
+            f"projected cost: ${totals['projected_cost']:.4f}"
+        )
+
+
+def record_response_usage(metrics, operation, response, response_body):
+    input_tokens, output_tokens = extract_usage(response_body, response)
+    metrics.record_usage(operation, input_tokens, output_tokens, cached=bool(response.get("cached")))
@@ -0,0 +1,185 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from datetime import datetime
+
+STATUS_PENDING = "pending"
+STATUS_GENERATED = "generated"
+STATUS_SKIPPED_NO_GENERATION = "skipped_no_generation"
+STATUS_FAILED = "failed"
+STATUS_STALE = "stale"
+
+DONE_STATUSES = (STATUS_GENERATED, STATUS_SKIPPED_NO_GENERATION)
+
+
+def content_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def _now():
+    return datetime.utcnow().isoformat() + "Z"
+
+
+class RunStateStore:
+    """
+    SQLite-backed generation state, one row per (file_path, style_name, kb_hash).
+
+    kb_hash is the content hash of the KB document, so an edited document
+    gets fresh rows instead of reusing the old ones. Completed pairs
+    (generated / skipped_no_generation) are never downgraded to pending.
+    """
+
+    def __init__(self, path):
+        parent = os.path.dirname(path)
+        if parent:
+            os.makedirs(parent, exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS pairs ("
+            "file_path TEXT NOT NULL, "
+            "style_name TEXT NOT NULL, "
+            "kb_hash TEXT NOT NULL, "
+            "status TEXT NOT NULL, "
+            "updated_at TEXT NOT NULL, "
+            "PRIMARY KEY (file_path, style_name, kb_hash))"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+        )
+        self._conn.commit()
+
+    def is_done(self, file_path, style_name, kb_hash):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT status FROM pairs WHERE file_path = ? AND style_name = ? AND kb_hash = ?",
+                (file_path, style_name, kb_hash),
+            ).fetchone()
+        return row is not None and row[0] in DONE_STATUSES
+
+    def count_done(self):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM pairs WHERE status IN (?, ?)", DONE_STATUSES
+            ).fetchone()[0]
+
+    def mark_many(self, entries):
+        """Applies [(file_path, style_name, kb_hash, status), ...] in one transaction."""
+        if not entries:
+            return
+        updated_at = _now()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO pairs (file_path, style_name, kb_hash, status, updated_at) "
+                "VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (file_path, style_name, kb_hash) DO UPDATE SET "
+                "status = excluded.status, updated_at = excluded.updated_at "
+                "WHERE pairs.status NOT IN (?, ?) OR excluded.status IN (?, ?)",
+                [
+                    (file_path, style_name, kb_hash, status, updated_at) + DONE_STATUSES + DONE_STATUSES
+                    for file_path, style_name, kb_hash, status in entries
+                ],
+            )
+
+    def mark(self, file_path, style_name, kb_hash, status):
+        self.mark_many([(file_path, style_name, kb_hash, status)])
+
+    def mark_stale(self, file_path, keep_hash=None):
+        """Marks every row of file_path stale, except those for keep_hash."""
+        with self._lock, self._conn:
+            return self._conn.execute(
+                "UPDATE pairs SET status = ?, updated_at = ? "
+                "WHERE file_path = ? AND kb_hash != ?",
+                (STATUS_STALE, _now(), file_path, keep_hash or ""),
+            ).rowcount
+
+    def carry_over(self, old_path, new_path, kb_hash):
+        """Copies completed rows of a renamed, content-identical document to its new path."""
+        with self._lock, self._conn:
+            return self._conn.execute(
+                "INSERT OR IGNORE INTO pairs (file_path, style_name, kb_hash, status, updated_at) "
+                "SELECT ?, style_name, kb_hash, status, ? FROM pairs "
+                "WHERE file_path = ? AND kb_hash = ? AND status IN (?, ?)",
+                (new_path, _now(), old_path, kb_hash) + DONE_STATUSES,
+            ).rowcount
+
+    def import_progress_log(self, progress_log_path, hash_for_file):
+        """
+        One-time import of a legacy generation_progress.jsonl. Legacy lines
+        carry no content hash, so hash_for_file(file_path) supplies the hash
+        of the document as it is on disk now (None skips the line).
+        Returns the number of imported entries, 0 if already imported.
+        """
+        if not os.path.exists(progress_log_path):
+            return 0
+        marker = f"imported:{os.path.abspath(progress_log_path)}"
+        with self._lock:
+            already = self._conn.execute(
+                "SELECT 1 FROM meta WHERE key = ?", (marker,)
+            ).fetchone()
+        if already:
+            return 0
+
+        entries = []
+        hashes = {}
+        with open(progress_log_path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    obj = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                file_path = obj.get("file_path")
+                style_name = obj.get("style_name")
+                status = obj.get("status")
+                if not (file_path and style_name and status in DONE_STATUSES):
+                    continue
+                if file_path not in hashes:
+                    hashes[file_path] = hash_for_file(file_path)
+                if hashes[file_path] is None:
+                    continue
+                entries.append((file_path, style_name, hashes[file_path], status))
+
+        self.mark_many(entries)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (marker, _now())
+            )
+        return len(entries)
+
+    def compact(self, keep_hashes=()):
+        """
+        Drops stale rows already superseded by a live row for another
+        kb_hash of the same file/style, then VACUUMs. Stale rows of deleted
+        documents have no successor and are kept, and so are rows whose
+        kb_hash is in keep_hashes (content the output CSV still holds).
+        """
+        keep_hashes = set(keep_hashes)
+        with self._lock:
+            superseded = self._conn.execute(
+                "SELECT file_path, style_name, kb_hash FROM pairs WHERE status = ? AND EXISTS ("
+                "SELECT 1 FROM pairs AS live "
+                "WHERE live.file_path = pairs.file_path "
+                "AND live.style_name = pairs.style_name "
+                "AND live.kb_hash != pairs.kb_hash "
+                "AND live.status != ?)",
+                (STATUS_STALE, STATUS_STALE),
+            ).fetchall()
+            removable = [key for key in superseded if key[2] not in keep_hashes]
+            with self._conn:
+                self._conn.executemany(
+                    "DELETE FROM pairs WHERE file_path = ? AND style_name = ? AND kb_hash = ?",
+                    removable,
+                )
+            self._conn.execute("VACUUM")
+        return len(removable)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,137 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+import config
+
+# SQLite caps bound parameters per statement; lookups are chunked below it.
+LOOKUP_CHUNK = 400
+
+
+def hash_text(text):
+    return hashlib.sha256(str(text).encode("utf-8")).hexdigest()
+
+
+class ScoreCache:
+    """
+    Persistent reranker relevance scores in a local SQLite file, keyed by
+    (model, hash(query), hash(chunk), max_length). Only hashes are stored,
+    so the file stays small even for large test sets.
+
+    The mean scoring time per pair of the last run that scored anything is
+    kept per (model, max_length), to estimate the time saved by hits.
+    """
+
+    def __init__(self, path):
+        parent = os.path.dirname(path)
+        if parent:
+            os.makedirs(parent, exist_ok=True)
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.time_saved_seconds = 0.0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS scores ("
+            "model TEXT NOT NULL, "
+            "query_hash TEXT NOT NULL, "
+            "chunk_hash TEXT NOT NULL, "
+            "max_length INTEGER NOT NULL, "
+            "score REAL NOT NULL, "
+            "updated_at REAL NOT NULL, "
+            "PRIMARY KEY (model, query_hash, chunk_hash, max_length))"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS timings ("
+            "model TEXT NOT NULL, "
+            "max_length INTEGER NOT NULL, "
+            "seconds_per_pair REAL NOT NULL, "
+            "updated_at REAL NOT NULL, "
+            "PRIMARY KEY (model, max_length))"
+        )
+        self._conn.commit()
+
+    def get_many(self, model, max_length, pairs):
+        """Cached score for each (query, chunk) pair, or None where missing."""
+        keys = [(hash_text(query), hash_text(chunk)) for query, chunk in pairs]
+        found = {}
+        with self._lock:
+            for start in range(0, len(keys), LOOKUP_CHUNK):
+                chunk_keys = keys[start:start + LOOKUP_CHUNK]
+                placeholders = ", ".join("(?, ?)" for _ in chunk_keys)
+                rows = self._conn.execute(
+                    "SELECT query_hash, chunk_hash, score FROM scores "
+                    f"WHERE model = ? AND max_length = ? AND (query_hash, chunk_hash) IN (VALUES {placeholders})",
+                    [model, max_length] + [value for key in chunk_keys for value in key],
+                ).fetchall()
+                for query_hash, chunk_hash, score in rows:
+                    found[(query_hash, chunk_hash)] = score
+        scores = [found.get(key) for key in keys]
+        hits = sum(score is not None for score in scores)
+        with self._lock:
+            self.hits += hits
+            self.misses += len(scores) - hits
+        return scores
+
+    def put_many(self, model, max_length, pairs, scores):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO scores (model, query_hash, chunk_hash, max_length, score, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (model, hash_text(query), hash_text(chunk), max_length, float(score), now)
+                    for (query, chunk), score in zip(pairs, scores)
+                ],
+            )
+
+    def seconds_per_pair(self, model, max_length):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT seconds_per_pair FROM timings WHERE model = ? AND max_length = ?",
+                (model, max_length),
+            ).fetchone()
+        return row[0] if row else None
+
+    def record_timing(self, model, max_length, scored_pairs, seconds, hits):
+        """Stores this run's per-pair time and credits the hits with the time they saved."""
+        if scored_pairs:
+            with self._lock, self._conn:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO timings (model, max_length, seconds_per_pair, updated_at) "
+                    "VALUES (?, ?, ?, ?)",
+                    (model, max_length, seconds / scored_pairs, time.time()),
+                )
+        per_pair = self.seconds_per_pair(model, max_length)
+        if per_pair is not None:
+            with self._lock:
+                self.time_saved_seconds += hits * per_pair
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "path": self.path,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / lookups) if lookups else 0.0,
+            "time_saved_seconds": round(self.time_saved_seconds, 2),
+        }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_score_cache():
+    """Returns the process-wide cache, or None when RELEVANCE_CACHE_ENABLED is off."""
+    global _cache
+    if not config.RELEVANCE_CACHE_ENABLED:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = ScoreCache(config.RELEVANCE_CACHE_PATH)
+        return _cache
@@ -3,6 +3,7 @@
 import ast
 import html
 import json
+import sys
 from pathlib import Path
 from typing import Any, Iterable
 
@@ -10,10 +11,27 @@ import pandas as pd
 import streamlit as st
 import altair as alt
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import config  # noqa: E402
+from agent_trace import latency_breakdown, load_batch_records, steps_frame  # noqa: E402
+
 
 APP_DIR = Path(__file__).parent
 DATASETS_DIR = APP_DIR / "complete_datasets"
 METRICS_PATH = APP_DIR / "metrics.json"
+# Written by the batch mode of retriever/agent/agent_raw_retriever.py.
+AGENT_BATCH_PATH = Path(config.PIPELINE_OUTPUT_DIR) / "agent_batch_results.jsonl"
+
+AGENT_CATEGORY_LABELS = {
+    "guardrail": "Guardrails",
+    "retrieval": "Recuperación (KB)",
+    "action_group": "Action groups",
+    "reasoning": "Razonamiento",
+    "generation": "Generación",
+    "model": "Modelo (sin tipo)",
+    "other": "Otros",
+    "unattributed": "Sin atribuir",
+}
 
 
 st.set_page_config(
@@ -134,6 +152,81 @@ def render_run_summary_tab(dataset_path: Path) -> None:
     st.markdown(summary_md, unsafe_allow_html=True)
 
 
+@st.cache_data(show_spinner=False)
+def load_agent_steps(results_path: str, modified_at: float) -> pd.DataFrame:
+    # modified_at only invalidates the cache when the file is rewritten.
+    return steps_frame(load_batch_records(results_path))
+
+
+def render_agent_latency_tab() -> None:
+    st.markdown("### Latencia del agente")
+    st.caption(
+        "Desglose por paso de las trazas de `invoke_agent` "
+        "(modo batch de `retriever/agent/agent_raw_retriever.py`)."
+    )
+    results_path = Path(st.text_input(
+        "Archivo de resultados del agente (JSONL)",
+        str(AGENT_BATCH_PATH),
+    ))
+    if not results_path.exists():
+        st.info(f"No se encontró `{results_path}`.")
+        return
+
+    steps_df = load_agent_steps(str(results_path), results_path.stat().st_mtime)
+    if steps_df.empty:
+        st.info("El archivo no contiene trazas con tiempos. ¿Se ejecutó con `ENABLE_TRACE = True`?")
+        return
+
+    breakdown = latency_breakdown(steps_df)
+    breakdown["paso"] = breakdown["category"].map(lambda c: AGENT_CATEGORY_LABELS.get(c, c))
+    breakdown["share_pct"] = breakdown["share_of_total"] * 100
+    end_to_end = steps_df.drop_duplicates("row_index")["end_to_end_ms"].dropna()
+
+    col1, col2, col3 = st.columns(3)
+    col1.metric("Consultas", f"{steps_df['row_index'].nunique()}")
+    col2.metric("Latencia p50", f"{end_to_end.quantile(0.5) / 1000:.2f} s" if not end_to_end.empty else "N/D")
+    col3.metric("Latencia p95", f"{end_to_end.quantile(0.95) / 1000:.2f} s" if not end_to_end.empty else "N/D")
+
+    chart = (
+        alt.Chart(breakdown)
+        .mark_bar(cornerRadiusTopRight=4, cornerRadiusBottomRight=4)
+        .encode(
+            y=alt.Y("paso:N", title=None, sort=list(breakdown["paso"])),
+            x=alt.X("mean_ms:Q", title="Milisegundos promedio por consulta"),
+            color=alt.value("#2563eb"),
+            tooltip=[
+                alt.Tooltip("paso:N", title="Paso"),
+                alt.Tooltip("mean_ms:Q", title="Promedio (ms)", format=".0f"),
+                alt.Tooltip("p95_ms:Q", title="p95 (ms)", format=".0f"),
+                alt.Tooltip("share_of_total:Q", title="Proporción del total", format=".1%"),
+            ],
+        )
+        .properties(height=40 * len(breakdown) + 40)
+        .configure_axis(grid=False)
+        .configure_view(strokeWidth=0)
+    )
+    st.altair_chart(chart, use_container_width=True)
+
+    st.dataframe(
+        breakdown[[
+            "paso", "queries", "calls_per_query", "mean_ms", "p50_ms", "p95_ms",
+            "share_pct", "mean_input_tokens", "mean_output_tokens",
+        ]].round(1).rename(columns={
+            "paso": "Paso",
+            "queries": "Consultas",
+            "calls_per_query": "Llamadas por consulta",
+            "mean_ms": "Promedio (ms)",
+            "p50_ms": "p50 (ms)",
+            "p95_ms": "p95 (ms)",
+            "share_pct": "Proporción del total (%)",
+            "mean_input_tokens": "Tokens de entrada",
+            "mean_output_tokens": "Tokens de salida",
+        }),
+        hide_index=True,
+        use_container_width=True,
+    )
+
+
 # --- STYLING ---
 
 CSS = """
@@ -476,6 +569,9 @@ def render_hero(df: pd.DataFrame) -> None:
     total = len(df)
     styles = df["query_style"].nunique() if "query_style" in df.columns else 0
     files = df["source_file"].nunique() if "source_file" in df.columns else 0
+    kb_pill = ""
+    if "kb_variant" in df.columns and df["kb_variant"].notna().any():
+        kb_pill = f'<span class="metric-pill">KB {html.escape(str(df["kb_variant"].dropna().iloc[0]))}</span>'
     st.markdown(
         f"""
         <div class="hero">
@@ -485,6 +581,7 @@ def render_hero(df: pd.DataFrame) -> None:
                 <span class="metric-pill">{total} casos de prueba</span>
                 <span class="metric-pill">{styles} estilos de consulta</span>
                 <span class="metric-pill">{files} archivos fuente</span>
+                {kb_pill}
             </div>
         </div>
         """,
@@ -641,7 +738,8 @@ def value_to_color(value: float | None) -> str | None:
 def _available_datasets() -> list[Path]:
     if not DATASETS_DIR.exists():
         return []
-    return sorted(DATASETS_DIR.glob("**/*.parquet"))
+    # K-sweep tables live next to the results but are not per-case datasets.
+    return sorted(p for p in DATASETS_DIR.glob("**/*.parquet") if not p.name.endswith("_k_sweep.parquet"))
 
 
 def _render_kpi_cards(
@@ -995,7 +1093,7 @@ def select_dataset() -> Path | None:
         if not DATASETS_DIR.exists():
             st.error(f"No se encontró la carpeta de conjuntos de datos: {DATASETS_DIR}")
             return None
-        parquet_files = sorted(DATASETS_DIR.glob("**/*.parquet"))
+        parquet_files = _available_datasets()
         if not parquet_files:
             st.error(f"No se encontraron archivos parquet en {DATASETS_DIR}")
             return None
@@ -1045,11 +1143,12 @@ def main() -> None:
         st.warning("Ningún dato coincide con los filtros seleccionados.")
         return
 
-    tab1, tab2, tab3, tab4 = st.tabs([
+    tab1, tab2, tab3, tab4, tab5 = st.tabs([
         "Métricas globales",
         "Análisis de resultados",
         "Explorador de casos de prueba",
         "Comparar datasets",
+        "Latencia del agente",
     ])
     
     with tab1:
@@ -1064,6 +1163,9 @@ def main() -> None:
     with tab4:
         render_compare_datasets_tab()
 
+    with tab5:
+        render_agent_latency_tab()
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,101 @@
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bedrock_utils import StreamStopParser, invoke_model_streaming  # noqa: E402
+
+STOP_TAG = "</user_input>"
+
+
+class StubStream:
+    """invoke_model_with_response_stream body: one OpenAI-style delta event per piece of text."""
+
+    def __init__(self, deltas, invocation_metrics=None):
+        self.deltas = deltas
+        self.invocation_metrics = invocation_metrics
+        self.read = 0
+        self.closed = False
+
+    def __iter__(self):
+        for delta in self.deltas:
+            self.read += 1
+            yield {"chunk": {"bytes": json.dumps({"choices": [{"delta": {"content": delta}}]}).encode("utf-8")}}
+        if self.invocation_metrics:
+            payload = {"choices": [], "amazon-bedrock-invocationMetrics": self.invocation_metrics}
+            yield {"chunk": {"bytes": json.dumps(payload).encode("utf-8")}}
+
+    def close(self):
+        self.closed = True
+
+
+class StubClient:
+    def __init__(self, stream):
+        self.stream = stream
+
+    def invoke_model_with_response_stream(self, modelId, body):
+        return {"body": self.stream}
+
+
+def feed_all(parser, deltas):
+    return [parser.feed(delta) for delta in deltas]
+
+
+def test_stop_tag_split_across_two_deltas():
+    parser = StreamStopParser(STOP_TAG)
+    assert feed_all(parser, ["<user_input>hola</user_", "input> resto"]) == [False, True]
+    assert parser.matches == 1
+
+
+def test_stop_tag_is_case_insensitive():
+    parser = StreamStopParser(STOP_TAG)
+    assert parser.feed("<USER_INPUT>hola</USER_INPUT>")
+
+
+def test_tags_inside_reasoning_are_ignored():
+    parser = StreamStopParser(STOP_TAG)
+    deltas = ["<reason", "ing>ejemplo: </user_input> y </user_in", "put></reas", "oning>", "<user_input>q</user_input>"]
+    assert feed_all(parser, deltas) == [False, False, False, False, True]
+    assert parser.matches == 1
+
+
+def test_stop_count_waits_for_every_block():
+    parser = StreamStopParser(STOP_TAG, stop_count=2)
+    assert feed_all(parser, ["<user_input>a</user_input>", "<user_input>b</user_", "input>"]) == [False, False, True]
+
+
+def test_any_split_matches_a_single_feed():
+    text = "<reasoning>x </user_input></reasoning><user_input>a</user_input><user_input>b</user_input>"
+    whole = StreamStopParser(STOP_TAG, stop_count=5)
+    whole.feed(text)
+    for size in range(1, len(text) + 1):
+        parser = StreamStopParser(STOP_TAG, stop_count=5)
+        feed_all(parser, [text[i:i + size] for i in range(0, len(text), size)])
+        assert parser.matches == whole.matches == 2
+        assert parser.text == text
+
+
+def test_early_stop_closes_stream_and_estimates_usage():
+    stream = StubStream(["<reasoning>r</reasoning><user_input>q</user_", "input>", " sobrante", " sobrante"])
+    latency_log = []
+    response = invoke_model_streaming(StubClient(stream), "model", "{}", STOP_TAG, latency_log=latency_log)
+    payload = json.loads(response["body"].read().decode("utf-8"))
+
+    assert stream.read == 2
+    assert stream.closed
+    assert payload["choices"][0]["message"]["content"] == "<reasoning>r</reasoning><user_input>q</user_input>"
+    assert payload["usage"]["estimated"] is True
+    assert set(payload["usage"]) == {"prompt_tokens", "completion_tokens", "estimated"}
+    assert latency_log[0]["stopped_early"] is True
+
+
+def test_full_stream_uses_invocation_metrics():
+    stream = StubStream(["<user_input>q"], invocation_metrics={"inputTokenCount": 11, "outputTokenCount": 3})
+    latency_log = []
+    response = invoke_model_streaming(StubClient(stream), "model", "{}", STOP_TAG, latency_log=latency_log)
+    payload = json.loads(response["body"].read().decode("utf-8"))
+
+    assert not stream.closed
+    assert payload["choices"][0]["message"]["content"] == "<user_input>q"
+    assert payload["usage"] == {"prompt_tokens": 11, "completion_tokens": 3}
+    assert latency_log[0]["stopped_early"] is False
@@ -0,0 +1,346 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import config
+from bedrock_utils import call_with_retry, estimate_tokens, get_model_limiter
+from bm25_index import tokenize
+from llm_cache import cached_invoke, get_llm_cache
+from run_metrics import record_response_usage
+
+VECTORS_FILE = "vectors.npy"
+IDS_FILE = "ids.json"
+META_FILE = "meta.json"
+IVF_FILE = "ivf.npz"
+
+
+def split_passages_by_tokens(text, chunk_tokens, overlap_tokens=0):
+    """
+    Word windows of about chunk_tokens tokens, using the same ~4 chars per
+    token estimate as estimate_tokens. Lets 200- vs 512-token KB chunking
+    be simulated without re-ingesting the KB.
+    """
+    words = str(text).split()
+    if not words:
+        return []
+    if chunk_tokens <= 0:
+        return [" ".join(words)]
+    budget = chunk_tokens * 4
+    overlap_budget = max(0, overlap_tokens) * 4
+
+    passages = []
+    start = 0
+    while start < len(words):
+        end = start
+        size = 0
+        while end < len(words) and (end == start or size + len(words[end]) + 1 <= budget):
+            size += len(words[end]) + 1
+            end += 1
+        passages.append(" ".join(words[start:end]))
+        if end >= len(words):
+            break
+        # Step back over roughly overlap_budget characters, always moving forward.
+        next_start = end
+        overlap = 0
+        while next_start - 1 > start and overlap + len(words[next_start - 1]) + 1 <= overlap_budget:
+            next_start -= 1
+            overlap += len(words[next_start]) + 1
+        start = next_start
+    return passages
+
+
+def normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+class HashingEmbeddingProvider:
+    """
+    Deterministic local stand-in for an embedding model: signed feature
+    hashing of unigram and bigram tokens into dim buckets, L2-normalized.
+    Same text, same vector, on any machine and without network access.
+    """
+
+    def __init__(self, dim=384):
+        self.dim = dim
+        self._buckets = {}
+
+    @property
+    def name(self):
+        return f"hash:{self.dim}"
+
+    def _bucket(self, feature):
+        if feature not in self._buckets:
+            digest = int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "little")
+            self._buckets[feature] = (digest % self.dim, 1.0 if digest >> 63 else -1.0)
+        return self._buckets[feature]
+
+    def embed(self, texts):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            tokens = tokenize(text)
+            for feature in tokens + [f"{a}_{b}" for a, b in zip(tokens, tokens[1:])]:
+                bucket, sign = self._bucket(feature)
+                vectors[row, bucket] += sign
+        return normalize_rows(vectors)
+
+
+class EmbeddingError(RuntimeError):
+    """Some texts could not be embedded; failed_rows are their positions in the input."""
+
+    def __init__(self, failed_rows, total):
+        self.failed_rows = list(failed_rows)
+        self.total = total
+        preview = ", ".join(str(row) for row in self.failed_rows[:10])
+        more = ", ..." if len(self.failed_rows) > 10 else ""
+        super().__init__(f"{len(self.failed_rows)} of {total} texts could not be embedded (rows {preview}{more})")
+
+
+class TitanEmbeddingProvider:
+    """
+    Titan Text Embeddings V2 through invoke_model. Responses go through the
+    persistent LLM response cache, so re-embedding an unchanged chunk or
+    query is free after the first run.
+    """
+
+    SUPPORTED_DIMS = (256, 512, 1024)
+
+    def __init__(self, client, model_id, dim=1024, workers=4, error_log=None, metrics=None):
+        if dim not in self.SUPPORTED_DIMS:
+            raise ValueError(
+                f"Titan Text Embeddings V2 supports dimensions {self.SUPPORTED_DIMS}, not {dim}; set VECTOR_DIM accordingly."
+            )
+        self.client = client
+        self.model_id = model_id
+        self.dim = dim
+        self.workers = max(1, workers)
+        self.error_log = error_log if error_log is not None else []
+        self.metrics = metrics
+        self.failures = 0
+
+    @property
+    def name(self):
+        return f"titan:{self.model_id}:{self.dim}"
+
+    def _embed_one(self, text):
+        body = json.dumps({"inputText": text, "dimensions": self.dim, "normalize": True})
+
+        def _call():
+            return self.client.invoke_model(modelId=self.model_id, body=body)
+
+        response = cached_invoke(
+            get_llm_cache(),
+            self.model_id,
+            body,
+            0.0,
+            lambda: call_with_retry(
+                _call,
+                "invoke_model_embedding",
+                self.error_log,
+                limiter=get_model_limiter(self.model_id),
+                tokens=estimate_tokens(text),
+                metrics=self.metrics,
+            ),
+        )
+        if response is None:
+            return None
+        payload = json.loads(response.get("body").read().decode("utf-8"))
+        if self.metrics is not None:
+            record_response_usage(self.metrics, "invoke_model_embedding", response, payload)
+        return payload.get("embedding")
+
+    def embed(self, texts):
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            embeddings = list(executor.map(self._embed_one, texts))
+        failed_rows = [row for row, embedding in enumerate(embeddings) if embedding is None]
+        if failed_rows:
+            # Zero vectors would silently stand in for real embeddings, so the caller has to decide.
+            self.failures += len(failed_rows)
+            raise EmbeddingError(failed_rows, len(texts))
+        return normalize_rows(np.asarray(embeddings, dtype=np.float32))
+
+
+def _top_k_merge(best_rows, best_scores, rows, scores, top_k):
+    """Keeps the top_k of two (queries, n) candidate sets, unsorted."""
+    rows = np.concatenate([best_rows, rows], axis=1)
+    scores = np.concatenate([best_scores, scores], axis=1)
+    if scores.shape[1] > top_k:
+        keep = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+        rows = np.take_along_axis(rows, keep, axis=1)
+        scores = np.take_along_axis(scores, keep, axis=1)
+    return rows, scores
+
+
+def _sorted_results(rows, scores):
+    order = np.argsort(-scores, axis=1, kind="stable")
+    rows = np.take_along_axis(rows, order, axis=1)
+    scores = np.take_along_axis(scores, order, axis=1)
+    return [
+        (row[row >= 0].tolist(), score[row >= 0].tolist())
+        for row, score in zip(rows, scores)
+    ]
+
+
+class VectorStore:
+    """
+    On-disk embedding store: an (n, dim) float16/float32 .npy matrix opened
+    as a read-only memory map, plus an ids.json sidecar (chunk IDs, source
+    URIs, passage texts) and meta.json describing how it was built. Rows
+    are L2-normalized, so the dot product is the cosine similarity.
+    """
+
+    def __init__(self, index_dir, vectors, ids, uris, passages, meta):
+        self.index_dir = index_dir
+        self.vectors = vectors
+        self.ids = ids
+        self.uris = uris
+        self.passages = passages
+        self.meta = meta
+        self.ivf = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def build(cls, index_dir, passages, uris, provider, dtype="float16", batch_size=256, meta=None):
+        os.makedirs(index_dir, exist_ok=True)
+        for stale in (META_FILE, IVF_FILE):
+            if os.path.exists(os.path.join(index_dir, stale)):
+                os.remove(os.path.join(index_dir, stale))
+
+        tmp_vectors = os.path.join(index_dir, f"tmp_{VECTORS_FILE}")
+        vectors = np.lib.format.open_memmap(
+            tmp_vectors, mode="w+", dtype=np.dtype(dtype), shape=(len(passages), provider.dim)
+        )
+        for start in range(0, len(passages), batch_size):
+            batch = passages[start:start + batch_size]
+            try:
+                vectors[start:start + len(batch)] = provider.embed(batch)
+            except EmbeddingError as exc:
+                del vectors
+                os.remove(tmp_vectors)
+                raise EmbeddingError([start + row for row in exc.failed_rows], len(passages)) from exc
+            print(f"Embedded {start + len(batch)}/{len(passages)} passages")
+        vectors.flush()
+        del vectors
+        os.replace(tmp_vectors, os.path.join(index_dir, VECTORS_FILE))
+
+        ids = []
+        counts = {}
+        for uri in uris:
+            ids.append(f"{uri}#{counts.get(uri, 0)}")
+            counts[uri] = counts.get(uri, 0) + 1
+        with open(os.path.join(index_dir, IDS_FILE), "w", encoding="utf-8") as f:
+            json.dump({"ids": ids, "uris": uris, "passages": passages}, f, ensure_ascii=False)
+
+        meta = dict(meta or {})
+        meta.update({"provider": provider.name, "dim": provider.dim, "dtype": str(np.dtype(dtype)), "count": len(passages)})
+        # meta.json is written last: its presence marks a complete store.
+        with open(os.path.join(index_dir, META_FILE), "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False, indent=2)
+        return cls.load(index_dir)
+
+    @classmethod
+    def load(cls, index_dir):
+        meta_path = os.path.join(index_dir, META_FILE)
+        if not os.path.exists(meta_path):
+            return None
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            with open(os.path.join(index_dir, IDS_FILE), "r", encoding="utf-8") as f:
+                sidecar = json.load(f)
+            vectors = np.load(os.path.join(index_dir, VECTORS_FILE), mmap_mode="r")
+        except (OSError, ValueError, json.JSONDecodeError):
+            return None
+        if vectors.shape[0] != meta.get("count") or len(sidecar["ids"]) != vectors.shape[0]:
+            return None
+        store = cls(index_dir, vectors, sidecar["ids"], sidecar["uris"], sidecar["passages"], meta)
+        ivf_path = os.path.join(index_dir, IVF_FILE)
+        if os.path.exists(ivf_path):
+            with np.load(ivf_path) as ivf:
+                store.ivf = {key: ivf[key] for key in ivf.files}
+        return store
+
+    def search(self, query_vectors, top_k, block_rows=65536):
+        """
+        Exact top-k (row indices, scores) per query, best first. The memmap is
+        streamed in blocks of block_rows; each block is one matrix multiply
+        followed by argpartition, merged into the running top-k.
+        """
+        queries = np.asarray(query_vectors, dtype=np.float32)
+        top_k = min(top_k, len(self))
+        if top_k <= 0:
+            return [([], []) for _ in range(len(queries))]
+
+        best_rows = np.empty((len(queries), 0), dtype=np.int64)
+        best_scores = np.empty((len(queries), 0), dtype=np.float32)
+        for start in range(0, len(self), block_rows):
+            block = np.asarray(self.vectors[start:start + block_rows], dtype=np.float32)
+            scores = queries @ block.T
+            block_k = min(top_k, scores.shape[1])
+            if block_k < scores.shape[1]:
+                rows = np.argpartition(-scores, block_k - 1, axis=1)[:, :block_k]
+                scores = np.take_along_axis(scores, rows, axis=1)
+            else:
+                rows = np.tile(np.arange(scores.shape[1]), (len(queries), 1))
+            best_rows, best_scores = _top_k_merge(best_rows, best_scores, rows + start, scores, top_k)
+        return _sorted_results(best_rows, best_scores)
+
+    def build_ivf(self, n_lists, iterations=10, seed=None, block_rows=65536):
+        """
+        Spherical k-means inverted file: n_lists centroids and, per list,
+        the rows assigned to it (CSR offsets/members). Saved next to the store.
+        """
+        n_lists = max(1, min(n_lists, len(self)))
+        rng = np.random.default_rng(config.SEED if seed is None else seed)
+        centroids = np.asarray(self.vectors[np.sort(rng.choice(len(self), n_lists, replace=False))], dtype=np.float32)
+
+        for _ in range(max(1, iterations)):
+            assignments = self._assign(centroids, block_rows)
+            sums = np.zeros_like(centroids)
+            for start in range(0, len(self), block_rows):
+                block = np.asarray(self.vectors[start:start + block_rows], dtype=np.float32)
+                np.add.at(sums, assignments[start:start + len(block)], block)
+            filled = np.bincount(assignments, minlength=n_lists) > 0
+            centroids[filled] = normalize_rows(sums[filled])
+
+        assignments = self._assign(centroids, block_rows)
+        members = np.argsort(assignments, kind="stable")
+        offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignments, minlength=n_lists), out=offsets[1:])
+        self.ivf = {"centroids": centroids, "offsets": offsets, "members": members}
+        np.savez(os.path.join(self.index_dir, IVF_FILE), **self.ivf)
+        return self.ivf
+
+    def _assign(self, centroids, block_rows):
+        assignments = np.empty(len(self), dtype=np.int64)
+        for start in range(0, len(self), block_rows):
+            block = np.asarray(self.vectors[start:start + block_rows], dtype=np.float32)
+            assignments[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+        return assignments
+
+    def search_ivf(self, query_vectors, top_k, nprobe=8):
+        """Approximate top-k: exact scores over the rows of the nprobe closest lists only."""
+        if self.ivf is None:
+            return self.search(query_vectors, top_k)
+        queries = np.asarray(query_vectors, dtype=np.float32)
+        centroids, offsets, members = self.ivf["centroids"], self.ivf["offsets"], self.ivf["members"]
+        nprobe = max(1, min(nprobe, len(centroids)))
+        probe = np.argsort(-(queries @ centroids.T), axis=1)[:, :nprobe]
+
+        results = []
+        for query, lists in zip(queries, probe):
+            candidates = np.sort(np.concatenate([members[offsets[i]:offsets[i + 1]] for i in lists]))
+            if len(candidates) == 0:
+                results.append(([], []))
+                continue
+            scores = np.asarray(self.vectors[candidates], dtype=np.float32) @ query
+            k = min(top_k, len(candidates))
+            keep = np.argpartition(-scores, k - 1)[:k] if k < len(candidates) else np.arange(len(candidates))
+            keep = keep[np.argsort(-scores[keep], kind="stable")]
+            results.append((candidates[keep].tolist(), scores[keep].tolist()))
+        return results